@@ -0,0 +1,190 @@
+"""
+アカウント（ユーザー名・パスワードハッシュ）の保存先。backend/accounts.db（SQLite）に持つ。
+username は UNIQUE 制約付きなので、同時登録でも重複・書き込み消失が起きない。
+読み取りはプロセス内キャッシュから返し、他プロセスの書き込みは PRAGMA data_version で検知して捨てる。
+
+旧形式の accounts.json は初回起動時に自動で取り込む。手動で取り込む場合:
+
+  python accounts_store.py import                  # backend/accounts.json
+  python accounts_store.py import path/to/accounts.json
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import threading
+from collections import OrderedDict
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+# キャッシュするアカウント数の上限（古いものから捨てる）。存在しない名前は覚えない
+ACCOUNT_CACHE_MAX = int(os.getenv("SUMAPURO_ACCOUNT_CACHE_SIZE", "4096"))
+
+
+class AccountRepository:
+    """accounts テーブルへの読み書き。1本の接続をロックで共有する（1件ずつの小さな操作のみ）。"""
+
+    def __init__(self, db_path, legacy_json_path=None):
+        self.db_path = db_path
+        self.legacy_json_path = legacy_json_path
+        self._conn = None
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._data_version = None
+
+    def _connect(self):
+        if self._conn is not None:
+            return self._conn
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS accounts ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "username TEXT NOT NULL UNIQUE, "
+            "password_hash TEXT NOT NULL)"
+        )
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._conn = conn
+        imported = conn.execute("SELECT value FROM meta WHERE key = 'legacy_json_imported'").fetchone()
+        if not imported and self.legacy_json_path and os.path.exists(self.legacy_json_path):
+            self._import_locked(load_legacy_json(self.legacy_json_path))
+            conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('legacy_json_imported', '1')"
+            )
+        return conn
+
+    def _validate_cache_locked(self, conn):
+        # data_version は「この接続以外」がコミットしたときだけ変わる
+        version = conn.execute("PRAGMA data_version").fetchone()[0]
+        if version != self._data_version:
+            self._cache.clear()
+            self._data_version = version
+
+    def get_password_hash(self, username):
+        """username のパスワードハッシュ。アカウントが無ければ None。"""
+        with self._lock:
+            conn = self._connect()
+            self._validate_cache_locked(conn)
+            if username in self._cache:
+                self._cache.move_to_end(username)
+                return self._cache[username]
+            row = conn.execute(
+                "SELECT password_hash FROM accounts WHERE username = ?", (username,)
+            ).fetchone()
+            if row is None:
+                # 存在しない名前でのログイン試行でキャッシュが増え続けないよう、無いことは覚えない
+                return None
+            self._remember_locked(username, row[0])
+            return row[0]
+
+    def _remember_locked(self, username, password_hash):
+        self._cache[username] = password_hash
+        self._cache.move_to_end(username)
+        while len(self._cache) > ACCOUNT_CACHE_MAX:
+            self._cache.popitem(last=False)
+
+    def exists(self, username):
+        return self.get_password_hash(username) is not None
+
+    def create(self, username, password_hash):
+        """アカウントを追加する。既に同名があれば False。"""
+        with self._lock:
+            conn = self._connect()
+            try:
+                conn.execute(
+                    "INSERT INTO accounts (username, password_hash) VALUES (?, ?)",
+                    (username, password_hash),
+                )
+            except sqlite3.IntegrityError:
+                self._cache.pop(username, None)
+                return False
+            self._remember_locked(username, password_hash)
+            return True
+
+    def set_password_hash(self, username, password_hash):
+        """パスワードハッシュを置き換える（方式変更時の作り直し用）。アカウントが無ければ False。"""
+        with self._lock:
+            conn = self._connect()
+            updated = conn.execute(
+                "UPDATE accounts SET password_hash = ? WHERE username = ?",
+                (password_hash, username),
+            ).rowcount
+            if updated:
+                self._remember_locked(username, password_hash)
+            else:
+                self._cache.pop(username, None)
+            return bool(updated)
+
+    def _import_locked(self, accounts):
+        conn = self._conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO accounts (username, password_hash) VALUES (?, ?)",
+                accounts,
+            )
+            added = conn.total_changes - before
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._cache.clear()
+        return added
+
+    def import_accounts(self, accounts):
+        """(username, password_hash) の列を一括で取り込み、追加件数を返す（既存の名前は飛ばす）。"""
+        with self._lock:
+            self._connect()
+            return self._import_locked(list(accounts))
+
+    def reset_after_fork(self):
+        """fork 直後の子プロセス用。親の接続は閉じずに手放し、次の操作で開き直す。"""
+        self._conn = None
+        self._lock = threading.Lock()
+        self._cache.clear()
+        self._data_version = None
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+            self._cache.clear()
+            self._data_version = None
+
+
+def load_legacy_json(path):
+    """旧 accounts.json から (username, password_hash) の一覧を読む。"""
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if not isinstance(data, list):
+        return []
+    return [
+        (a["username"], a["password_hash"])
+        for a in data
+        if isinstance(a, dict) and a.get("username") and a.get("password_hash")
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="アカウントの保存先の管理")
+    sub = parser.add_subparsers(dest="command", required=True)
+    imp = sub.add_parser("import", help="accounts.json を accounts.db に取り込む")
+    imp.add_argument("path", nargs="?", default=os.path.join(BACKEND_DIR, "accounts.json"))
+    imp.add_argument("--db", default=os.path.join(BACKEND_DIR, "accounts.db"))
+    args = parser.parse_args(argv)
+
+    repo = AccountRepository(args.db)
+    try:
+        added = repo.import_accounts(load_legacy_json(args.path))
+    finally:
+        repo.close()
+    print(f"{args.path}: {added} accounts imported into {args.db}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
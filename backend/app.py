@@ -1,19 +1,50 @@
 import hashlib
-import json
 import os
 import re
-from flask import Flask, jsonify, request
+from datetime import datetime, timezone
+from flask import Flask, g, jsonify, request
 from flask_cors import CORS
 from flask_jwt_extended import (
     JWTManager,
     create_access_token,
     jwt_required,
+    get_jwt,
     get_jwt_identity,
     set_access_cookies,
     unset_jwt_cookies,
+    verify_jwt_in_request,
 )
-from sqlalchemy import create_engine, text
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask_jwt_extended.exceptions import JWTExtendedException
+from jwt.exceptions import PyJWTError
+from sqlalchemy import text
+
+from accounts_store import AccountRepository
+from canvas_history import history_stats, list_revisions, state_at
+from canvas_patch import PatchError
+from canvas_store import (
+    CanvasConflict,
+    current_rev,
+    ensure_canvas_tables,
+    load_state_text,
+    remember_state,
+    save_patch,
+    save_snapshot,
+    state_version,
+    write_snapshot,
+)
+from compression import COMPRESS_MIN_BYTES, choose_encoding, compress
+from contents_store import CONTENT_FIELDS, ContentStore, begin_write, storage_mode
+from db_swap import DatabaseBusy, swap_database_file
+from engine_registry import EngineRegistry, parse_pragmas
+from identity_cache import IdentityCache
+from maintenance import MaintenanceScheduler
+from metrics import Metrics, init_metrics, phase
+from password_hashing import HasherBusy, PasswordHasher
+from user_map import UserMap
+from search_cache import SearchCache
+from write_queue import WriteQueue
+from search_index import drop_search_index
+from transfer import TargetNotEmpty, TransferError, export_chunks, import_lines, open_import_stream
 
 app = Flask(__name__)
 app.config["JWT_SECRET_KEY"] = os.getenv("JWT_SECRET_KEY", "dev-secret-change-me")
@@ -21,6 +52,46 @@ app.config["JWT_TOKEN_LOCATION"] = ["cookies"]
 app.config["JWT_COOKIE_SECURE"] = False
 app.config["JWT_COOKIE_SAMESITE"] = "Lax"
 app.config["JWT_COOKIE_CSRF_PROTECT"] = False
+# アカウント毎DBのエンジンを同時に開いておく上限と、未使用で破棄するまでの秒数
+app.config["SUMAPURO_MAX_ENGINES"] = int(os.getenv("SUMAPURO_MAX_ENGINES", "64"))
+app.config["SUMAPURO_ENGINE_IDLE_SECONDS"] = int(os.getenv("SUMAPURO_ENGINE_IDLE_SECONDS", "600"))
+# /api/contents/batch 1回で扱える行数の上限
+app.config["SUMAPURO_MAX_BATCH_ROWS"] = int(os.getenv("SUMAPURO_MAX_BATCH_ROWS", "5000"))
+# 接続ごとの PRAGMA の上書き（例: "busy_timeout=10000,mmap_size=0"）
+app.config["SUMAPURO_SQLITE_PRAGMAS"] = os.getenv("SUMAPURO_SQLITE_PRAGMAS", "")
+# 検索結果キャッシュの件数（0 で無効）と、世代をDBに置いて複数ワーカーで共有するか
+app.config["SUMAPURO_SEARCH_CACHE_SIZE"] = int(os.getenv("SUMAPURO_SEARCH_CACHE_SIZE", "256"))
+app.config["SUMAPURO_SEARCH_CACHE_SHARED"] = os.getenv("SUMAPURO_SEARCH_CACHE_SHARED", "0") == "1"
+# JWT（jti）→ ユーザー情報のキャッシュの件数（0 で無効）と保持秒数
+app.config["SUMAPURO_IDENTITY_CACHE_SIZE"] = int(os.getenv("SUMAPURO_IDENTITY_CACHE_SIZE", "4096"))
+app.config["SUMAPURO_IDENTITY_CACHE_SECONDS"] = int(os.getenv("SUMAPURO_IDENTITY_CACHE_SECONDS", "300"))
+# パスワードハッシュの方式（werkzeug 形式）と、ハッシュ計算に使うスレッド数・待ちの上限
+app.config["SUMAPURO_PASSWORD_METHOD"] = os.getenv("SUMAPURO_PASSWORD_METHOD", "scrypt")
+app.config["SUMAPURO_PASSWORD_SALT_LENGTH"] = int(os.getenv("SUMAPURO_PASSWORD_SALT_LENGTH", "16"))
+app.config["SUMAPURO_HASH_WORKERS"] = int(os.getenv("SUMAPURO_HASH_WORKERS", "2"))
+app.config["SUMAPURO_HASH_QUEUE"] = int(os.getenv("SUMAPURO_HASH_QUEUE", "8"))
+# /api/db/reset の方式。swap: DBファイルを空のものと差し替える（他の接続があれば drop に切り替え）/ drop: テーブルを DROP
+app.config["SUMAPURO_RESET_MODE"] = os.getenv("SUMAPURO_RESET_MODE", "swap")
+# data/*.db の保守（チェックポイント・空き領域の回収・統計の更新）をバックグラウンドで行うか（間隔などは maintenance.py）
+app.config["SUMAPURO_MAINTENANCE"] = os.getenv("SUMAPURO_MAINTENANCE", "0") == "1"
+# 同じユーザーへの書き込み（中身の追加・削除・名前変更・キャンバス全体保存）を1トランザクションにまとめるか。
+# まとめる最大件数と、最初の要求が待つ時間（ミリ秒。応答がこの分遅れる）
+app.config["SUMAPURO_WRITE_QUEUE"] = os.getenv("SUMAPURO_WRITE_QUEUE", "0") == "1"
+app.config["SUMAPURO_WRITE_QUEUE_BATCH"] = int(os.getenv("SUMAPURO_WRITE_QUEUE_BATCH", "32"))
+app.config["SUMAPURO_WRITE_QUEUE_DELAY_MS"] = float(os.getenv("SUMAPURO_WRITE_QUEUE_DELAY_MS", "2"))
+# 計測（/metrics）を有効にするか。cProfile を取る割合（0〜1）と、残す件数・置き場所
+app.config["SUMAPURO_METRICS"] = os.getenv("SUMAPURO_METRICS", "0") == "1"
+# /metrics を読むための Bearer トークン（空なら同じマシンからだけ読める）
+app.config["SUMAPURO_METRICS_TOKEN"] = os.getenv("SUMAPURO_METRICS_TOKEN", "")
+app.config["SUMAPURO_PROFILE_SAMPLE"] = float(os.getenv("SUMAPURO_PROFILE_SAMPLE", "0"))
+app.config["SUMAPURO_PROFILE_KEEP"] = int(os.getenv("SUMAPURO_PROFILE_KEEP", "10"))
+app.config["SUMAPURO_PROFILE_DIR"] = os.getenv(
+    "SUMAPURO_PROFILE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles")
+)
+# プロセス全体の統計（/api/system/*）を見られるユーザー名（カンマ区切り）。空なら誰も見られない（/metrics を使う）
+app.config["SUMAPURO_OPERATORS"] = {
+    name.strip() for name in os.getenv("SUMAPURO_OPERATORS", "").split(",") if name.strip()
+}
 
 jwt = JWTManager(app)
 CORS(app, supports_credentials=True, origins=["http://localhost:5173"])
@@ -58,27 +129,62 @@ def expired_token_callback(jwt_header, jwt_payload):
     }), 401
 
 
-# アカウント管理: backend フォルダの JSON ファイル（サーバ落ちても永続）
+# アカウント管理: backend/accounts.db（旧 accounts.json は初回に自動取り込み。サーバ落ちても永続）
+# 置き場所は環境変数で差し替え可能（ベンチマークや検証用に別ディレクトリを使うとき）
 BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
-ACCOUNTS_JSON = os.path.join(BACKEND_DIR, "accounts.json")
-DATA_DIR = os.path.join(BACKEND_DIR, "data")
-_user_engines = {}
-
-
-def load_accounts():
-    if not os.path.exists(ACCOUNTS_JSON):
-        return []
-    try:
-        with open(ACCOUNTS_JSON, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        return data if isinstance(data, list) else []
-    except Exception:
-        return []
-
-
-def save_accounts(accounts):
-    with open(ACCOUNTS_JSON, "w", encoding="utf-8") as f:
-        json.dump(accounts, f, ensure_ascii=False, indent=2)
+ACCOUNTS_JSON = os.getenv("SUMAPURO_ACCOUNTS_JSON", os.path.join(BACKEND_DIR, "accounts.json"))
+ACCOUNTS_DB = os.getenv("SUMAPURO_ACCOUNTS_DB", os.path.join(BACKEND_DIR, "accounts.db"))
+DATA_DIR = os.getenv("SUMAPURO_DATA_DIR", os.path.join(BACKEND_DIR, "data"))
+# ユーザー名 → DB ファイル名（起動時に1回読み込み、新しい対応のときだけ書く）
+user_map = UserMap(os.path.join(DATA_DIR, "user_map.json"))
+accounts = AccountRepository(ACCOUNTS_DB, legacy_json_path=ACCOUNTS_JSON)
+_user_engines = EngineRegistry(
+    max_engines=app.config["SUMAPURO_MAX_ENGINES"],
+    idle_seconds=app.config["SUMAPURO_ENGINE_IDLE_SECONDS"],
+    pragmas=parse_pragmas(app.config["SUMAPURO_SQLITE_PRAGMAS"]),
+)
+search_cache = SearchCache(
+    max_entries=app.config["SUMAPURO_SEARCH_CACHE_SIZE"],
+    shared=app.config["SUMAPURO_SEARCH_CACHE_SHARED"],
+)
+identity_cache = IdentityCache(
+    max_entries=app.config["SUMAPURO_IDENTITY_CACHE_SIZE"],
+    ttl_seconds=app.config["SUMAPURO_IDENTITY_CACHE_SECONDS"],
+)
+password_hasher = PasswordHasher(
+    method=app.config["SUMAPURO_PASSWORD_METHOD"],
+    salt_length=app.config["SUMAPURO_PASSWORD_SALT_LENGTH"],
+    workers=app.config["SUMAPURO_HASH_WORKERS"],
+    queue_size=app.config["SUMAPURO_HASH_QUEUE"],
+)
+write_queue = WriteQueue(
+    enabled=app.config["SUMAPURO_WRITE_QUEUE"],
+    max_batch=app.config["SUMAPURO_WRITE_QUEUE_BATCH"],
+    max_delay_ms=app.config["SUMAPURO_WRITE_QUEUE_DELAY_MS"],
+    # 保存方式が未記録のDB（reset 直後など）で、記録の commit が SAVEPOINT の中で起きないよう先に決める
+    prepare=storage_mode,
+)
+maintenance = MaintenanceScheduler(DATA_DIR)
+# gunicorn ではワーカーの post_worker_init で始める（preload の親プロセスでスレッドを動かさないため）
+if app.config["SUMAPURO_MAINTENANCE"] and os.getenv("SUMAPURO_GUNICORN") != "1":
+    maintenance.start()
+if app.config["SUMAPURO_METRICS"]:
+    metrics = init_metrics(
+        app,
+        jwt,
+        Metrics(
+            profile_sample=app.config["SUMAPURO_PROFILE_SAMPLE"],
+            profile_dir=app.config["SUMAPURO_PROFILE_DIR"],
+            profile_keep=app.config["SUMAPURO_PROFILE_KEEP"],
+        ),
+        token=app.config["SUMAPURO_METRICS_TOKEN"],
+    )
+    metrics.add_source("engine_cache", _user_engines.stats)
+    metrics.add_source("search_cache", search_cache.stats)
+    metrics.add_source("identity_cache", identity_cache.stats)
+    metrics.add_source("password_hasher", password_hasher.stats)
+    metrics.add_source("maintenance", maintenance.stats)
+    metrics.add_source("write_queue", write_queue.stats)
 
 
 def username_to_db_key(username):
@@ -90,45 +196,46 @@ def username_to_db_key(username):
 
 
 def _ensure_user_meta_and_map(engine, username, key):
-    """DB内に meta テーブルでユーザー名を保存し、user_map.json にユーザー→ファイル名を追記。"""
+    """DB内に meta テーブルでユーザー名を保存し、user_map.json にユーザー→ファイル名を記録。
+    どちらも値が変わるときだけ書き込む。"""
     with engine.connect() as conn:
         conn.execute(
             text("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
         )
-        conn.execute(
-            text("INSERT OR REPLACE INTO meta (key, value) VALUES ('username', :u)"),
-            {"u": username},
-        )
-        conn.commit()
-    map_path = os.path.join(DATA_DIR, "user_map.json")
-    try:
-        m = {}
-        if os.path.exists(map_path):
-            with open(map_path, "r", encoding="utf-8") as f:
-                m = json.load(f)
-    except Exception:
-        m = {}
-    m[username] = f"{key}.db"
+        stored = conn.execute(
+            text("SELECT value FROM meta WHERE key = 'username'")
+        ).scalar()
+        if stored != username:
+            conn.execute(
+                text("INSERT OR REPLACE INTO meta (key, value) VALUES ('username', :u)"),
+                {"u": username},
+            )
+            conn.commit()
     try:
-        with open(map_path, "w", encoding="utf-8") as f:
-            json.dump(m, f, ensure_ascii=False, indent=2)
-    except Exception:
-        pass
+        user_map.record(username, f"{key}.db")
+    except OSError as e:
+        print("[user_map] write failed:", e)
 
 
 def get_engine_for_user(username):
     """アカウント毎のDBエンジン（data/{hash}.db）。サーバ落ちてもファイルは残る。"""
-    key = username_to_db_key(username)
-    if key not in _user_engines:
+    return _engine_for_key(username, username_to_db_key(username))
+
+
+def _engine_for_key(username, key):
+    def init_engine(engine):
         os.makedirs(DATA_DIR, exist_ok=True)
-        path = os.path.join(DATA_DIR, f"{key}.db")
-        uri = f"sqlite:///{path}"
-        _user_engines[key] = create_engine(
-            uri.replace("\\", "/"),
-            connect_args={"check_same_thread": False},
-        )
-        _ensure_user_meta_and_map(_user_engines[key], username, key)
-    return _user_engines[key]
+        _ensure_user_meta_and_map(engine, username, key)
+
+    with phase("engine"):
+        return _user_engines.get(key, os.path.join(DATA_DIR, f"{key}.db"), on_create=init_engine)
+
+
+def queued_write(username, engine, fn, invalidate_search=True):
+    """fn(conn) を write_queue 経由で実行し（有効なら同じユーザーの書き込みとまとめて commit）、戻り値を返す。
+    invalidate_search なら commit 後に検索キャッシュの世代を進める（バッチ内で1回）。"""
+    after_commit = (search_cache.invalidate, username) if invalidate_search else None
+    return write_queue.run(str(engine.url), engine, fn, after_commit=after_commit)
 
 
 def sanitize_table_name(name):
@@ -147,64 +254,62 @@ def sanitize_type_id(type_id):
     return s[:60] if s else "object"
 
 
-def escape_like(value):
-    """LIKE 句で % _ をリテラルとして検索するためにエスケープする（部分一致用）"""
-    if not value:
-        return value
-    return str(value).replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
-
-
-# 中身テーブルのカラム: id, object_name, name, category, count, nest_type, parent_table_name
-CONTENT_TABLE_COLS = (
-    "id INTEGER PRIMARY KEY AUTOINCREMENT, "
-    "object_name TEXT, "
-    "name TEXT, "
-    "category TEXT, "
-    "count INTEGER, "
-    "nest_type INTEGER, "
-    "parent_table_name TEXT"
-)
+def allocate_table_name(store, type_id):
+    """type_id に対し、未使用の連番を付けたテーブル名を生成してテーブルを作成する（commit は呼び出し側）。"""
+    prefix = sanitize_type_id(type_id)
+    if not prefix:
+        prefix = "object"
+    return store.allocate_object(prefix)
 
 
 def get_next_table_name(engine, type_id):
     """type_id に対し、未使用の連番を付けたテーブル名を生成し、テーブルを作成して返す。"""
-    prefix = sanitize_type_id(type_id)
-    if not prefix:
-        prefix = "object"
     with engine.connect() as conn:
-        tables = conn.execute(
-            text(
-                "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'"
-            )
-        ).fetchall()
-        existing = []
-        for (t,) in tables:
-            if t.startswith(prefix + "_"):
-                suffix = t[len(prefix) + 1 :]
-                if suffix.isdigit():
-                    existing.append(int(suffix))
-        next_num = max(existing, default=0) + 1
-        table_name = f"{prefix}_{next_num}"
-        table_name = sanitize_table_name(table_name)
-        conn.execute(
-            text(
-                f'CREATE TABLE IF NOT EXISTS "{table_name}" ({CONTENT_TABLE_COLS})'
-            )
-        )
+        table_name = allocate_table_name(ContentStore(conn), type_id)
         conn.commit()
     return table_name
 
 
+def content_row_from_body(body):
+    """リクエストの1行分（object_name, name, category, count, nest_type, parent_table_name）を正規化する。
+    count・nest_type が数値でなければ ValueError。"""
+    count = int(body.get("count", 0)) if body.get("count") is not None else 0
+    nest_type = int(body.get("nest_type", 0))
+    if nest_type not in (0, 1, 2):
+        nest_type = 0
+    parent_table_name = body.get("parent_table_name") or None
+    if parent_table_name is not None:
+        parent_table_name = sanitize_table_name(str(parent_table_name)) or None
+    return {
+        "object_name": body.get("object_name", ""),
+        "name": body.get("name", ""),
+        "category": body.get("category", ""),
+        "count": count,
+        "nest_type": nest_type,
+        "parent_table_name": parent_table_name,
+    }
+
+
 def get_current_user_engine():
-    """JWT から現在ユーザを取得し、そのアカウント用の DB エンジンを返す。未認証は 401。"""
-    identity = get_jwt_identity()
-    if not identity:
-        return None, None
-    # identity はログイン時に文字列（username）で保存している
-    username = identity if isinstance(identity, str) else (identity.get("username") if isinstance(identity, dict) else None)
-    if not username:
-        return None, None
-    return username, get_engine_for_user(username)
+    """JWT から現在ユーザを取得し、そのアカウント用の DB エンジンを返す。未認証は 401。
+    (username, DBキー) はリクエスト内では g に、リクエストをまたいでは jti 毎に identity_cache に持つ。
+    エンジンは毎回置き場から引く（破棄済みのエンジンを使わないため）。"""
+    user = g.get("_current_user")
+    if user is None:
+        jwt_data = get_jwt()
+        jti = jwt_data.get("jti")
+        user = identity_cache.get(jti)
+        if user is None:
+            identity = get_jwt_identity()
+            # identity はログイン時に文字列（username）で保存している
+            username = identity if isinstance(identity, str) else (identity.get("username") if isinstance(identity, dict) else None)
+            if not username:
+                return None, None
+            user = (username, username_to_db_key(username))
+            identity_cache.put(jti, user, jwt_data.get("exp"))
+        g._current_user = user
+    username, key = user
+    return username, _engine_for_key(username, key)
 
 
 @app.route("/api/data", methods=["GET"])
@@ -216,6 +321,42 @@ def get_data():
     return jsonify(data)
 
 
+def is_operator():
+    """現在ユーザーが SUMAPURO_OPERATORS に含まれるか（全アカウント分の統計を見てよいか）。"""
+    username, _ = get_current_user_engine()
+    return username is not None and username in app.config["SUMAPURO_OPERATORS"]
+
+
+@app.route("/api/system/engines", methods=["GET"])
+@jwt_required()
+def engine_stats():
+    """エンジン置き場の件数とヒット・ミス・破棄の回数を返す（運用者のみ）。"""
+    if not is_operator():
+        return jsonify({"error": "forbidden"}), 403
+    return jsonify(_user_engines.stats()), 200
+
+
+@app.route("/api/system/search-cache", methods=["GET"])
+@jwt_required()
+def search_cache_stats():
+    """検索結果キャッシュの件数とヒット率を返す（運用者のみ）。"""
+    if not is_operator():
+        return jsonify({"error": "forbidden"}), 403
+    return jsonify(search_cache.stats()), 200
+
+
+@app.route("/api/system/maintenance", methods=["GET"])
+@jwt_required()
+def maintenance_stats():
+    """このユーザーのDBの直近の保守結果（空きページの割合・実行した処理）を返す。
+    巡回回数などプロセス全体の値は運用者にだけ付ける。"""
+    username, _ = get_current_user_engine()
+    report = maintenance.reports().get(f"{username_to_db_key(username)}.db")
+    if not is_operator():
+        return jsonify({"database": report}), 200
+    return jsonify(dict(maintenance.stats(), database=report)), 200
+
+
 @app.route("/api/objects/next-table-name", methods=["POST"])
 @jwt_required()
 def create_next_table():
@@ -235,7 +376,7 @@ def create_next_table():
 @jwt_required()
 def add_content():
     """オブジェクト中身を1行追加（アカウント毎DB）。"""
-    _, engine = get_current_user_engine()
+    username, engine = get_current_user_engine()
     if not engine:
         return jsonify({"error": "unauthorized"}), 401
     body = request.get_json()
@@ -246,51 +387,100 @@ def add_content():
     if not table_name:
         return jsonify({"error": "table_name is invalid"}), 400
 
-    object_name = body.get("object_name", "")
-    row_name = body.get("name", "")
-    category = body.get("category", "")
-    count = int(body.get("count", 0)) if body.get("count") is not None else 0
-    nest_type = int(body.get("nest_type", 0))
-    if nest_type not in (0, 1, 2):
-        nest_type = 0
-    parent_table_name = body.get("parent_table_name") or None
-    if parent_table_name is not None:
-        parent_table_name = sanitize_table_name(str(parent_table_name)) or None
+    try:
+        row = content_row_from_body(body)
+    except (TypeError, ValueError):
+        return jsonify({"error": "count and nest_type must be integers"}), 400
+
+    def insert(conn):
+        store = ContentStore(conn)
+        if not store.object_exists(table_name):
+            return None
+        return store.insert_row(table_name, row)
+
+    row_id = queued_write(username, engine, insert)
+    if row_id is None:
+        return jsonify({"error": f"table {table_name} does not exist"}), 404
+    return jsonify({"id": row_id, "status": "created"}), 201
+
+
+@app.route("/api/contents/batch", methods=["POST"])
+@jwt_required()
+def batch_contents():
+    """テーブル発行・中身の複数行削除・複数行追加を1リクエスト・1トランザクションで行う（アカウント毎DB）。
+    body: {allocate?: {type_id}, table_name?, deletes?: [{table_name?, ids}], inserts?: [{table_name?, name, ...}]}
+    table_name を省略した行は allocate で発行したテーブル（無ければ body.table_name）が対象。"""
+    username, engine = get_current_user_engine()
+    if not engine:
+        return jsonify({"error": "unauthorized"}), 401
+    body = request.get_json()
+    if not isinstance(body, dict):
+        return jsonify({"error": "body must be an object"}), 400
+    allocate = body.get("allocate")
+    deletes = body.get("deletes") or []
+    inserts = body.get("inserts") or []
+    if allocate is not None and not (isinstance(allocate, dict) and "type_id" in allocate):
+        return jsonify({"error": "allocate.type_id is required"}), 400
+    if not isinstance(deletes, list) or not isinstance(inserts, list):
+        return jsonify({"error": "deletes and inserts must be arrays"}), 400
+    # 上限の判定は中身を検証する前に行うので、配列でない ids はここでは数えない（下で 400 にする）
+    n_rows = len(inserts) + sum(
+        len(d["ids"]) for d in deletes if isinstance(d, dict) and isinstance(d.get("ids"), list)
+    )
+    if n_rows > app.config["SUMAPURO_MAX_BATCH_ROWS"]:
+        return jsonify({"error": "too many rows in one batch"}), 413
+
+    default_table = sanitize_table_name(body["table_name"]) if body.get("table_name") else None
+    try:
+        delete_ops = []
+        for d in deletes:
+            ids = d.get("ids") if isinstance(d, dict) else None
+            if not isinstance(ids, list):
+                return jsonify({"error": "deletes[].ids must be an array"}), 400
+            delete_ops.append((d.get("table_name"), [int(i) for i in ids]))
+        insert_ops = [
+            (r.get("table_name"), content_row_from_body(r)) for r in inserts if isinstance(r, dict)
+        ]
+    except (TypeError, ValueError):
+        return jsonify({"error": "ids, count and nest_type must be integers"}), 400
+    if len(insert_ops) != len(inserts):
+        return jsonify({"error": "inserts[] must be objects"}), 400
 
     with engine.connect() as conn:
-        row = conn.execute(
-            text("SELECT name FROM sqlite_master WHERE type='table' AND name=:n"),
-            {"n": table_name},
-        ).first()
-        if not row:
-            return jsonify({"error": f"table {table_name} does not exist"}), 404
+        store = ContentStore(conn)
+        begin_write(conn)
+        allocated = allocate_table_name(store, allocate["type_id"]) if allocate else None
+        default_table = allocated or default_table
 
-        conn.execute(
-            text(
-                f'INSERT INTO "{table_name}" '
-                "(object_name, name, category, count, nest_type, parent_table_name) "
-                "VALUES (:object_name, :name, :category, :count, :nest_type, :parent_table_name)"
-            ),
-            {
-                "object_name": object_name,
-                "name": row_name,
-                "category": category,
-                "count": count,
-                "nest_type": nest_type,
-                "parent_table_name": parent_table_name,
-            },
-        )
+        def target(name):
+            return sanitize_table_name(name) if name else default_table
+
+        checked = set()
+        for name in [target(t) for t, _ in delete_ops] + [target(t) for t, _ in insert_ops]:
+            if name in checked:
+                continue
+            if not name or not store.object_exists(name):
+                conn.rollback()
+                return jsonify({"error": f"table {name} does not exist"}), 404
+            checked.add(name)
+
+        deleted = 0
+        for name, ids in delete_ops:
+            deleted += store.delete_rows(target(name), ids)
+        row_ids = [store.insert_row(target(name), row) for name, row in insert_ops]
         conn.commit()
-        row_id = conn.execute(text("SELECT last_insert_rowid()")).scalar()
+        search_cache.invalidate(username, conn)
 
-    return jsonify({"id": row_id, "status": "created"}), 201
+    return jsonify(
+        {"status": "ok", "table_name": allocated, "ids": row_ids, "deleted": deleted}
+    ), 201
 
 
 @app.route("/api/objects/rename", methods=["POST"])
 @jwt_required()
 def rename_object_in_table():
     """指定テーブル内の object_name を一括更新（アカウント毎DB）。"""
-    _, engine = get_current_user_engine()
+    username, engine = get_current_user_engine()
     if not engine:
         return jsonify({"error": "unauthorized"}), 401
     body = request.get_json()
@@ -302,19 +492,15 @@ def rename_object_in_table():
     if not table_name:
         return jsonify({"error": "table_name is invalid"}), 400
 
-    with engine.connect() as conn:
-        row = conn.execute(
-            text("SELECT name FROM sqlite_master WHERE type='table' AND name=:n"),
-            {"n": table_name},
-        ).first()
-        if not row:
-            return jsonify({"status": "ok"}), 200
+    def rename(conn):
+        store = ContentStore(conn)
+        if not store.object_exists(table_name):
+            return False
+        store.rename_object(table_name, new_name)
+        return True
 
-        conn.execute(
-            text(f'UPDATE "{table_name}" SET object_name = :new_name'),
-            {"new_name": new_name},
-        )
-        conn.commit()
+    if not queued_write(username, engine, rename):
+        return jsonify({"status": "ok"}), 200
     return jsonify({"status": "renamed"}), 200
 
 
@@ -324,63 +510,109 @@ def drop_object_table(table_name):
     """オブジェクト削除時にそのテーブルを削除（アカウント毎DB）。"""
     from urllib.parse import unquote
 
-    _, engine = get_current_user_engine()
+    username, engine = get_current_user_engine()
     if not engine:
         return jsonify({"error": "unauthorized"}), 401
     decoded = unquote(table_name)
     name = sanitize_table_name(decoded)
-    with engine.begin() as conn:
-        conn.execute(text(f'DROP TABLE IF EXISTS "{name}"'))
+    with engine.connect() as conn:
+        if not ContentStore(conn).drop_object(name):
+            conn.commit()
+            return jsonify({"error": f"table {name} does not exist"}), 404
+        conn.commit()
+        search_cache.invalidate(username, conn)
     return jsonify({"status": "deleted"}), 200
 
 
+def _int_list(values):
+    """整数の配列なら list を返す（bool は除く）。そうでなければ None。"""
+    if not isinstance(values, list):
+        return None
+    if not all(isinstance(v, int) and not isinstance(v, bool) for v in values):
+        return None
+    return values
+
+
 @app.route("/api/contents/delete", methods=["POST"])
 @jwt_required()
 def delete_contents():
-    """オブジェクト中身の指定行を削除（アカウント毎DB）。"""
-    _, engine = get_current_user_engine()
+    """オブジェクト中身の指定行を削除（アカウント毎DB）。
+    行は ids（add_content が返した行 id）で指定する。indices（表示順の位置）は旧クライアント向けの互換指定。"""
+    username, engine = get_current_user_engine()
+    if not engine:
+        return jsonify({"error": "unauthorized"}), 401
+    body = request.get_json()
+    if not body or "table_name" not in body or ("ids" not in body and "indices" not in body):
+        return jsonify({"error": "table_name and ids are required"}), 400
+
+    table_name = sanitize_table_name(body.get("table_name", ""))
+    if not table_name:
+        return jsonify({"error": "table_name is invalid"}), 400
+    by_id = "ids" in body
+    values = _int_list(body.get("ids") if by_id else body.get("indices"))
+    if values is None:
+        key = "ids" if by_id else "indices"
+        return jsonify({"error": f"{key} must be an array of integers"}), 400
+
+    def delete(conn):
+        store = ContentStore(conn)
+        if not store.object_exists(table_name):
+            return None
+        if by_id:
+            to_delete = values
+        else:
+            ids_list = store.row_ids(table_name)
+            to_delete = [ids_list[i] for i in values if 0 <= i < len(ids_list)]
+        return store.delete_rows(table_name, to_delete) if to_delete else 0
+
+    deleted = queued_write(username, engine, delete)
+    if deleted is None:
+        return jsonify({"status": "ok", "deleted": 0}), 200
+    return jsonify({"status": "deleted", "deleted": deleted}), 200
+
+
+@app.route("/api/contents/update", methods=["POST"])
+@jwt_required()
+def update_content():
+    """オブジェクト中身の1行（id 指定）の name / category / count を更新（アカウント毎DB）。"""
+    username, engine = get_current_user_engine()
     if not engine:
         return jsonify({"error": "unauthorized"}), 401
     body = request.get_json()
-    if not body or "table_name" not in body or "indices" not in body:
-        return jsonify({"error": "table_name and indices are required"}), 400
+    if not body or "table_name" not in body or "id" not in body:
+        return jsonify({"error": "table_name and id are required"}), 400
 
     table_name = sanitize_table_name(body.get("table_name", ""))
-    indices = body.get("indices", [])
     if not table_name:
         return jsonify({"error": "table_name is invalid"}), 400
-    if not isinstance(indices, list):
-        return jsonify({"error": "indices must be an array"}), 400
+    row_id = body.get("id")
+    if not isinstance(row_id, int) or isinstance(row_id, bool):
+        return jsonify({"error": "id must be an integer"}), 400
+    fields = {}
+    for key in ("name", "category"):
+        if key in body:
+            fields[key] = str(body.get(key) or "")
+    if "count" in body:
+        try:
+            fields["count"] = int(body.get("count") or 0)
+        except (TypeError, ValueError):
+            return jsonify({"error": "count must be an integer"}), 400
 
     with engine.connect() as conn:
-        row = conn.execute(
-            text("SELECT name FROM sqlite_master WHERE type='table' AND name=:n"),
-            {"n": table_name},
-        ).first()
-        if not row:
-            return jsonify({"status": "ok"}), 200
-
-        ids_result = conn.execute(
-            text(f'SELECT id FROM "{table_name}" ORDER BY id')
-        ).fetchall()
-        ids_list = [r[0] for r in ids_result]
-        to_delete = [ids_list[i] for i in indices if 0 <= i < len(ids_list)]
-        if to_delete:
-            placeholders = ", ".join(f":id{i}" for i in range(len(to_delete)))
-            params = {f"id{i}": v for i, v in enumerate(to_delete)}
-            conn.execute(
-                text(f'DELETE FROM "{table_name}" WHERE id IN ({placeholders})'),
-                params,
-            )
-            conn.commit()
-    return jsonify({"status": "deleted"}), 200
+        store = ContentStore(conn)
+        if not store.object_exists(table_name) or not store.update_row(table_name, row_id, fields):
+            conn.rollback()
+            return jsonify({"error": "row not found"}), 404
+        conn.commit()
+        search_cache.invalidate(username, conn)
+    return jsonify({"status": "updated", "id": row_id}), 200
 
 
 @app.route("/api/contents/search", methods=["POST"])
 @jwt_required()
 def search_contents():
     """名前・分類で中身を検索（アカウント毎DB）。"""
-    _, engine = get_current_user_engine()
+    username, engine = get_current_user_engine()
     if not engine:
         return jsonify({"error": "unauthorized"}), 401
     body = request.get_json() or {}
@@ -390,77 +622,224 @@ def search_contents():
         return jsonify({"matches": []}), 200
 
     with engine.connect() as conn:
-        tables = conn.execute(
-            text(
-                "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'"
-            )
-        ).fetchall()
-        results = []
-        for (table_name,) in tables:
-            # テーブル名は type_id_N 形式のみ（アンダースコア＋数字で終わる）
-            if "_" not in table_name or not table_name.split("_")[-1].isdigit():
-                continue
-            try:
-                # 部分一致: name, category を LIKE %...% で検索（% _ はエスケープ）
-                name_pattern = (
-                    "%" + escape_like(search_name) + "%" if search_name else "%"
-                )
-                category_pattern = (
-                    "%" + escape_like(search_category) + "%" if search_category else "%"
-                )
-                rows = conn.execute(
-                    text(
-                        f'SELECT DISTINCT parent_table_name FROM "{table_name}" '
-                        "WHERE name LIKE :name_pattern ESCAPE '\\' AND category LIKE :category_pattern ESCAPE '\\'"
-                    ),
-                    {"name_pattern": name_pattern, "category_pattern": category_pattern},
-                ).fetchall()
-                for (parent_table_name,) in rows:
-                    results.append(
-                        {
-                            "table_name": table_name,
-                            "parent_table_name": parent_table_name,
-                        }
-                    )
-            except Exception:
-                continue
+        # 世代は検索より先に読む（検索中に変更が入っても、古い世代のエントリになるだけ）
+        generation = search_cache.generation(username, conn)
+        matches = search_cache.get(username, generation, search_name, search_category)
+        if matches is None:
+            store = ContentStore(conn)
+            matches = store.search(search_name, search_category)
+            conn.commit()
+            search_cache.put(username, generation, search_name, search_category, matches)
+    results = [{"table_name": t, "parent_table_name": p} for t, p in matches]
     return jsonify({"matches": results}), 200
 
 
-def ensure_canvas_state_table(conn):
-    conn.execute(
-        text(
-            "CREATE TABLE IF NOT EXISTS canvas_state (id INTEGER PRIMARY KEY, state TEXT)"
-        )
-    )
-    conn.commit()
+@app.route("/api/summary/categories", methods=["GET"])
+@jwt_required()
+def summary_categories():
+    """分類毎の行数と count 合計（アカウント毎DB）。集計表を読むだけで中身は走査しない。"""
+    _, engine = get_current_user_engine()
+    if not engine:
+        return jsonify({"error": "unauthorized"}), 401
+    with engine.connect() as conn:
+        summary = ContentStore(conn).category_summary()
+        conn.commit()
+    categories = [
+        {"category": c, "rows": rows, "total_count": total} for c, rows, total in summary
+    ]
+    return jsonify({
+        "categories": categories,
+        "rows": sum(c["rows"] for c in categories),
+        "total_count": sum(c["total_count"] for c in categories),
+    }), 200
+
+
+@app.route("/api/summary/objects", methods=["GET"])
+@jwt_required()
+def summary_objects():
+    """オブジェクト毎の行数と count 合計（アカウント毎DB）。?table_name= でその1件のみ。"""
+    _, engine = get_current_user_engine()
+    if not engine:
+        return jsonify({"error": "unauthorized"}), 401
+    table_name = request.args.get("table_name")
+    if table_name is not None:
+        table_name = sanitize_table_name(table_name)
+    with engine.connect() as conn:
+        summary = ContentStore(conn).object_summary(table_name)
+        conn.commit()
+    objects = [
+        {"table_name": t, "object_name": o, "rows": rows, "total_count": total}
+        for t, o, rows, total in summary
+    ]
+    return jsonify({"objects": objects}), 200
+
+
+def _limit_arg(default=100, maximum=1000):
+    """?limit=（1〜maximum）を読む。整数でなければ ValueError。"""
+    return min(max(int(request.args.get("limit", default)), 1), maximum)
+
+
+@app.route("/api/objects/<path:table_name>/contents", methods=["GET"])
+@jwt_required()
+def list_contents(table_name):
+    """オブジェクトの中身を id 順に1ページ返す（アカウント毎DB）。
+    ?limit=（既定 100、最大 1000）&after=直前のページの next_after で続き。?category= で分類（完全一致）を絞り込み、
+    ?fields=name,category のように返す列を選べる（id は常に含む）。続きが無ければ next_after は null。"""
+    _, engine = get_current_user_engine()
+    if not engine:
+        return jsonify({"error": "unauthorized"}), 401
+    name = sanitize_table_name(table_name)
+    try:
+        limit = _limit_arg()
+        after = int(request.args["after"]) if "after" in request.args else None
+    except ValueError:
+        return jsonify({"error": "limit and after must be integers"}), 400
+    fields = CONTENT_FIELDS
+    if request.args.get("fields"):
+        fields = tuple(f.strip() for f in request.args["fields"].split(",") if f.strip())
+        unknown = [f for f in fields if f not in CONTENT_FIELDS and f != "id"]
+        if unknown:
+            return jsonify({"error": f"unknown fields: {', '.join(unknown)}"}), 400
+        fields = tuple(f for f in fields if f != "id")
+    with engine.connect() as conn:
+        store = ContentStore(conn)
+        if not store.object_exists(name):
+            conn.commit()
+            return jsonify({"error": f"table {name} does not exist"}), 404
+        # 続きがあるかを知るため1行多く読む
+        rows = store.list_rows(name, fields, after, limit + 1, request.args.get("category"))
+        conn.commit()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    return jsonify({
+        "table_name": name,
+        "rows": [dict(zip(("id",) + fields, r)) for r in rows],
+        "next_after": rows[-1][0] if more else None,
+    }), 200
+
+
+@app.route("/api/objects/<path:table_name>/children", methods=["GET"])
+@jwt_required()
+def list_children(table_name):
+    """オブジェクトの直下に入っているオブジェクトを table_name 順に1ページ返す（アカウント毎DB）。
+    ?limit=（既定 100、最大 1000）&after=直前のページの next_after で続き。"""
+    _, engine = get_current_user_engine()
+    if not engine:
+        return jsonify({"error": "unauthorized"}), 401
+    name = sanitize_table_name(table_name)
+    try:
+        limit = _limit_arg()
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    with engine.connect() as conn:
+        store = ContentStore(conn)
+        if not store.object_exists(name):
+            conn.commit()
+            return jsonify({"error": f"table {name} does not exist"}), 404
+        rows = store.children(name, request.args.get("after"), limit + 1)
+        conn.commit()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    return jsonify({
+        "table_name": name,
+        "children": [
+            {"table_name": t, "object_name": o, "rows": n, "total_count": total}
+            for t, o, n, total in rows
+        ],
+        "next_after": rows[-1][0] if more else None,
+    }), 200
+
+
+@app.route("/api/tree", methods=["GET"])
+@jwt_required()
+def object_tree():
+    """オブジェクトの入れ子の木（アカウント毎DB）。?root= でそのオブジェクト以下のみ。"""
+    _, engine = get_current_user_engine()
+    if not engine:
+        return jsonify({"error": "unauthorized"}), 401
+    root = request.args.get("root")
+    if root is not None:
+        root = sanitize_table_name(root)
+    with engine.connect() as conn:
+        rows = ContentStore(conn).subtree(root)
+        conn.commit()
+    if root is not None and not rows:
+        return jsonify({"error": f"table {root} does not exist"}), 404
+    # 深さ順に並んでいるので、親は必ず子より先に出てくる
+    nodes = {}
+    tree = []
+    for table_name, object_name, parent_table_name, depth in rows:
+        node = {"table_name": table_name, "object_name": object_name, "children": []}
+        nodes[table_name] = node
+        parent = nodes.get(parent_table_name) if depth > 0 else None
+        (parent["children"] if parent else tree).append(node)
+    return jsonify({"tree": tree}), 200
+
+
+@app.route("/api/tree/locate", methods=["GET"])
+@jwt_required()
+def locate_contents():
+    """名前・分類で中身を探し、見つかったオブジェクトと最上位までの祖先を返す（アカウント毎DB）。"""
+    _, engine = get_current_user_engine()
+    if not engine:
+        return jsonify({"error": "unauthorized"}), 401
+    search_name = (request.args.get("name") or "").strip()
+    search_category = (request.args.get("category") or "").strip()
+    if not search_name and not search_category:
+        return jsonify({"locations": []}), 200
+    with engine.connect() as conn:
+        store = ContentStore(conn)
+        matches = [t for t, _ in store.search(search_name, search_category)]
+        chains = store.ancestors(matches)
+        conn.commit()
+    locations = []
+    for table_name, chain in chains.items():
+        path = [{"table_name": t, "object_name": o} for t, o in reversed(chain)]
+        locations.append({
+            "table_name": table_name,
+            "object_name": path[-1]["object_name"] if path else None,
+            "path": path,
+        })
+    return jsonify({"locations": locations}), 200
 
 
 @app.route("/api/canvas/state", methods=["GET"])
 @jwt_required()
 def get_canvas_state():
-    """保存されたキャンバス状態を返す（アカウント毎DB）。リロード後も復元。"""
+    """保存されたキャンバス状態と rev を返す（アカウント毎DB）。リロード後も復元。
+    If-None-Match が現在の版と同じなら 304。保存済みの JSON は解析せずそのまま返し、大きければ圧縮する。"""
     _, engine = get_current_user_engine()
     if not engine:
         return jsonify({"error": "unauthorized"}), 401
     with engine.connect() as conn:
-        ensure_canvas_state_table(conn)
-        row = conn.execute(
-            text("SELECT state FROM canvas_state WHERE id = 1")
-        ).fetchone()
-    if not row or not row[0]:
-        return jsonify({"state": None}), 200
-    try:
-        state = json.loads(row[0])
-    except Exception:
-        return jsonify({"state": None}), 200
-    return jsonify({"state": state}), 200
+        version = state_version(conn)
+        # 初回に振った lineage を残す（残さないと次の GET で版が変わる）
+        conn.commit()
+        if request.if_none_match.contains_weak(version):
+            resp = app.response_class(status=304)
+            resp.set_etag(version, weak=True)
+            resp.headers["Cache-Control"] = "private, no-cache"
+            return resp
+        try:
+            state_text, rev, version = load_state_text(conn, str(engine.url))
+        except ValueError:
+            return jsonify({"state": None, "rev": 0}), 200
+    body = f'{{"rev": {rev}, "state": {state_text}}}'.encode("utf-8")
+    resp = app.response_class(body, mimetype="application/json")
+    resp.set_etag(version, weak=True)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    resp.vary.add("Accept-Encoding")
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding and len(body) >= COMPRESS_MIN_BYTES:
+        resp.set_data(compress(body, encoding, version, scope=str(engine.url)))
+        resp.headers["Content-Encoding"] = encoding
+    return resp
 
 
 @app.route("/api/canvas/state", methods=["POST"])
 @jwt_required()
 def save_canvas_state():
-    """キャンバス状態を保存する（アカウント毎DB）。UI操作でのみ変化。"""
+    """キャンバス状態を丸ごと保存する（アカウント毎DB）。差分保存が衝突したときの復帰にも使う。"""
     _, engine = get_current_user_engine()
     if not engine:
         return jsonify({"error": "unauthorized"}), 401
@@ -468,69 +847,240 @@ def save_canvas_state():
     state = data.get("state")
     if state is None:
         return jsonify({"error": "state required"}), 400
+    lineage, rev = queued_write(
+        None, engine, lambda conn: write_snapshot(conn, state), invalidate_search=False
+    )
+    remember_state(str(engine.url), lineage, rev, state)
+    return jsonify({"status": "saved", "rev": rev}), 200
+
+
+@app.route("/api/canvas/state/patch", methods=["POST"])
+@jwt_required()
+def patch_canvas_state():
+    """キャンバス状態に JSON Patch の ops を適用して保存する。base_rev が古ければ 409（全体保存で復帰）。"""
+    _, engine = get_current_user_engine()
+    if not engine:
+        return jsonify({"error": "unauthorized"}), 401
+    data = request.get_json() or {}
+    base_rev = data.get("base_rev")
+    ops = data.get("ops")
+    if not isinstance(base_rev, int) or not isinstance(ops, list):
+        return jsonify({"error": "base_rev and ops are required"}), 400
     with engine.connect() as conn:
-        ensure_canvas_state_table(conn)
-        conn.execute(
-            text("INSERT OR REPLACE INTO canvas_state (id, state) VALUES (1, :s)"),
-            {"s": json.dumps(state, ensure_ascii=False)},
-        )
+        try:
+            rev = save_patch(conn, str(engine.url), base_rev, ops)
+        except CanvasConflict as e:
+            return jsonify({"error": "conflict", "rev": e.rev}), 409
+        except PatchError as e:
+            return jsonify({"error": f"invalid patch: {e}"}), 422
+    return jsonify({"status": "patched", "rev": rev}), 200
+
+
+@app.route("/api/canvas/history", methods=["GET"])
+@jwt_required()
+def canvas_history():
+    """キャンバス状態の履歴を新しい順に返す（アカウント毎DB）。?limit=（既定 50、最大 500）&before=rev で続きを取得。"""
+    _, engine = get_current_user_engine()
+    if not engine:
+        return jsonify({"error": "unauthorized"}), 401
+    try:
+        limit = min(max(int(request.args.get("limit", 50)), 1), 500)
+        before = int(request.args["before"]) if "before" in request.args else None
+    except ValueError:
+        return jsonify({"error": "limit and before must be integers"}), 400
+    with engine.connect() as conn:
+        ensure_canvas_tables(conn)
+        revisions = list_revisions(conn, limit, before)
+        rev = current_rev(conn)
+        stats = history_stats(conn)
         conn.commit()
-    return jsonify({"status": "saved"}), 200
+    return jsonify({
+        "rev": rev,
+        "revisions": [
+            {
+                "rev": r,
+                "kind": kind,
+                "saved_at": datetime.fromtimestamp(saved_at, timezone.utc).isoformat(),
+                "bytes": size,
+            }
+            for r, kind, saved_at, size in revisions
+        ],
+        "stats": stats,
+    }), 200
+
+
+@app.route("/api/canvas/history/<int:rev>", methods=["GET"])
+@jwt_required()
+def canvas_history_state(rev):
+    """履歴にある rev のキャンバス状態を返す（復元前の確認用）。履歴に無ければ 404。"""
+    _, engine = get_current_user_engine()
+    if not engine:
+        return jsonify({"error": "unauthorized"}), 401
+    with engine.connect() as conn:
+        found, state = state_at(conn, rev)
+        conn.commit()
+    if not found:
+        return jsonify({"error": f"rev {rev} is not in history"}), 404
+    return jsonify({"rev": rev, "state": state}), 200
+
+
+@app.route("/api/canvas/history/restore", methods=["POST"])
+@jwt_required()
+def restore_canvas_history():
+    """履歴の rev の状態を新しい rev として全体保存する（復元自体も履歴に残るので取り消せる）。"""
+    _, engine = get_current_user_engine()
+    if not engine:
+        return jsonify({"error": "unauthorized"}), 401
+    data = request.get_json() or {}
+    rev = data.get("rev")
+    if not isinstance(rev, int) or isinstance(rev, bool):
+        return jsonify({"error": "rev must be an integer"}), 400
+    with engine.connect() as conn:
+        found, state = state_at(conn, rev)
+        if not found:
+            conn.rollback()
+            return jsonify({"error": f"rev {rev} is not in history"}), 404
+        new_rev = save_snapshot(conn, str(engine.url), state)
+    return jsonify({"status": "restored", "rev": new_rev, "restored_from": rev}), 200
+
+
+@app.route("/api/export", methods=["GET"])
+@jwt_required()
+def export_inventory():
+    """全オブジェクトの中身とキャンバス状態を NDJSON で書き出す（アカウント毎DB）。?format=gzip で圧縮。
+    本文は読みながら chunk で返すので、中身が多くてもメモリに溜めない。"""
+    username, engine = get_current_user_engine()
+    if not engine:
+        return jsonify({"error": "unauthorized"}), 401
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in ("ndjson", "gzip"):
+        return jsonify({"error": "format must be ndjson or gzip"}), 400
+    compress = fmt == "gzip"
+    filename = "sumapuro-{}.ndjson{}".format(
+        username_to_db_key(username)[:8], ".gz" if compress else ""
+    )
+    resp = app.response_class(
+        export_chunks(engine, compress=compress),
+        mimetype="application/gzip" if compress else "application/x-ndjson",
+    )
+    resp.headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
+
+@app.route("/api/import", methods=["POST"])
+@jwt_required()
+def import_inventory():
+    """/api/export の出力（NDJSON、gzip も可）を取り込む（アカウント毎DB）。本文は1行ずつ読む。
+    既にオブジェクトがあれば 409。?replace=1 なら中身とキャンバス状態を置き換える。"""
+    username, engine = get_current_user_engine()
+    if not engine:
+        return jsonify({"error": "unauthorized"}), 401
+    replace = request.args.get("replace") == "1"
+    with engine.connect() as conn:
+        try:
+            result = import_lines(conn, open_import_stream(request.stream), replace=replace)
+        except TargetNotEmpty:
+            return jsonify({"error": "account already has objects (use ?replace=1)"}), 409
+        except (TransferError, OSError, EOFError) as e:
+            return jsonify({"error": f"invalid import: {e}"}), 400
+        search_cache.invalidate(username, conn)
+    return jsonify(dict(result, status="imported")), 200
 
 
 @app.route("/api/db/reset", methods=["POST"])
 @jwt_required()
 def reset_db():
-    """そのアカウントのオブジェクト用テーブルとキャンバス状態をクリア（明示的初期化用）。"""
-    _, engine = get_current_user_engine()
+    """そのアカウントのオブジェクト用テーブルとキャンバス状態をクリア（明示的初期化用）。
+    既定ではDBファイルを空のものと差し替える（中身の量に関係なく一定時間で、領域もすぐ空く）。
+    他の接続がファイルを開いていて差し替えられないときはテーブルを DROP する。"""
+    username, engine = get_current_user_engine()
     if not engine:
         return jsonify({"error": "unauthorized"}), 401
+    key = username_to_db_key(username)
+    mode = "drop"
+    if app.config["SUMAPURO_RESET_MODE"] == "swap":
+        # このプロセスのエンジン（プール済みの接続）を先に閉じる
+        _user_engines.discard(key)
+
+        def init_meta(conn):
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+            conn.execute("INSERT INTO meta (key, value) VALUES ('username', ?)", (username,))
+
+        try:
+            swap_database_file(os.path.join(DATA_DIR, f"{key}.db"), init=init_meta)
+            mode = "swap"
+        except DatabaseBusy as e:
+            print("[reset] file swap skipped, dropping tables:", e)
+        engine = _engine_for_key(username, key)
     with engine.connect() as conn:
-        tables = conn.execute(
-            text(
-                "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'"
-            )
-        ).fetchall()
-        for (name,) in tables:
-            conn.execute(text(f'DROP TABLE IF EXISTS "{name}"'))
-        conn.commit()
-    return jsonify({"status": "reset"}), 200
+        if mode == "drop":
+            # FTS5 の付随テーブルを個別に DROP しないよう、先に検索インデックスを消す
+            drop_search_index(conn)
+            tables = conn.execute(
+                text(
+                    "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'"
+                )
+            ).fetchall()
+            for (name,) in tables:
+                conn.execute(text(f'DROP TABLE IF EXISTS "{name}"'))
+            conn.commit()
+        search_cache.invalidate(username, conn)
+    return jsonify({"status": "reset", "mode": mode}), 200
+
+
+def _busy_response():
+    """ハッシュ計算が混んでいるときの 503（少し待って再試行してもらう）"""
+    resp = jsonify({"message": "混み合っています。しばらくしてからもう一度お試しください"})
+    resp.headers["Retry-After"] = "1"
+    return resp, 503
 
 
 @app.route("/api/auth/register", methods=["POST"])
 def register():
-    """新規登録。アカウント名は完全一致で重複不可。backend/accounts.json に保存。"""
+    """新規登録。アカウント名は完全一致で重複不可。backend/accounts.db に保存。"""
     data = request.get_json() or {}
     username = (data.get("username") or "").strip()
     password = data.get("password") or ""
     if not username:
         return jsonify({"message": "アカウント名を入力してください"}), 400
-    accounts = load_accounts()
-    for a in accounts:
-        if a.get("username") == username:
-            return jsonify({"message": "このアカウント名は既に使われています"}), 409
-    pwhash = generate_password_hash(password)
-    accounts.append({"username": username, "password_hash": pwhash})
-    save_accounts(accounts)
+    if accounts.exists(username):
+        return jsonify({"message": "このアカウント名は既に使われています"}), 409
+    try:
+        pwhash = password_hasher.hash(password)
+    except HasherBusy:
+        return _busy_response()
+    # 同時登録は UNIQUE 制約で弾かれる
+    if not accounts.create(username, pwhash):
+        return jsonify({"message": "このアカウント名は既に使われています"}), 409
     return jsonify({"ok": True}), 201
 
 
 @app.route("/api/auth/login", methods=["POST"])
 def auth_login():
-    """ログイン。accounts.json で完全一致のアカウント名を検索。"""
+    """ログイン。accounts.db で完全一致のアカウント名を検索。"""
     data = request.get_json() or {}
     username = (data.get("username") or "").strip()
     password = data.get("password") or ""
-    accounts = load_accounts()
-    for a in accounts:
-        if a.get("username") == username:
-            if check_password_hash(a.get("password_hash", ""), password):
-                # identity は文字列必須（dict だと "Subject must be a string" で 401 になる）
-                access_token = create_access_token(identity=username)
-                resp = jsonify({"ok": True, "user": {"id": username, "username": username}})
-                set_access_cookies(resp, access_token)
-                return resp, 200
-            break
+    pwhash = accounts.get_password_hash(username)
+    try:
+        ok = pwhash is not None and password_hasher.verify(pwhash, password)
+    except HasherBusy:
+        return _busy_response()
+    if ok:
+        if password_hasher.needs_rehash(pwhash):
+            # 方式・コストの設定が変わっていれば今の設定で作り直す（混んでいれば次回に回す）
+            try:
+                accounts.set_password_hash(username, password_hasher.hash(password))
+                password_hasher.count_rehash()
+            except HasherBusy:
+                pass
+        # identity は文字列必須（dict だと "Subject must be a string" で 401 になる）
+        access_token = create_access_token(identity=username)
+        resp = jsonify({"ok": True, "user": {"id": username, "username": username}})
+        set_access_cookies(resp, access_token)
+        return resp, 200
     return jsonify({"message": "IDまたはパスワードが違います"}), 401
 
 
@@ -545,10 +1095,17 @@ def auth_me():
 
 @app.route("/api/auth/logout", methods=["POST"])
 def auth_logout():
+    # このトークンの解決結果をキャッシュから消す（期限切れ・不正なトークンなら何もしない）
+    try:
+        verify_jwt_in_request(optional=True)
+        identity_cache.invalidate(get_jwt().get("jti"))
+    except (JWTExtendedException, PyJWTError):
+        pass
     resp = jsonify({"ok": True})
     unset_jwt_cookies(resp)
     return resp, 200
 
 
 if __name__ == "__main__":
+    # 開発用。本番は serve.py（gunicorn / waitress）で起動する
     app.run(debug=True, port=5000)
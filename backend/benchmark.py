@@ -0,0 +1,354 @@
+"""
+API のベンチマーク（負荷生成）。合成データのアカウント毎DBを作り、複数ワーカーで
+登録・ログイン・検索・追加・削除・キャンバス保存を流して、エンドポイント毎の
+p50 / p95 / p99 と処理件数/秒を表示する。
+
+  python benchmark.py                              # Flask test client（プロセス内）
+  python benchmark.py --serve                      # ローカルの WSGI サーバを立てて HTTP 経由
+  python benchmark.py --url http://127.0.0.1:5000  # 起動済みのサーバに対して（データは実DBに入る）
+  python benchmark.py --users 20 --objects 50 --rows 40 --depth 3 --workers 8 --iterations 200
+  python benchmark.py --json result.json           # 結果を保存
+  python benchmark.py --baseline result.json       # 保存した結果より p95 が悪化していたら終了コード 1
+
+--url 以外では一時ディレクトリにDBを作り、終了時に消す（--keep で残す）。
+"""
+import argparse
+import http.cookiejar
+import json
+import logging
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+
+WORDS = [
+    "apple", "battery", "cable", "drill", "eraser", "flashlight", "glue", "hammer",
+    "ink", "jacket", "knife", "lamp", "marker", "notebook", "oil", "pliers",
+    "ruler", "scissors", "tape", "umbrella", "vase", "wrench", "yarn", "zipper",
+]
+CATEGORIES = ["tools", "stationery", "kitchen", "clothes", "electronics", "misc"]
+
+
+class TestClientSession:
+    """Flask test client を使う1ワーカー分のセッション（Cookie はクライアントが保持）"""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body=None):
+        res = self.client.open(path, method=method, json=body)
+        return res.status_code, res.get_json(silent=True)
+
+
+class HttpSession:
+    """HTTP 経由の1ワーカー分のセッション"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar())
+        )
+
+    def request(self, method, path, body=None):
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        req = urllib.request.Request(self.base_url + path, data=data, method=method)
+        if data is not None:
+            req.add_header("Content-Type", "application/json")
+        try:
+            with self.opener.open(req, timeout=60) as res:
+                status, raw = res.status, res.read()
+        except urllib.error.HTTPError as e:
+            status, raw = e.code, e.read()
+        try:
+            return status, json.loads(raw) if raw else None
+        except ValueError:
+            return status, None
+
+
+class Recorder:
+    """エンドポイント毎の所要時間（秒）とエラー件数を集める"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def call(self, session, label, method, path, body=None, ok=(200, 201)):
+        start = time.perf_counter()
+        status, data = session.request(method, path, body)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.samples[label].append(elapsed)
+            if status not in ok:
+                self.errors[label] += 1
+        return status, data
+
+
+def percentile(sorted_values, p):
+    """最近順位法のパーセンタイル"""
+    if not sorted_values:
+        return 0.0
+    k = math.ceil(p / 100 * len(sorted_values)) - 1
+    return sorted_values[max(0, min(len(sorted_values) - 1, k))]
+
+
+def summarize(recorder, wall_seconds):
+    result = {}
+    for label, values in sorted(recorder.samples.items()):
+        values = sorted(values)
+        result[label] = {
+            "count": len(values),
+            "errors": recorder.errors.get(label, 0),
+            "p50_ms": round(percentile(values, 50) * 1000, 2),
+            "p95_ms": round(percentile(values, 95) * 1000, 2),
+            "p99_ms": round(percentile(values, 99) * 1000, 2),
+            "max_ms": round(values[-1] * 1000, 2),
+            "per_sec": round(len(values) / wall_seconds, 1) if wall_seconds else 0.0,
+        }
+    return result
+
+
+def print_report(title, summary, wall_seconds):
+    print(f"\n== {title} ({wall_seconds:.2f}s) ==")
+    print(
+        f"{'endpoint':<16}{'count':>8}{'errors':>8}{'p50ms':>10}{'p95ms':>10}"
+        f"{'p99ms':>10}{'maxms':>10}{'req/s':>10}"
+    )
+    for label, s in summary.items():
+        print(
+            f"{label:<16}{s['count']:>8}{s['errors']:>8}{s['p50_ms']:>10}{s['p95_ms']:>10}"
+            f"{s['p99_ms']:>10}{s['max_ms']:>10}{s['per_sec']:>10}"
+        )
+    total = sum(s["count"] for s in summary.values())
+    if wall_seconds:
+        print(f"{'total':<16}{total:>8}{'':>48}{total / wall_seconds:>10.1f}")
+
+
+def run_parallel(workers, target):
+    """target(worker_index) を workers 本のスレッドで実行し、経過秒を返す"""
+    threads = [threading.Thread(target=target, args=(i,)) for i in range(workers)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start
+
+
+def item_name(rng):
+    return f"{rng.choice(WORDS)}{rng.randint(1, 999)}"
+
+
+def canvas_state(tables, rows_per_object, rng):
+    """フロントの items に近い形の合成キャンバス状態"""
+    items = []
+    for i, table_name in enumerate(tables):
+        items.append({
+            "id": f"item-{i}",
+            "x": rng.randint(0, 2000),
+            "y": rng.randint(0, 2000),
+            "width": 120,
+            "height": 80,
+            "name": f"object{i}",
+            "tableName": table_name,
+            "contents": [
+                {"name": item_name(rng), "category": rng.choice(CATEGORIES)}
+                for _ in range(rows_per_object)
+            ],
+            "nestedItems": [],
+        })
+    return items
+
+
+def seed(make_session, args, recorder):
+    """ユーザー登録と、オブジェクト・中身行（depth 段の入れ子）の投入"""
+    users = [f"bench{i}" for i in range(args.users)]
+    seeded = {}
+    lock = threading.Lock()
+
+    def seed_worker(index):
+        rng = random.Random(args.seed + index)
+        session = make_session()
+        for username in users[index :: args.workers]:
+            recorder.call(session, "register", "POST", "/api/auth/register",
+                          {"username": username, "password": "bench"}, ok=(201, 409))
+            recorder.call(session, "login", "POST", "/api/auth/login",
+                          {"username": username, "password": "bench"})
+            tables = []
+            for i in range(args.objects):
+                # depth 個ずつの鎖にして入れ子を作る（鎖の先頭は最上位）
+                parent = tables[-1] if args.depth > 1 and i % args.depth else None
+                inserts = [
+                    {
+                        "object_name": f"object{i}",
+                        "name": item_name(rng),
+                        "category": rng.choice(CATEGORIES),
+                        "count": rng.randint(0, 20),
+                        "nest_type": 2 if parent else 0,
+                        "parent_table_name": parent,
+                    }
+                    for _ in range(args.rows)
+                ]
+                _, data = recorder.call(session, "seed_batch", "POST", "/api/contents/batch",
+                                        {"allocate": {"type_id": "bench"}, "inserts": inserts})
+                tables.append((data or {}).get("table_name"))
+            with lock:
+                seeded[username] = [t for t in tables if t]
+
+    wall = run_parallel(min(args.workers, max(1, args.users)), seed_worker)
+    return seeded, wall
+
+
+def drive(make_session, args, seeded, recorder):
+    """各ワーカーが1ユーザーでログインし、検索・追加・削除・キャンバス保存を繰り返す"""
+    users = sorted(seeded)
+
+    def worker(index):
+        rng = random.Random(args.seed * 7919 + index)
+        username = users[index % len(users)]
+        tables = seeded[username]
+        session = make_session()
+        recorder.call(session, "login", "POST", "/api/auth/login",
+                      {"username": username, "password": "bench"})
+        state = canvas_state(tables[: args.canvas_items], args.rows, rng)
+        rev = None
+        for i in range(args.iterations):
+            op = i % 5
+            if op == 0:
+                recorder.call(session, "search", "POST", "/api/contents/search",
+                              {"name": rng.choice(WORDS)[: rng.randint(2, 5)]})
+            elif op == 1 and tables:
+                table_name = rng.choice(tables)
+                _, data = recorder.call(session, "add_content", "POST", "/api/contents",
+                                        {"table_name": table_name, "object_name": "bench",
+                                         "name": item_name(rng), "category": rng.choice(CATEGORIES)})
+                row_id = (data or {}).get("id")
+                if row_id is not None:
+                    recorder.call(session, "delete_contents", "POST", "/api/contents/delete",
+                                  {"table_name": table_name, "ids": [row_id]})
+            elif op == 2:
+                _, data = recorder.call(session, "canvas_save", "POST", "/api/canvas/state",
+                                        {"state": state})
+                rev = (data or {}).get("rev")
+            elif op == 3 and rev is not None and state:
+                x = rng.randint(0, 2000)
+                status, data = recorder.call(
+                    session, "canvas_patch", "POST", "/api/canvas/state/patch",
+                    {"base_rev": rev, "ops": [{"op": "replace", "path": "/0/x", "value": x}]},
+                    ok=(200, 409),
+                )
+                if status == 200:
+                    rev = data.get("rev")
+                    state[0]["x"] = x
+                else:
+                    # 同じユーザーを別ワーカーが更新した。次の全体保存で揃える
+                    rev = None
+            else:
+                recorder.call(session, "canvas_load", "GET", "/api/canvas/state", ok=(200, 304))
+
+    return run_parallel(args.workers, worker)
+
+
+def check_baseline(summary, baseline_path, tolerance):
+    """baseline より p95 が tolerance（割合）を超えて悪化したエンドポイントを返す"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f).get("run", {})
+    regressions = []
+    for label, s in summary.items():
+        base = baseline.get(label)
+        if base and base["p95_ms"] > 0 and s["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append((label, base["p95_ms"], s["p95_ms"]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="API のベンチマーク")
+    parser.add_argument("--users", type=int, default=4)
+    parser.add_argument("--objects", type=int, default=20, help="ユーザー毎のオブジェクト数")
+    parser.add_argument("--rows", type=int, default=20, help="オブジェクト毎の中身行数")
+    parser.add_argument("--depth", type=int, default=3, help="入れ子の深さ（1 で入れ子なし）")
+    parser.add_argument("--canvas-items", type=int, default=50, help="キャンバス状態に載せるオブジェクト数")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--iterations", type=int, default=100, help="ワーカー毎の操作回数")
+    parser.add_argument("--seed", type=int, default=1)
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--serve", action="store_true", help="ローカルの WSGI サーバを立てて HTTP 経由で測る")
+    target.add_argument("--url", help="起動済みサーバの URL")
+    parser.add_argument("--data-dir", help="DB を置くディレクトリ（既定は一時ディレクトリ）")
+    parser.add_argument("--keep", action="store_true", help="一時ディレクトリを消さない")
+    parser.add_argument("--json", dest="json_path", help="結果を JSON で保存する")
+    parser.add_argument("--baseline", help="比較する以前の結果（--json で保存したもの）")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="許容する p95 の悪化（割合）")
+    args = parser.parse_args(argv)
+
+    work_dir = None
+    server = None
+    if args.url:
+        make_session = lambda: HttpSession(args.url)  # noqa: E731
+    else:
+        # app の import 前に置き場所を差し替える
+        work_dir = args.data_dir or tempfile.mkdtemp(prefix="sumapuro-bench-")
+        os.environ["SUMAPURO_DATA_DIR"] = os.path.join(work_dir, "data")
+        os.environ["SUMAPURO_ACCOUNTS_DB"] = os.path.join(work_dir, "accounts.db")
+        os.environ["SUMAPURO_ACCOUNTS_JSON"] = os.path.join(work_dir, "accounts.json")
+        from app import app
+
+        if args.serve:
+            from werkzeug.serving import make_server
+
+            # リクエスト毎のアクセスログは測定の邪魔なので出さない
+            logging.getLogger("werkzeug").setLevel(logging.ERROR)
+            server = make_server("127.0.0.1", 0, app, threaded=True)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            url = f"http://127.0.0.1:{server.server_port}"
+            make_session = lambda: HttpSession(url)  # noqa: E731
+        else:
+            make_session = lambda: TestClientSession(app)  # noqa: E731
+
+    try:
+        seed_recorder = Recorder()
+        seeded, seed_wall = seed(make_session, args, seed_recorder)
+        seed_summary = summarize(seed_recorder, seed_wall)
+        print_report(
+            f"seed: {args.users} users x {args.objects} objects x {args.rows} rows, depth {args.depth}",
+            seed_summary,
+            seed_wall,
+        )
+        if not seeded:
+            print("no users were seeded", file=sys.stderr)
+            return 1
+
+        run_recorder = Recorder()
+        run_wall = drive(make_session, args, seeded, run_recorder)
+        run_summary = summarize(run_recorder, run_wall)
+        print_report(f"run: {args.workers} workers x {args.iterations} iterations", run_summary, run_wall)
+    finally:
+        if server is not None:
+            server.shutdown()
+        if work_dir and not args.data_dir and not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"args": vars(args), "seed": seed_summary, "run": run_summary},
+                f, ensure_ascii=False, indent=2,
+            )
+    if args.baseline:
+        regressions = check_baseline(run_summary, args.baseline, args.tolerance)
+        for label, before, after in regressions:
+            print(f"REGRESSION {label}: p95 {before}ms -> {after}ms", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,157 @@
+"""
+キャンバス状態の履歴（アカウント毎DB）。保存のたびに canvas_history に1行追加する。
+  full: その rev の状態全体（zlib 圧縮した JSON）
+  diff: 直前の rev からの差分（クライアントが送った JSON Patch の ops を zlib 圧縮）
+全体は SUMAPURO_CANVAS_HISTORY_FULL_EVERY 件毎と、全体保存・取り込みなど差分が無いときだけ持つので、
+毎回全体を持つより大幅に小さい。ある rev の状態は、それ以前で最新の full に diff を順に適用して作る。
+
+直近 SUMAPURO_CANVAS_HISTORY_KEEP 件（かつ SUMAPURO_CANVAS_HISTORY_DAYS 日以内。0 なら日数で消さない）を
+残し、それより古いものは full の境目で消す（境目までの数件は余分に残る）。
+書き込みは canvas_store の保存と同じトランザクションで行う。
+"""
+import json
+import os
+import time
+import zlib
+
+from sqlalchemy import text
+
+from canvas_patch import apply_patch
+
+CANVAS_HISTORY_TABLE = "canvas_history"
+HISTORY_FULL_EVERY = int(os.getenv("SUMAPURO_CANVAS_HISTORY_FULL_EVERY", "20"))
+HISTORY_KEEP = int(os.getenv("SUMAPURO_CANVAS_HISTORY_KEEP", "200"))
+HISTORY_DAYS = int(os.getenv("SUMAPURO_CANVAS_HISTORY_DAYS", "90"))
+
+
+def ensure_history_table(conn):
+    conn.execute(
+        text(
+            f"CREATE TABLE IF NOT EXISTS {CANVAS_HISTORY_TABLE} ("
+            "rev INTEGER PRIMARY KEY, "
+            "kind TEXT NOT NULL, "
+            "data BLOB NOT NULL, "
+            "saved_at INTEGER NOT NULL)"
+        )
+    )
+
+
+def _pack(value):
+    return zlib.compress(json.dumps(value, ensure_ascii=False).encode("utf-8"), 6)
+
+
+def _unpack(data):
+    return json.loads(zlib.decompress(data))
+
+
+def record(conn, rev, state, ops=None):
+    """rev の保存を履歴に加える。ops（直前の rev からの差分）があり、直前の rev が履歴にあって
+    最後の full から HISTORY_FULL_EVERY 件未満なら diff、それ以外は full で持つ。"""
+    kind, data = "full", None
+    if ops is not None and HISTORY_FULL_EVERY > 1:
+        last_full = conn.execute(
+            text(f"SELECT MAX(rev) FROM {CANVAS_HISTORY_TABLE} WHERE kind = 'full'")
+        ).scalar()
+        previous = conn.execute(
+            text(f"SELECT 1 FROM {CANVAS_HISTORY_TABLE} WHERE rev = :r"), {"r": rev - 1}
+        ).first()
+        if last_full is not None and previous is not None and rev - last_full < HISTORY_FULL_EVERY:
+            kind, data = "diff", _pack(ops)
+    if data is None:
+        data = _pack(state)
+    conn.execute(
+        text(
+            f"INSERT OR REPLACE INTO {CANVAS_HISTORY_TABLE} (rev, kind, data, saved_at) "
+            "VALUES (:r, :k, :d, :t)"
+        ),
+        {"r": rev, "k": kind, "d": data, "t": int(time.time())},
+    )
+    if kind == "full":
+        # 消せるのは full の境目より前だけなので、full を書いたときに古いものを整理する
+        prune(conn)
+
+
+def prune(conn, keep=None, days=None):
+    """保持期間を過ぎた履歴を消し、消した件数を返す。"""
+    keep = HISTORY_KEEP if keep is None else keep
+    days = HISTORY_DAYS if days is None else days
+    newest = conn.execute(text(f"SELECT MAX(rev) FROM {CANVAS_HISTORY_TABLE}")).scalar()
+    if newest is None:
+        return 0
+    cutoff = newest - max(keep, 1) + 1
+    if days > 0:
+        recent = conn.execute(
+            text(f"SELECT MIN(rev) FROM {CANVAS_HISTORY_TABLE} WHERE saved_at >= :t"),
+            {"t": int(time.time()) - days * 86400},
+        ).scalar()
+        cutoff = max(cutoff, recent if recent is not None else newest)
+    # cutoff 以降を復元できるよう、cutoff 以前で最新の full は残す
+    base = conn.execute(
+        text(f"SELECT MAX(rev) FROM {CANVAS_HISTORY_TABLE} WHERE kind = 'full' AND rev <= :r"),
+        {"r": cutoff},
+    ).scalar()
+    if base is None:
+        return 0
+    return conn.execute(
+        text(f"DELETE FROM {CANVAS_HISTORY_TABLE} WHERE rev < :r"), {"r": base}
+    ).rowcount
+
+
+def list_revisions(conn, limit=50, before=None):
+    """新しい順に (rev, kind, saved_at, 圧縮後のバイト数) を返す。before 指定時はそれより前の rev のみ。"""
+    ensure_history_table(conn)
+    params = {"n": limit}
+    where = ""
+    if before is not None:
+        where = "WHERE rev < :b"
+        params["b"] = before
+    rows = conn.execute(
+        text(
+            f"SELECT rev, kind, saved_at, LENGTH(data) FROM {CANVAS_HISTORY_TABLE} {where} "
+            "ORDER BY rev DESC LIMIT :n"
+        ),
+        params,
+    ).fetchall()
+    return [tuple(r) for r in rows]
+
+
+def state_at(conn, rev):
+    """履歴にある rev の状態を返す。履歴に無ければ (False, None)、あれば (True, state)。"""
+    ensure_history_table(conn)
+    if conn.execute(
+        text(f"SELECT 1 FROM {CANVAS_HISTORY_TABLE} WHERE rev = :r"), {"r": rev}
+    ).first() is None:
+        return False, None
+    base = conn.execute(
+        text(
+            f"SELECT rev, data FROM {CANVAS_HISTORY_TABLE} WHERE kind = 'full' AND rev <= :r "
+            "ORDER BY rev DESC LIMIT 1"
+        ),
+        {"r": rev},
+    ).fetchone()
+    if base is None:
+        return False, None
+    state = _unpack(base[1])
+    diffs = conn.execute(
+        text(
+            f"SELECT data FROM {CANVAS_HISTORY_TABLE} WHERE kind = 'diff' AND rev > :b AND rev <= :r "
+            "ORDER BY rev"
+        ),
+        {"b": base[0], "r": rev},
+    )
+    for (data,) in diffs:
+        state = apply_patch(state, _unpack(data))
+    return True, state
+
+
+def history_stats(conn):
+    """件数と、full / diff 別の圧縮後バイト数"""
+    ensure_history_table(conn)
+    stats = {"entries": 0, "full": 0, "diff": 0, "full_bytes": 0, "diff_bytes": 0}
+    for kind, n, size in conn.execute(
+        text(f"SELECT kind, COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM {CANVAS_HISTORY_TABLE} GROUP BY kind")
+    ):
+        stats[kind] = n
+        stats[f"{kind}_bytes"] = size
+        stats["entries"] += n
+    return stats
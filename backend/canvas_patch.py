@@ -0,0 +1,111 @@
+"""
+JSON Patch（RFC 6902）の最小実装。キャンバス状態の差分保存で使う。
+対応 op: add, remove, replace, move, copy, test
+"""
+import copy
+
+
+class PatchError(ValueError):
+    """パッチが不正、または適用できない"""
+
+
+def _parse_pointer(path):
+    if path == "":
+        return []
+    if not isinstance(path, str) or not path.startswith("/"):
+        raise PatchError(f"invalid path: {path!r}")
+    return [p.replace("~1", "/").replace("~0", "~") for p in path[1:].split("/")]
+
+
+def _array_index(container, token, allow_end=False):
+    if allow_end and token == "-":
+        return len(container)
+    if not token.isdigit() or (len(token) > 1 and token.startswith("0")):
+        raise PatchError(f"invalid array index: {token!r}")
+    index = int(token)
+    limit = len(container) + (1 if allow_end else 0)
+    if index >= limit:
+        raise PatchError(f"array index out of range: {index}")
+    return index
+
+
+def _resolve(doc, tokens):
+    node = doc
+    for token in tokens:
+        if isinstance(node, list):
+            node = node[_array_index(node, token)]
+        elif isinstance(node, dict):
+            if token not in node:
+                raise PatchError(f"path not found: {token!r}")
+            node = node[token]
+        else:
+            raise PatchError(f"cannot traverse into {type(node).__name__}")
+    return node
+
+
+def _add(doc, tokens, value):
+    if not tokens:
+        return value
+    parent = _resolve(doc, tokens[:-1])
+    key = tokens[-1]
+    if isinstance(parent, list):
+        parent.insert(_array_index(parent, key, allow_end=True), value)
+    elif isinstance(parent, dict):
+        parent[key] = value
+    else:
+        raise PatchError(f"cannot add into {type(parent).__name__}")
+    return doc
+
+
+def _remove(doc, tokens):
+    if not tokens:
+        raise PatchError("cannot remove the document root")
+    parent = _resolve(doc, tokens[:-1])
+    key = tokens[-1]
+    if isinstance(parent, list):
+        return doc, parent.pop(_array_index(parent, key))
+    if isinstance(parent, dict):
+        if key not in parent:
+            raise PatchError(f"path not found: {key!r}")
+        return doc, parent.pop(key)
+    raise PatchError(f"cannot remove from {type(parent).__name__}")
+
+
+def apply_patch(doc, ops):
+    """doc に ops を順に適用した結果を返す。doc はその場で書き換わる（ルート置換時は戻り値が新しいルート）。"""
+    if not isinstance(ops, list):
+        raise PatchError("ops must be an array")
+    for op in ops:
+        if not isinstance(op, dict) or "op" not in op or "path" not in op:
+            raise PatchError(f"invalid operation: {op!r}")
+        name = op["op"]
+        tokens = _parse_pointer(op["path"])
+        if name in ("add", "replace", "test") and "value" not in op:
+            raise PatchError(f"{name} requires value")
+        if name == "add":
+            doc = _add(doc, tokens, op["value"])
+        elif name == "remove":
+            doc, _ = _remove(doc, tokens)
+        elif name == "replace":
+            if not tokens:
+                doc = op["value"]
+                continue
+            doc, _ = _remove(doc, tokens)
+            doc = _add(doc, tokens, op["value"])
+        elif name in ("move", "copy"):
+            if "from" not in op:
+                raise PatchError(f"{name} requires from")
+            from_tokens = _parse_pointer(op["from"])
+            if name == "move":
+                if tokens[: len(from_tokens)] == from_tokens and tokens != from_tokens:
+                    raise PatchError("cannot move a value into its own child")
+                doc, value = _remove(doc, from_tokens)
+            else:
+                value = copy.deepcopy(_resolve(doc, from_tokens))
+            doc = _add(doc, tokens, value)
+        elif name == "test":
+            if _resolve(doc, tokens) != op["value"]:
+                raise PatchError(f"test failed at {op['path']!r}")
+        else:
+            raise PatchError(f"unknown op: {name!r}")
+    return doc
@@ -0,0 +1,308 @@
+"""
+キャンバス状態の保存（アカウント毎DB）。
+canvas_state（id=1）にスナップショット、canvas_patches にそれ以降の差分（JSON Patch）を rev 順に持つ。
+差分が SUMAPURO_CANVAS_COMPACT_PATCHES 件たまったらスナップショットにまとめる。
+状態の版は (lineage, rev) で一意に決まるので、ETag には JSON を読まずにこれを使う。
+保存した各 rev は canvas_history にも残す（一覧・復元用。canvas_history.py）。
+"""
+import json
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+from sqlalchemy import text
+
+from canvas_history import ensure_history_table, record
+from canvas_patch import PatchError, apply_patch
+
+CANVAS_COMPACT_PATCHES = int(os.getenv("SUMAPURO_CANVAS_COMPACT_PATCHES", "50"))
+
+# 差分適用用に、直近に保存した状態をプロセス内に持つ（db -> (lineage, rev, state)）
+_MATERIALIZED_MAX = 32
+_materialized = OrderedDict()
+_materialized_lock = threading.Lock()
+
+
+class CanvasConflict(Exception):
+    """base_rev が現在の rev と一致しない（別タブ・別端末が先に保存した）"""
+
+    def __init__(self, rev):
+        super().__init__(f"canvas state is at rev {rev}")
+        self.rev = rev
+
+
+def ensure_canvas_tables(conn):
+    conn.execute(
+        text(
+            "CREATE TABLE IF NOT EXISTS canvas_state (id INTEGER PRIMARY KEY, state TEXT)"
+        )
+    )
+    cols = {r[1] for r in conn.execute(text("PRAGMA table_info(canvas_state)"))}
+    if "rev" not in cols:
+        conn.execute(
+            text("ALTER TABLE canvas_state ADD COLUMN rev INTEGER NOT NULL DEFAULT 0")
+        )
+    if "lineage" not in cols:
+        conn.execute(text("ALTER TABLE canvas_state ADD COLUMN lineage TEXT"))
+    # 版（lineage.rev）が DB 毎に一意になるよう、行が無い・lineage が無い（旧形式から移した）ときは
+    # ここで振る（書くのはその1回だけ。読み取りの呼び出し側も commit すること）
+    if conn.execute(
+        text("SELECT 1 FROM canvas_state WHERE id = 1 AND lineage IS NOT NULL")
+    ).first() is None:
+        _lock_for_write(conn)
+    conn.execute(
+        text(
+            "CREATE TABLE IF NOT EXISTS canvas_patches (rev INTEGER PRIMARY KEY, ops TEXT NOT NULL)"
+        )
+    )
+    ensure_history_table(conn)
+
+
+def _lock_for_write(conn):
+    """書き込みロックを先に取り、以降の読み取りと判定を他の保存と直列にする。"""
+    conn.execute(
+        text(
+            "INSERT OR IGNORE INTO canvas_state (id, state, rev, lineage) VALUES (1, NULL, 0, :l)"
+        ),
+        {"l": uuid.uuid4().hex},
+    )
+    conn.execute(
+        text("UPDATE canvas_state SET lineage = :l WHERE id = 1 AND lineage IS NULL"),
+        {"l": uuid.uuid4().hex},
+    )
+
+
+def _snapshot(conn):
+    row = conn.execute(
+        text("SELECT state, rev, lineage FROM canvas_state WHERE id = 1")
+    ).fetchone()
+    return (row[0], row[1] or 0, row[2]) if row else (None, 0, None)
+
+
+def _snapshot_version(conn):
+    row = conn.execute(
+        text("SELECT rev, lineage FROM canvas_state WHERE id = 1")
+    ).fetchone()
+    return (row[0] or 0, row[1]) if row else (0, None)
+
+
+def current_rev(conn):
+    snapshot_rev, _ = _snapshot_version(conn)
+    patch_rev = conn.execute(text("SELECT MAX(rev) FROM canvas_patches")).scalar()
+    return max(snapshot_rev, patch_rev or 0)
+
+
+def _version_tag(lineage, rev):
+    return f"{lineage or 'empty'}.{rev}"
+
+
+def state_version(conn):
+    """現在の状態の版（ETag 用）。state 列は読まない。"""
+    ensure_canvas_tables(conn)
+    _, lineage = _snapshot_version(conn)
+    return _version_tag(lineage, current_rev(conn))
+
+
+def _materialize(conn, snapshot_text, snapshot_rev):
+    """スナップショットに未統合の差分を適用した状態を返す。"""
+    state = json.loads(snapshot_text) if snapshot_text else None
+    patches = conn.execute(
+        text("SELECT ops FROM canvas_patches WHERE rev > :r ORDER BY rev"),
+        {"r": snapshot_rev},
+    ).fetchall()
+    for (ops,) in patches:
+        state = apply_patch(state, json.loads(ops))
+    return state
+
+
+def remember_state(cache_key, lineage, rev, state):
+    """commit 済みの状態を差分適用用キャッシュに入れる"""
+    with _materialized_lock:
+        _materialized[cache_key] = (lineage, rev, state)
+        _materialized.move_to_end(cache_key)
+        while len(_materialized) > _MATERIALIZED_MAX:
+            _materialized.popitem(last=False)
+
+
+def _take(cache_key, lineage, rev):
+    """キャッシュが同じ lineage・rev の状態なら取り出す（書き換えるので登録からは外す）"""
+    with _materialized_lock:
+        entry = _materialized.pop(cache_key, None)
+    if entry and entry[0] == lineage and entry[1] == rev:
+        return True, entry[2]
+    return False, None
+
+
+def load_state(conn):
+    """(state, rev) を返す。保存がなければ (None, 0)。"""
+    ensure_canvas_tables(conn)
+    snapshot_text, snapshot_rev, _ = _snapshot(conn)
+    state = _materialize(conn, snapshot_text, snapshot_rev)
+    return state, current_rev(conn)
+
+
+def iter_canvas_objects(state):
+    """キャンバス状態（items 配列）のオブジェクトを、入れ子（nestedItems）も含めて返す"""
+    stack = list(state) if isinstance(state, list) else []
+    while stack:
+        obj = stack.pop()
+        if not isinstance(obj, dict):
+            continue
+        yield obj
+        nested = obj.get("nestedItems")
+        if isinstance(nested, list):
+            stack.extend(nested)
+
+
+def remap_content_ids(conn, id_map):
+    """中身行の id が振り直されたとき（{table_name: {旧 id: 新 id}}）、保存済み状態の contents[].id を書き換える。
+    対応の無い id は削除する。呼び出し側のトランザクション内で書き、commit はしない。"""
+    ensure_canvas_tables(conn)
+    snapshot_text, snapshot_rev, _ = _snapshot(conn)
+    rev = current_rev(conn)
+    if rev == 0 and not snapshot_text:
+        return False
+    state = _materialize(conn, snapshot_text, snapshot_rev)
+    changed = False
+    for obj in iter_canvas_objects(state):
+        mapping = id_map.get(obj.get("tableName"))
+        if mapping is None:
+            continue
+        for row in obj.get("contents") or []:
+            if isinstance(row, dict) and "id" in row:
+                new_id = mapping.get(row["id"])
+                if new_id is None:
+                    del row["id"]
+                else:
+                    row["id"] = new_id
+                changed = True
+    if changed:
+        conn.execute(
+            text("UPDATE canvas_state SET state = :s, rev = :r, lineage = :l WHERE id = 1"),
+            {"s": json.dumps(state, ensure_ascii=False), "r": rev + 1, "l": uuid.uuid4().hex},
+        )
+        conn.execute(text("DELETE FROM canvas_patches"))
+        record(conn, rev + 1, state)
+    return changed
+
+
+def export_state_text(conn):
+    """(JSON 文字列, rev) を返す（書き出し用）。書き込まないので読み取りトランザクション内で呼べる。
+    未統合の差分が無ければ保存済みの文字列を解析せずにそのまま返す。"""
+    snapshot_text, snapshot_rev, _ = _snapshot(conn)
+    rev = current_rev(conn)
+    if rev > snapshot_rev:
+        snapshot_text = json.dumps(_materialize(conn, snapshot_text, snapshot_rev), ensure_ascii=False)
+    return snapshot_text or "null", rev
+
+
+def replace_state(conn, state):
+    """状態全体を新しい lineage・rev+1 で置き換える（取り込み用）。呼び出し側のトランザクション内で書き、commit はしない。"""
+    ensure_canvas_tables(conn)
+    _lock_for_write(conn)
+    rev = current_rev(conn) + 1
+    conn.execute(
+        text("UPDATE canvas_state SET state = :s, rev = :r, lineage = :l WHERE id = 1"),
+        {"s": json.dumps(state, ensure_ascii=False), "r": rev, "l": uuid.uuid4().hex},
+    )
+    conn.execute(text("DELETE FROM canvas_patches"))
+    record(conn, rev, state)
+    return rev
+
+
+def load_state_text(conn, cache_key):
+    """(保存済み JSON 文字列, rev, 版) を返す。未統合の差分があれば先にスナップショットへまとめる。"""
+    ensure_canvas_tables(conn)
+    snapshot_text, snapshot_rev, lineage = _snapshot(conn)
+    rev = current_rev(conn)
+    if rev > snapshot_rev:
+        snapshot_text, rev, lineage = compact(conn, cache_key)
+    return snapshot_text or "null", rev, _version_tag(lineage, rev)
+
+
+def compact(conn, cache_key):
+    """未統合の差分をスナップショットにまとめて commit し、(JSON 文字列, rev, lineage) を返す。rev は変わらない。"""
+    ensure_canvas_tables(conn)
+    _lock_for_write(conn)
+    snapshot_text, snapshot_rev, lineage = _snapshot(conn)
+    rev = current_rev(conn)
+    if rev == snapshot_rev:
+        conn.rollback()
+        return snapshot_text, rev, lineage
+    found, state = _take(cache_key, lineage, rev)
+    if not found:
+        state = _materialize(conn, snapshot_text, snapshot_rev)
+    snapshot_text = json.dumps(state, ensure_ascii=False)
+    conn.execute(
+        text("UPDATE canvas_state SET state = :s, rev = :r WHERE id = 1"),
+        {"s": snapshot_text, "r": rev},
+    )
+    conn.execute(text("DELETE FROM canvas_patches"))
+    conn.commit()
+    remember_state(cache_key, lineage, rev, state)
+    return snapshot_text, rev, lineage
+
+
+def write_snapshot(conn, state):
+    """状態全体を書き込み（未統合の差分は破棄）、(lineage, 新しい rev) を返す。commit はしないので、
+    呼び出し側が commit した後で remember_state を呼ぶ（write_queue でまとめて commit するとき用）。"""
+    ensure_canvas_tables(conn)
+    _lock_for_write(conn)
+    rev = current_rev(conn) + 1
+    lineage = uuid.uuid4().hex
+    conn.execute(
+        text("UPDATE canvas_state SET state = :s, rev = :r, lineage = :l WHERE id = 1"),
+        {"s": json.dumps(state, ensure_ascii=False), "r": rev, "l": lineage},
+    )
+    conn.execute(text("DELETE FROM canvas_patches"))
+    record(conn, rev, state)
+    return lineage, rev
+
+
+def save_snapshot(conn, cache_key, state):
+    """状態全体を保存し（未統合の差分は破棄）、commit して新しい rev を返す。"""
+    lineage, rev = write_snapshot(conn, state)
+    conn.commit()
+    remember_state(cache_key, lineage, rev, state)
+    return rev
+
+
+def save_patch(conn, cache_key, base_rev, ops):
+    """base_rev の状態に ops を適用して保存し、commit して新しい rev を返す。
+    rev が進んでいれば CanvasConflict、ops が適用できなければ PatchError（どちらも何も書かない）。"""
+    if not isinstance(ops, list):
+        raise PatchError("ops must be an array")
+    ensure_canvas_tables(conn)
+    _lock_for_write(conn)
+    snapshot_text, snapshot_rev, lineage = _snapshot(conn)
+    rev = current_rev(conn)
+    if base_rev != rev:
+        conn.rollback()
+        raise CanvasConflict(rev)
+    found, state = _take(cache_key, lineage, rev)
+    try:
+        if not found:
+            state = _materialize(conn, snapshot_text, snapshot_rev)
+        state = apply_patch(state, ops)
+    except ValueError as e:
+        # 壊れた保存データ（json.loads の失敗）も適用不可として扱い、全体保存で復帰させる
+        conn.rollback()
+        raise e if isinstance(e, PatchError) else PatchError(str(e))
+    new_rev = rev + 1
+    if new_rev - snapshot_rev >= CANVAS_COMPACT_PATCHES:
+        # 差分がたまったのでスナップショットにまとめる
+        conn.execute(
+            text("UPDATE canvas_state SET state = :s, rev = :r WHERE id = 1"),
+            {"s": json.dumps(state, ensure_ascii=False), "r": new_rev},
+        )
+        conn.execute(text("DELETE FROM canvas_patches"))
+    else:
+        conn.execute(
+            text("INSERT INTO canvas_patches (rev, ops) VALUES (:r, :o)"),
+            {"r": new_rev, "o": json.dumps(ops, ensure_ascii=False)},
+        )
+    record(conn, new_rev, state, ops)
+    conn.commit()
+    remember_state(cache_key, lineage, new_rev, state)
+    return new_rev
@@ -0,0 +1,50 @@
+"""
+レスポンス本文の圧縮（gzip / brotli）。brotli はパッケージが入っている場合のみ使う。
+同じ版の本文を何度も圧縮しないよう、(DB, 版, 方式) → 圧縮済みバイト列を少数だけ覚えておく
+（キャッシュはプロセス内の全ユーザーで共有なので、版だけでなく DB も必ずキーに含める）。
+"""
+import gzip
+import os
+import threading
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:  # 任意依存
+    brotli = None
+
+COMPRESS_MIN_BYTES = int(os.getenv("SUMAPURO_COMPRESS_MIN_BYTES", "1024"))
+_CACHE_MAX = 64
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def choose_encoding(accept_encoding):
+    """Accept-Encoding（werkzeug の MIMEAccept 相当）から使う方式を選ぶ。無ければ None。"""
+    if brotli is not None and accept_encoding["br"]:
+        return "br"
+    if accept_encoding["gzip"]:
+        return "gzip"
+    return None
+
+
+def compress(body, encoding, version=None, scope=None):
+    """body（bytes）を encoding で圧縮する。scope（DB のキー）と version を渡すと同じ DB・版の結果を再利用する。"""
+    key = (scope, version, encoding) if version is not None and scope is not None else None
+    if key is not None:
+        with _cache_lock:
+            cached = _cache.get(key)
+            if cached is not None:
+                _cache.move_to_end(key)
+                return cached
+    if encoding == "br":
+        data = brotli.compress(body, quality=5)
+    else:
+        data = gzip.compress(body, compresslevel=6)
+    if key is not None:
+        with _cache_lock:
+            _cache[key] = data
+            while len(_cache) > _CACHE_MAX:
+                _cache.popitem(last=False)
+    return data
@@ -0,0 +1,717 @@
+"""
+オブジェクト中身の保存先（アカウント毎DB）。
+  tables: オブジェクト毎に type_id_N テーブルを作る（従来方式）
+  single: 全オブジェクトの中身を contents 1テーブルにまとめ、table_name を論理 id として持つ
+
+新規DBの方式は環境変数 SUMAPURO_STORAGE_MODE（既定 tables）で決まり、meta.storage_mode に記録する。
+既存DBを single に変換するには:
+
+  python contents_store.py migrate                 # data/*.db をすべて変換
+  python contents_store.py migrate data/xxxx.db    # 指定ファイルのみ
+"""
+import argparse
+import glob
+import os
+import sys
+
+from sqlalchemy import create_engine, text
+
+from canvas_store import remap_content_ids
+from object_tree import (
+    ancestors,
+    children,
+    drop_object_tree,
+    ensure_object_tree,
+    remove_object,
+    set_parent,
+    subtree,
+)
+from object_tree import register_object as register_tree_object
+from rollups import (
+    add_to_rollups,
+    category_summary,
+    drop_rollup_object,
+    drop_rollups,
+    ensure_rollups,
+    object_summary,
+    register_object,
+    rename_rollup_object,
+)
+from search_index import (
+    drop_indexed_table,
+    drop_search_index,
+    ensure_search_index,
+    index_content_row,
+    remove_content_rows,
+    rename_indexed_object,
+    search_index,
+)
+
+STORAGE_TABLES = "tables"
+STORAGE_SINGLE = "single"
+STORAGE_MODES = (STORAGE_TABLES, STORAGE_SINGLE)
+DEFAULT_STORAGE_MODE = os.getenv("SUMAPURO_STORAGE_MODE", STORAGE_TABLES)
+
+# 中身テーブルのカラム: id, object_name, name, category, count, nest_type, parent_table_name
+CONTENT_TABLE_COLS = (
+    "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+    "object_name TEXT, "
+    "name TEXT, "
+    "category TEXT, "
+    "count INTEGER, "
+    "nest_type INTEGER, "
+    "parent_table_name TEXT"
+)
+CONTENT_FIELDS = ("object_name", "name", "category", "count", "nest_type", "parent_table_name")
+# /api/contents/update で変更できる列
+UPDATABLE_FIELDS = ("name", "category", "count")
+
+# single 方式: 中身行と、存在するオブジェクト（論理テーブル名）の一覧
+CONTENTS_TABLE = "contents"
+OBJECTS_TABLE = "content_objects"
+# prefix（type_id）毎に払い出した最後の連番
+COUNTERS_TABLE = "object_counters"
+
+
+def is_content_table_name(name):
+    """中身テーブル（type_id_N 形式: アンダースコア＋数字で終わる）か"""
+    return bool(name) and "_" in name and name.split("_")[-1].isdigit()
+
+
+def _escape_like(value):
+    return str(value).replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _in_clause(values, prefix="id"):
+    placeholders = ", ".join(f":{prefix}{i}" for i in range(len(values)))
+    params = {f"{prefix}{i}": v for i, v in enumerate(values)}
+    return placeholders, params
+
+
+def _ensure_meta(conn):
+    conn.execute(
+        text("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    )
+
+
+def begin_write(conn):
+    """書き込みトランザクションを明示的に始める。pysqlite は CREATE/DROP の前に BEGIN を出さないので、
+    テーブル作成を含む一連の操作を1トランザクション（1回の commit）にまとめたいときに使う。"""
+    if not conn.connection.driver_connection.in_transaction:
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+
+def _legacy_table_names(conn):
+    tables = conn.execute(
+        text(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'"
+        )
+    ).fetchall()
+    return [t for (t,) in tables if is_content_table_name(t)]
+
+
+def _create_single_tables(conn):
+    conn.execute(
+        text(
+            f"CREATE TABLE IF NOT EXISTS {CONTENTS_TABLE} ("
+            f"{CONTENT_TABLE_COLS}, table_name TEXT NOT NULL)"
+        )
+    )
+    conn.execute(
+        text(
+            f"CREATE INDEX IF NOT EXISTS idx_{CONTENTS_TABLE}_table "
+            f"ON {CONTENTS_TABLE} (table_name, id)"
+        )
+    )
+    conn.execute(
+        text(
+            f"CREATE TABLE IF NOT EXISTS {OBJECTS_TABLE} "
+            "(table_name TEXT PRIMARY KEY) WITHOUT ROWID"
+        )
+    )
+
+
+def storage_mode(conn):
+    """このDBの保存方式を返す。未記録なら、既存の type_id_N テーブルの有無と既定値から決めて記録する
+    （記録したときだけ commit するので、接続を開いた直後に呼ぶ）。"""
+    _ensure_meta(conn)
+    mode = conn.execute(
+        text("SELECT value FROM meta WHERE key = 'storage_mode'")
+    ).scalar()
+    if mode in STORAGE_MODES:
+        return mode
+    mode = DEFAULT_STORAGE_MODE if DEFAULT_STORAGE_MODE in STORAGE_MODES else STORAGE_TABLES
+    if mode == STORAGE_SINGLE and _legacy_table_names(conn):
+        # 従来方式の中身が残っている DB は migrate するまで tables のまま
+        mode = STORAGE_TABLES
+    if mode == STORAGE_SINGLE:
+        _create_single_tables(conn)
+    conn.execute(
+        text("INSERT OR REPLACE INTO meta (key, value) VALUES ('storage_mode', :m)"),
+        {"m": mode},
+    )
+    conn.commit()
+    return mode
+
+
+class ContentStore:
+    """1接続分の中身操作。保存方式の違いと検索インデックス・集計表・入れ子の表の同期をここで吸収する。"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.mode = storage_mode(conn)
+        self._indexed = None
+        self._rolled_up = False
+        self._tree_ready = False
+
+    @property
+    def single(self):
+        return self.mode == STORAGE_SINGLE
+
+    def indexed(self):
+        """検索インデックスが使えるか（初回呼び出しで必要なら構築）"""
+        if self._indexed is None:
+            self._indexed = ensure_search_index(self.conn, self.iter_rows)
+        return self._indexed
+
+    def rolled_up(self):
+        """集計表を使える状態にする（初回呼び出しで必要なら既存の中身から構築）"""
+        if not self._rolled_up:
+            self._rolled_up = ensure_rollups(self.conn, self.object_names, self._all_groups)
+        return self._rolled_up
+
+    def tree_ready(self):
+        """入れ子の表を使える状態にする（初回呼び出しで必要なら既存の中身から構築）"""
+        if not self._tree_ready:
+            self._tree_ready = ensure_object_tree(self.conn, self.object_names, self._parent_links)
+        return self._tree_ready
+
+    def _parent_links(self):
+        """中身行に記録された (table_name, parent_table_name) の組"""
+        where = "WHERE parent_table_name IS NOT NULL AND parent_table_name != ''"
+        if self.single:
+            for row in self.conn.execute(
+                text(f"SELECT DISTINCT table_name, parent_table_name FROM {CONTENTS_TABLE} {where}")
+            ):
+                yield tuple(row)
+            return
+        for table_name in _legacy_table_names(self.conn):
+            rows = self.conn.execute(
+                text(f'SELECT DISTINCT parent_table_name FROM "{table_name}" {where}')
+            ).fetchall()
+            for (parent_table_name,) in rows:
+                yield (table_name, parent_table_name)
+
+    def _groups(self, table_name, row_ids=None):
+        """オブジェクト内（row_ids 指定時はその行のみ）の分類毎の (category, rows, total_count)"""
+        params = {}
+        where = []
+        if self.single:
+            source = CONTENTS_TABLE
+            where.append("table_name = :t")
+            params["t"] = table_name
+        else:
+            source = f'"{table_name}"'
+        if row_ids is not None:
+            placeholders, id_params = _in_clause(row_ids)
+            where.append(f"id IN ({placeholders})")
+            params.update(id_params)
+        sql = (
+            f"SELECT COALESCE(category, ''), COUNT(*), COALESCE(SUM(count), 0) FROM {source}"
+            + (" WHERE " + " AND ".join(where) if where else "")
+            + " GROUP BY 1"
+        )
+        return [tuple(r) for r in self.conn.execute(text(sql), params)]
+
+    def _all_groups(self):
+        """全オブジェクトの (table_name, object_name, category, rows, total_count)"""
+        cols = "MAX(object_name), COALESCE(category, ''), COUNT(*), COALESCE(SUM(count), 0)"
+        if self.single:
+            for row in self.conn.execute(
+                text(f"SELECT table_name, {cols} FROM {CONTENTS_TABLE} GROUP BY table_name, 3")
+            ):
+                yield tuple(row)
+            return
+        for table_name in _legacy_table_names(self.conn):
+            rows = self.conn.execute(
+                text(f'SELECT {cols} FROM "{table_name}" GROUP BY 2')
+            ).fetchall()
+            for row in rows:
+                yield (table_name,) + tuple(row)
+
+    def object_exists(self, table_name):
+        """中身のオブジェクトとして存在するか。type_id_N 形式でない名前（meta・集計表など内部のテーブル）は False。"""
+        if not is_content_table_name(table_name):
+            return False
+        if self.single:
+            sql = f"SELECT 1 FROM {OBJECTS_TABLE} WHERE table_name = :n"
+        else:
+            sql = "SELECT 1 FROM sqlite_master WHERE type='table' AND name=:n"
+        return self.conn.execute(text(sql), {"n": table_name}).first() is not None
+
+    def object_names(self):
+        """存在するオブジェクト（論理テーブル名）の一覧"""
+        if self.single:
+            rows = self.conn.execute(
+                text(f"SELECT table_name FROM {OBJECTS_TABLE}")
+            ).fetchall()
+            return [t for (t,) in rows]
+        return _legacy_table_names(self.conn)
+
+    def allocate_object(self, prefix):
+        """prefix_N の N を連番カウンタから払い出してオブジェクトを作り、その名前を返す（commit は呼び出し側）。
+        BEGIN IMMEDIATE の中で読み書きするので、同時リクエストや別プロセスと番号が重ならない。"""
+        self.conn.execute(
+            text(
+                f"CREATE TABLE IF NOT EXISTS {COUNTERS_TABLE} "
+                "(prefix TEXT PRIMARY KEY, last INTEGER NOT NULL) WITHOUT ROWID"
+            )
+        )
+        begin_write(self.conn)
+        row = self.conn.execute(
+            text(f"SELECT last FROM {COUNTERS_TABLE} WHERE prefix = :p"), {"p": prefix}
+        ).fetchone()
+        if row is None:
+            # カウンタが無い prefix は、既存オブジェクトの最大番号から1回だけ数え始める
+            last = 0
+            for t in self.object_names():
+                suffix = t[len(prefix) + 1 :]
+                if t.startswith(prefix + "_") and suffix.isdigit():
+                    last = max(last, int(suffix))
+            self.conn.execute(
+                text(f"INSERT INTO {COUNTERS_TABLE} (prefix, last) VALUES (:p, :n)"),
+                {"p": prefix, "n": last},
+            )
+        else:
+            last = row[0]
+        last += 1
+        while self.object_exists(f"{prefix}_{last}"):
+            last += 1
+        self.conn.execute(
+            text(f"UPDATE {COUNTERS_TABLE} SET last = :n WHERE prefix = :p"),
+            {"p": prefix, "n": last},
+        )
+        table_name = f"{prefix}_{last}"
+        self.create_object(table_name)
+        return table_name
+
+    def create_object(self, table_name):
+        if not is_content_table_name(table_name):
+            raise ValueError(f"not a content table name: {table_name}")
+        self.rolled_up()
+        self.tree_ready()
+        register_object(self.conn, table_name)
+        register_tree_object(self.conn, table_name)
+        self._create_storage(table_name)
+
+    def _create_storage(self, table_name):
+        if self.single:
+            self.conn.execute(
+                text(f"INSERT OR IGNORE INTO {OBJECTS_TABLE} (table_name) VALUES (:n)"),
+                {"n": table_name},
+            )
+        else:
+            self.conn.execute(
+                text(
+                    f'CREATE TABLE IF NOT EXISTS "{table_name}" ({CONTENT_TABLE_COLS})'
+                )
+            )
+
+    def insert_row(self, table_name, row):
+        """中身1行を追加して id を返す。row は CONTENT_FIELDS のキーを持つ dict。"""
+        indexed = self.indexed()
+        params = {f: row.get(f) for f in CONTENT_FIELDS}
+        cols = ", ".join(CONTENT_FIELDS)
+        values = ", ".join(f":{f}" for f in CONTENT_FIELDS)
+        if self.single:
+            params["table_name"] = table_name
+            sql = f"INSERT INTO {CONTENTS_TABLE} ({cols}, table_name) VALUES ({values}, :table_name)"
+        else:
+            sql = f'INSERT INTO "{table_name}" ({cols}) VALUES ({values})'
+        row_id = self.conn.execute(text(sql), params).lastrowid
+        self.rolled_up()
+        add_to_rollups(
+            self.conn, table_name, params["object_name"], params["category"], 1, params["count"]
+        )
+        self.tree_ready()
+        set_parent(self.conn, table_name, params["parent_table_name"])
+        if indexed:
+            index_content_row(
+                self.conn,
+                table_name,
+                row_id,
+                params["object_name"],
+                params["name"],
+                params["category"],
+                params["parent_table_name"],
+            )
+        return row_id
+
+    def row_ids(self, table_name):
+        """オブジェクト内の行 id を追加順で返す（位置指定の削除用）"""
+        if self.single:
+            rows = self.conn.execute(
+                text(f"SELECT id FROM {CONTENTS_TABLE} WHERE table_name = :t ORDER BY id"),
+                {"t": table_name},
+            ).fetchall()
+        else:
+            rows = self.conn.execute(
+                text(f'SELECT id FROM "{table_name}" ORDER BY id')
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def delete_rows(self, table_name, row_ids):
+        """id 指定で行を削除し、実際に削除した行数を返す。"""
+        if not row_ids:
+            return 0
+        indexed = self.indexed()
+        self.rolled_up()
+        for category, rows, total_count in self._groups(table_name, row_ids):
+            add_to_rollups(self.conn, table_name, None, category, -rows, -total_count)
+        placeholders, params = _in_clause(row_ids)
+        if self.single:
+            params["t"] = table_name
+            sql = f"DELETE FROM {CONTENTS_TABLE} WHERE table_name = :t AND id IN ({placeholders})"
+        else:
+            sql = f'DELETE FROM "{table_name}" WHERE id IN ({placeholders})'
+        deleted = self.conn.execute(text(sql), params).rowcount
+        if indexed:
+            remove_content_rows(self.conn, table_name, row_ids)
+        return deleted
+
+    def _select_row(self, table_name, row_id, cols):
+        if self.single:
+            return self.conn.execute(
+                text(f"SELECT {cols} FROM {CONTENTS_TABLE} WHERE table_name = :t AND id = :id"),
+                {"t": table_name, "id": row_id},
+            ).fetchone()
+        return self.conn.execute(
+            text(f'SELECT {cols} FROM "{table_name}" WHERE id = :id'), {"id": row_id}
+        ).fetchone()
+
+    def update_row(self, table_name, row_id, fields):
+        """id 指定で1行の name / category / count を更新する。行が無ければ False。"""
+        fields = {k: v for k, v in fields.items() if k in UPDATABLE_FIELDS}
+        if not fields:
+            return self._select_row(table_name, row_id, "id") is not None
+        indexed = self.indexed()
+        self.rolled_up()
+        before = self._select_row(table_name, row_id, "category, count")
+        if before is None:
+            return False
+        sets = ", ".join(f"{k} = :{k}" for k in fields)
+        params = dict(fields, id=row_id)
+        if self.single:
+            params["t"] = table_name
+            sql = f"UPDATE {CONTENTS_TABLE} SET {sets} WHERE table_name = :t AND id = :id"
+        else:
+            sql = f'UPDATE "{table_name}" SET {sets} WHERE id = :id'
+        self.conn.execute(text(sql), params)
+        after = self._select_row(table_name, row_id, "category, count")
+        if tuple(before) != tuple(after):
+            add_to_rollups(self.conn, table_name, None, before[0], -1, -(before[1] or 0))
+            add_to_rollups(self.conn, table_name, None, after[0], 1, after[1])
+        if indexed:
+            object_name, name, category, parent_table_name = self._select_row(
+                table_name, row_id, "object_name, name, category, parent_table_name"
+            )
+            remove_content_rows(self.conn, table_name, [row_id])
+            index_content_row(
+                self.conn, table_name, row_id, object_name, name, category, parent_table_name
+            )
+        return True
+
+    def rename_object(self, table_name, new_name):
+        indexed = self.indexed()
+        if self.single:
+            self.conn.execute(
+                text(f"UPDATE {CONTENTS_TABLE} SET object_name = :n WHERE table_name = :t"),
+                {"n": new_name, "t": table_name},
+            )
+        else:
+            self.conn.execute(
+                text(f'UPDATE "{table_name}" SET object_name = :n'),
+                {"n": new_name},
+            )
+        self.rolled_up()
+        rename_rollup_object(self.conn, table_name, new_name)
+        if indexed:
+            rename_indexed_object(self.conn, table_name, new_name)
+
+    def drop_object(self, table_name):
+        """オブジェクトを削除する。type_id_N 形式でない名前は内部のテーブルなので何もせず False。"""
+        if not is_content_table_name(table_name):
+            return False
+        indexed = self.indexed()
+        self.rolled_up()
+        self.tree_ready()
+        if self.object_exists(table_name):
+            drop_rollup_object(self.conn, table_name, self._groups(table_name))
+        remove_object(self.conn, table_name)
+        if self.single:
+            self.conn.execute(
+                text(f"DELETE FROM {CONTENTS_TABLE} WHERE table_name = :t"),
+                {"t": table_name},
+            )
+            self.conn.execute(
+                text(f"DELETE FROM {OBJECTS_TABLE} WHERE table_name = :t"),
+                {"t": table_name},
+            )
+        else:
+            self.conn.execute(text(f'DROP TABLE IF EXISTS "{table_name}"'))
+        if indexed:
+            drop_indexed_table(self.conn, table_name)
+        return True
+
+    def clear(self):
+        """全オブジェクトと検索インデックス・集計表・入れ子の表を消す（取り込みの置き換え用、commit は呼び出し側）。"""
+        begin_write(self.conn)
+        drop_search_index(self.conn)
+        drop_rollups(self.conn)
+        drop_object_tree(self.conn)
+        if self.single:
+            self.conn.execute(text(f"DELETE FROM {CONTENTS_TABLE}"))
+            self.conn.execute(text(f"DELETE FROM {OBJECTS_TABLE}"))
+        else:
+            for table_name in _legacy_table_names(self.conn):
+                self.conn.execute(text(f'DROP TABLE "{table_name}"'))
+        self._indexed = None
+        self._rolled_up = False
+        self._tree_ready = False
+
+    def load_object(self, table_name, rows):
+        """オブジェクトを作り、行（id と CONTENT_FIELDS のキーを持つ dict）を executemany でまとめて入れる。
+        検索インデックス・集計表・入れ子の表は更新しないので、clear() 直後に使い、最後に rebuild_derived() を呼ぶ。"""
+        self._create_storage(table_name)
+        if not rows:
+            return
+        cols = ", ".join(("id",) + CONTENT_FIELDS)
+        values = ", ".join(f":{f}" for f in ("id",) + CONTENT_FIELDS)
+        if self.single:
+            sql = f"INSERT INTO {CONTENTS_TABLE} ({cols}, table_name) VALUES ({values}, :table_name)"
+            rows = [dict(r, table_name=table_name) for r in rows]
+        else:
+            sql = f'INSERT INTO "{table_name}" ({cols}) VALUES ({values})'
+        self.conn.execute(text(sql), rows)
+
+    def max_row_id(self):
+        """single 方式で使用済みの最大の行 id（tables 方式はテーブル毎に振るので 0）"""
+        if not self.single:
+            return 0
+        return self.conn.execute(text(f"SELECT COALESCE(MAX(id), 0) FROM {CONTENTS_TABLE}")).scalar()
+
+    def rebuild_derived(self):
+        """検索インデックス・集計表・入れ子の表を今の中身から作る（load_object の後に呼ぶ）"""
+        self.indexed()
+        self.rolled_up()
+        self.tree_ready()
+
+    def iter_contents(self):
+        """全オブジェクトの全行を (table_name, id, *CONTENT_FIELDS) で、オブジェクト毎・id 順に返す（書き出し用）。
+        1行ずつカーソルから読むので、行数が多くてもメモリに溜めない。"""
+        cols = "id, " + ", ".join(CONTENT_FIELDS)
+        if self.single:
+            result = self.conn.execute(
+                text(f"SELECT table_name, {cols} FROM {CONTENTS_TABLE} ORDER BY table_name, id")
+            )
+            for row in result:
+                yield tuple(row)
+            return
+        for table_name in sorted(_legacy_table_names(self.conn)):
+            for row in self.conn.execute(text(f'SELECT {cols} FROM "{table_name}" ORDER BY id')):
+                yield (table_name,) + tuple(row)
+
+    def iter_rows(self):
+        """全中身行を (table_name, id, object_name, name, category, parent_table_name) で返す"""
+        cols = "id, object_name, name, category, parent_table_name"
+        if self.single:
+            result = self.conn.execute(
+                text(f"SELECT table_name, {cols} FROM {CONTENTS_TABLE} ORDER BY table_name, id")
+            )
+            for row in result:
+                yield tuple(row)
+            return
+        for table_name in _legacy_table_names(self.conn):
+            rows = self.conn.execute(
+                text(f'SELECT {cols} FROM "{table_name}" ORDER BY id')
+            ).fetchall()
+            for row in rows:
+                yield (table_name,) + tuple(row)
+
+    def list_rows(self, table_name, fields=CONTENT_FIELDS, after_id=None, limit=100, category=None):
+        """オブジェクトの中身を id 順に (id, *fields) で最大 limit 行返す。after_id 指定時はそれより大きい id から
+        （キーセットでの続き取得。OFFSET と違い何ページ目でも索引を引くだけ）。category は完全一致で絞り込む。"""
+        cols = ", ".join(("id",) + tuple(f for f in fields if f in CONTENT_FIELDS))
+        conditions = []
+        params = {"n": limit}
+        if after_id is not None:
+            conditions.append("id > :after")
+            params["after"] = after_id
+        if category is not None:
+            conditions.append("COALESCE(category, '') = :category")
+            params["category"] = category
+        if self.single:
+            conditions.insert(0, "table_name = :t")
+            params["t"] = table_name
+            source = CONTENTS_TABLE
+        else:
+            source = f'"{table_name}"'
+        where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+        rows = self.conn.execute(
+            text(f"SELECT {cols} FROM {source} {where}ORDER BY id LIMIT :n"), params
+        ).fetchall()
+        return [tuple(r) for r in rows]
+
+    def children(self, table_name, after=None, limit=100):
+        """直下に入っているオブジェクトを (table_name, object_name, rows, total_count) で返す"""
+        self.rolled_up()
+        self.tree_ready()
+        return children(self.conn, table_name, after, limit)
+
+    def category_summary(self):
+        """分類毎の (category, rows, total_count)"""
+        self.rolled_up()
+        return category_summary(self.conn)
+
+    def object_summary(self, table_name=None):
+        """オブジェクト毎の (table_name, object_name, rows, total_count)"""
+        self.rolled_up()
+        return object_summary(self.conn, table_name)
+
+    def subtree(self, root=None):
+        """入れ子の木（root 指定でその部分木）を (table_name, object_name, parent_table_name, depth) で返す"""
+        self.rolled_up()
+        self.tree_ready()
+        return subtree(self.conn, root)
+
+    def ancestors(self, table_names):
+        """{table_name: [(table_name, object_name), ...（自分から最上位の順）]}"""
+        self.rolled_up()
+        self.tree_ready()
+        return ancestors(self.conn, table_names)
+
+    def search(self, search_name, search_category):
+        """名前・分類の部分一致で検索し、(table_name, parent_table_name) の一覧を返す。"""
+        if self.indexed():
+            return search_index(self.conn, search_name, search_category)
+        # FTS5 が使えない環境: LIKE で走査（tables 方式はテーブル毎に1クエリ）
+        name_pattern = "%" + _escape_like(search_name) + "%" if search_name else "%"
+        category_pattern = (
+            "%" + _escape_like(search_category) + "%" if search_category else "%"
+        )
+        where = (
+            "WHERE name LIKE :name_pattern ESCAPE '\\' "
+            "AND category LIKE :category_pattern ESCAPE '\\'"
+        )
+        params = {"name_pattern": name_pattern, "category_pattern": category_pattern}
+        if self.single:
+            rows = self.conn.execute(
+                text(
+                    f"SELECT DISTINCT table_name, parent_table_name FROM {CONTENTS_TABLE} "
+                    f"{where} ORDER BY table_name"
+                ),
+                params,
+            ).fetchall()
+            return [(t, p) for t, p in rows]
+        results = []
+        for table_name in _legacy_table_names(self.conn):
+            try:
+                rows = self.conn.execute(
+                    text(f'SELECT DISTINCT parent_table_name FROM "{table_name}" {where}'),
+                    params,
+                ).fetchall()
+            except Exception:
+                continue
+            results.extend((table_name, p) for (p,) in rows)
+        return results
+
+
+def migrate_to_single(conn):
+    """tables 方式のDBを single 方式へその場で変換する。変換したオブジェクト数を返す。
+    サーバ稼働中でも実行できる（変換中の他リクエストは書き込みロックを短時間待つだけ）。
+    行 id は contents 全体で振り直し、キャンバス状態に保存された中身行の id も同じ対応で書き換える
+    （変換中に開いていた画面は再読み込みが必要）。"""
+    _ensure_meta(conn)
+    # 先に DML を1つ実行してトランザクションを開始し、以降の CREATE/DROP も同じトランザクションに含める
+    conn.execute(
+        text("INSERT OR IGNORE INTO meta (key, value) VALUES ('storage_mode', :m)"),
+        {"m": STORAGE_TABLES},
+    )
+    mode = conn.execute(
+        text("SELECT value FROM meta WHERE key = 'storage_mode'")
+    ).scalar()
+    if mode == STORAGE_SINGLE:
+        return 0
+    _create_single_tables(conn)
+    tables = _legacy_table_names(conn)
+    cols = ", ".join(CONTENT_FIELDS)
+    id_map = {}
+    for table_name in tables:
+        conn.execute(
+            text(f"INSERT OR IGNORE INTO {OBJECTS_TABLE} (table_name) VALUES (:t)"),
+            {"t": table_name},
+        )
+        old_ids = [
+            r[0]
+            for r in conn.execute(text(f'SELECT id FROM "{table_name}" ORDER BY id'))
+        ]
+        base = conn.execute(
+            text(f"SELECT COALESCE(MAX(id), 0) FROM {CONTENTS_TABLE}")
+        ).scalar()
+        # 新しい id は base+1 から旧 id の順に連番（対応表を作れるよう明示的に振る）
+        conn.execute(
+            text(
+                f"INSERT INTO {CONTENTS_TABLE} (id, {cols}, table_name) "
+                f"SELECT :base + ROW_NUMBER() OVER (ORDER BY id), {cols}, :t "
+                f'FROM "{table_name}"'
+            ),
+            {"base": base, "t": table_name},
+        )
+        id_map[table_name] = {old: base + i + 1 for i, old in enumerate(old_ids)}
+        conn.execute(text(f'DROP TABLE "{table_name}"'))
+    remap_content_ids(conn, id_map)
+    conn.execute(
+        text("INSERT OR REPLACE INTO meta (key, value) VALUES ('storage_mode', :m)"),
+        {"m": STORAGE_SINGLE},
+    )
+    # 行 id が変わるので検索インデックスも作り直す
+    drop_search_index(conn)
+    ContentStore(conn).indexed()
+    return len(tables)
+
+
+def migrate_database_file(path):
+    engine = create_engine(
+        f"sqlite:///{path}".replace("\\", "/"),
+        connect_args={"check_same_thread": False},
+    )
+    try:
+        with engine.begin() as conn:
+            return migrate_to_single(conn)
+    finally:
+        engine.dispose()
+
+
+def main(argv=None):
+    backend_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="中身の保存方式の変換")
+    sub = parser.add_subparsers(dest="command", required=True)
+    migrate = sub.add_parser("migrate", help="tables 方式のDBを single 方式に変換")
+    migrate.add_argument("paths", nargs="*", help="対象の .db（省略時は data/*.db すべて）")
+    migrate.add_argument("--data-dir", default=os.path.join(backend_dir, "data"))
+    args = parser.parse_args(argv)
+
+    paths = args.paths or sorted(glob.glob(os.path.join(args.data_dir, "*.db")))
+    failed = 0
+    for path in paths:
+        try:
+            n = migrate_database_file(path)
+            print(f"{path}: {n} object tables migrated")
+        except Exception as e:
+            failed += 1
+            print(f"{path}: failed ({e})", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
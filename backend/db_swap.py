@@ -0,0 +1,65 @@
+"""
+アカウント毎DBのファイルを、新しく作った空のDBと丸ごと差し替える（/api/db/reset 用）。
+中身の量に関係なく一定時間で終わり、古いファイルの領域もすぐ解放される。
+
+WAL の -wal / -shm はパスで共有されるので、他の接続（別スレッド・別ワーカー）が古いファイルを開いている間は
+差し替えない（古い接続が閉じるときに新しいDBの -wal を消してしまうため）。
+journal_mode を DELETE に戻せる（= 他に接続が無い）ことを確かめ、排他ロックを持ったまま os.replace する。
+開いている接続があれば DatabaseBusy を投げるので、呼び出し側はテーブルを DROP する方式で消す。
+Windows は開いているファイルを置き換えられないので、ロックを外してから置き換え、失敗すれば DatabaseBusy。
+"""
+import os
+import sqlite3
+import tempfile
+
+
+class DatabaseBusy(Exception):
+    """他の接続が DB を開いているので差し替えられない"""
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def swap_database_file(path, init=None, timeout=0.1):
+    """path を空のDB（init(sqlite3 の接続) で初期化したもの）と差し替える。path が無ければ作るだけ。
+    timeout は他の接続のロックを待つ秒数。"""
+    directory = os.path.dirname(path) or "."
+    fd, tmp = tempfile.mkstemp(prefix=".reset-", suffix=".db", dir=directory)
+    os.close(fd)
+    try:
+        new = sqlite3.connect(tmp)
+        try:
+            if init is not None:
+                init(new)
+            new.commit()
+        finally:
+            new.close()
+        if not os.path.exists(path):
+            os.replace(tmp, path)
+            return
+        old = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        try:
+            try:
+                # 他に接続があれば WAL から戻せず "database is locked" になる
+                mode = old.execute("PRAGMA journal_mode=DELETE").fetchone()[0]
+                old.execute("BEGIN EXCLUSIVE")
+            except sqlite3.OperationalError as e:
+                raise DatabaseBusy(str(e))
+            if str(mode).lower() != "delete":
+                raise DatabaseBusy(f"journal_mode is still {mode}")
+            _remove(path + "-wal")
+            _remove(path + "-shm")
+            if os.name == "nt":
+                old.close()
+            try:
+                os.replace(tmp, path)
+            except PermissionError as e:
+                raise DatabaseBusy(str(e))
+        finally:
+            old.close()
+    finally:
+        _remove(tmp)
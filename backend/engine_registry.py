@@ -0,0 +1,183 @@
+"""
+アカウント毎DB（data/{hash}.db）の SQLAlchemy エンジン置き場。
+上限件数を超えたら最も使われていないものから dispose し、一定時間使われていないものも
+新規作成時（または evict_idle 呼び出し時）に dispose する。
+接続ごとに SQLite の PRAGMA（WAL など）を設定する。
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import create_engine, event
+
+# 接続ごとに設定する PRAGMA（journal_mode=WAL はファイルに記録されるが、毎回指定しても無害）
+# auto_vacuum はテーブルを作る前（journal_mode の切り替えより前）でないと効かないので先頭に置く。
+# 新しいDBだけが INCREMENTAL になり、既存のDBは maintenance.py が VACUUM で切り替える。
+DEFAULT_PRAGMAS = {
+    "auto_vacuum": "INCREMENTAL",
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "mmap_size": 64 * 1024 * 1024,
+    "cache_size": -8000,
+}
+
+
+def parse_pragmas(spec, base=None):
+    """"busy_timeout=10000,mmap_size=0" 形式の指定で base（既定 DEFAULT_PRAGMAS）を上書きした dict を返す。"""
+    pragmas = dict(DEFAULT_PRAGMAS if base is None else base)
+    for item in (spec or "").split(","):
+        key, sep, value = item.partition("=")
+        key = key.strip()
+        if not sep or not key.replace("_", "").isalnum():
+            continue
+        value = value.strip()
+        if value:
+            pragmas[key] = value
+        else:
+            pragmas.pop(key, None)
+    return pragmas
+
+
+def sqlite_uri(path):
+    return f"sqlite:///{path}".replace("\\", "/")
+
+
+def apply_pragmas(engine, pragmas):
+    """engine が新しく DB 接続を開くたびに pragmas を実行する。"""
+
+    @event.listens_for(engine, "connect")
+    def _set_pragmas(dbapi_conn, _record):
+        cur = dbapi_conn.cursor()
+        try:
+            for key, value in pragmas.items():
+                cur.execute(f"PRAGMA {key}={value}")
+        finally:
+            cur.close()
+
+    return engine
+
+
+class EngineRegistry:
+    """キー（username_to_db_key）→ エンジン。スレッドセーフで、件数上限とアイドル時間で破棄する。"""
+
+    def __init__(self, max_engines=64, idle_seconds=600, pragmas=None):
+        self.max_engines = max_engines
+        self.idle_seconds = idle_seconds
+        self.pragmas = dict(DEFAULT_PRAGMAS if pragmas is None else pragmas)
+        self._engines = OrderedDict()  # key -> (engine, last_used)、古い順
+        self._creating = {}  # key -> 作成中ロック
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _lookup_locked(self, key, now):
+        entry = self._engines.get(key)
+        if entry is None:
+            return None
+        self._engines[key] = (entry[0], now)
+        self._engines.move_to_end(key)
+        return entry[0]
+
+    def get(self, key, path, on_create=None):
+        """key のエンジンを返す。無ければ path に作成し、on_create(engine) を1回だけ呼ぶ。"""
+        with self._lock:
+            engine = self._lookup_locked(key, time.monotonic())
+            if engine is not None:
+                self.hits += 1
+                return engine
+            creating = self._creating.setdefault(key, threading.Lock())
+        # 同じキーの作成はキー毎のロックで1回に絞り、他ユーザの取得は待たせない
+        with creating:
+            with self._lock:
+                engine = self._lookup_locked(key, time.monotonic())
+                if engine is not None:
+                    self.hits += 1
+                    return engine
+                self.misses += 1
+            engine = apply_pragmas(
+                create_engine(
+                    sqlite_uri(path),
+                    connect_args={"check_same_thread": False},
+                ),
+                self.pragmas,
+            )
+            try:
+                if on_create is not None:
+                    on_create(engine)
+            except Exception:
+                engine.dispose()
+                with self._lock:
+                    self._creating.pop(key, None)
+                raise
+            with self._lock:
+                now = time.monotonic()
+                self._engines[key] = (engine, now)
+                self._creating.pop(key, None)
+                evicted = self._evict_locked(now, keep=key)
+        for old in evicted:
+            old.dispose()
+        return engine
+
+    def _evict_locked(self, now, keep=None):
+        evicted = []
+        for key in list(self._engines):
+            if key == keep:
+                continue
+            engine, last_used = self._engines[key]
+            idle = self.idle_seconds and now - last_used > self.idle_seconds
+            if idle or len(self._engines) > self.max_engines:
+                del self._engines[key]
+                evicted.append(engine)
+            else:
+                # 以降は新しいものだけ（OrderedDict は古い順）
+                break
+        self.evictions += len(evicted)
+        return evicted
+
+    def evict_idle(self):
+        """アイドル時間を過ぎたエンジンを破棄して、その数を返す。"""
+        with self._lock:
+            evicted = self._evict_locked(time.monotonic())
+        for engine in evicted:
+            engine.dispose()
+        return len(evicted)
+
+    def discard(self, key):
+        """key のエンジンを登録から外して dispose する（ファイル差し替え前など）。"""
+        with self._lock:
+            entry = self._engines.pop(key, None)
+        if entry is not None:
+            entry[0].dispose()
+            return True
+        return False
+
+    def dispose_all(self, close=True):
+        """全エンジンを破棄する。fork 直後の子プロセスでは close=False にして、
+        親から引き継いだ SQLite 接続を閉じずに手放す（親の接続・ロックに触れない）。"""
+        with self._lock:
+            engines = [e for e, _ in self._engines.values()]
+            self._engines.clear()
+            self._creating.clear()
+        for engine in engines:
+            engine.dispose(close=close)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._engines
+
+    def __len__(self):
+        with self._lock:
+            return len(self._engines)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "engines": len(self._engines),
+                "max_engines": self.max_engines,
+                "idle_seconds": self.idle_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,237 @@
+"""
+全アカウントのDB（data/*.db）をまとめて集計する管理用 CLI。
+ファイル毎の集計（オブジェクト数・行数・ファイルサイズ・キャンバス状態の大きさ）をプロセスプールで並列に行い、
+終わったものから順に出力して、最後に合計と行数の多い順の上位を出す。
+
+DB は読み取り専用（mode=ro）で開くので、サーバが動いていても書き込みを邪魔しない。
+--immutable はロックを取らずに読む（速いが、書き込み中のDBでは壊れた値になり得るので
+サーバを止めたバックアップなどに使う。-wal が残っているファイルは通常どおり読む）。--mmap-mb で PRAGMA mmap_size を指定する。
+
+  python fleet_report.py                          # data/*.db、CPU 数のプロセス
+  python fleet_report.py --format ndjson > report.ndjson
+  python fleet_report.py --workers 1 data/xxxx.db # 1プロセス（順番に）
+"""
+import argparse
+import glob
+import json
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from urllib.request import pathname2url
+
+from user_map import UserMap
+
+_CONTENTS_TABLE = "contents"
+_OBJECTS_TABLE = "content_objects"
+
+
+def _is_content_table_name(name):
+    # contents_store.is_content_table_name と同じ判定（SQLAlchemy を読み込まずに済むよう複製）
+    return bool(name) and "_" in name and name.split("_")[-1].isdigit()
+
+
+def _size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _connect(path, immutable=False, mmap_mb=0):
+    uri = f"file:{pathname2url(os.path.abspath(path))}?" + ("immutable=1" if immutable else "mode=ro")
+    conn = sqlite3.connect(uri, uri=True)
+    conn.execute("PRAGMA query_only=1")
+    if mmap_mb:
+        conn.execute(f"PRAGMA mmap_size={int(mmap_mb) * 1024 * 1024}")
+    return conn
+
+
+def _scalar(conn, sql, params=()):
+    row = conn.execute(sql, params).fetchone()
+    return row[0] if row else None
+
+
+def scan_database(path, immutable=False, mmap_mb=0):
+    """1ファイル分の集計を dict で返す。開けない・読めないときは error に理由を入れる。"""
+    started = time.perf_counter()
+    report = {
+        "file": os.path.basename(path),
+        "username": None,
+        "storage": None,
+        "objects": 0,
+        "rows": 0,
+        "db_bytes": _size(path),
+        "wal_bytes": _size(path + "-wal"),
+        "canvas_rev": 0,
+        "canvas_bytes": 0,
+        "canvas_patch_bytes": 0,
+        "history_bytes": 0,
+        "error": None,
+    }
+    try:
+        # -wal に未反映の書き込みがあると immutable では見えないので、そのファイルは通常の読み取りにする
+        conn = _connect(path, immutable=immutable and not report["wal_bytes"], mmap_mb=mmap_mb)
+    except sqlite3.Error as e:
+        report["error"] = str(e)
+        return report
+    try:
+        # 読み取りを1つのスナップショットにまとめる（途中で書き込まれても数が食い違わない）
+        conn.execute("BEGIN")
+        tables = {
+            name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")
+        }
+        if "meta" in tables:
+            meta = dict(conn.execute(
+                "SELECT key, value FROM meta WHERE key IN ('username', 'storage_mode')"
+            ).fetchall())
+            report["username"] = meta.get("username")
+            report["storage"] = meta.get("storage_mode")
+        if report["storage"] is None:
+            report["storage"] = "single" if _OBJECTS_TABLE in tables else "tables"
+        if report["storage"] == "single":
+            if _OBJECTS_TABLE in tables:
+                report["objects"] = _scalar(conn, f"SELECT COUNT(*) FROM {_OBJECTS_TABLE}")
+            if _CONTENTS_TABLE in tables:
+                report["rows"] = _scalar(conn, f"SELECT COUNT(*) FROM {_CONTENTS_TABLE}")
+        else:
+            content_tables = sorted(t for t in tables if _is_content_table_name(t))
+            report["objects"] = len(content_tables)
+            report["rows"] = sum(
+                _scalar(conn, f'SELECT COUNT(*) FROM "{t}"') for t in content_tables
+            )
+        if "canvas_state" in tables:
+            cols = {r[1] for r in conn.execute("PRAGMA table_info(canvas_state)")}
+            rev = "rev" if "rev" in cols else "0"
+            row = conn.execute(
+                f"SELECT COALESCE(LENGTH(CAST(state AS BLOB)), 0), {rev} FROM canvas_state WHERE id = 1"
+            ).fetchone()
+            if row:
+                report["canvas_bytes"], report["canvas_rev"] = row[0], row[1] or 0
+        if "canvas_patches" in tables:
+            report["canvas_patch_bytes"] = _scalar(
+                conn, "SELECT COALESCE(SUM(LENGTH(CAST(ops AS BLOB))), 0) FROM canvas_patches"
+            )
+        if "canvas_history" in tables:
+            report["history_bytes"] = _scalar(
+                conn, "SELECT COALESCE(SUM(LENGTH(data)), 0) FROM canvas_history"
+            )
+    except sqlite3.Error as e:
+        report["error"] = str(e)
+    finally:
+        conn.close()
+    report["seconds"] = round(time.perf_counter() - started, 4)
+    return report
+
+
+def scan_fleet(paths, workers=None, immutable=False, mmap_mb=0):
+    """paths を並列に集計し、終わったものから報告を yield する（順番はファイル順ではない）。"""
+    if workers == 1 or len(paths) <= 1:
+        for path in paths:
+            yield scan_database(path, immutable, mmap_mb)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(scan_database, p, immutable, mmap_mb): p for p in paths}
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as e:
+                path = futures[future]
+                yield {"file": os.path.basename(path), "error": f"worker failed: {e}"}
+
+
+class FleetSummary:
+    """報告を1件ずつ受け取って合計と上位を持つ"""
+
+    _TOTALS = ("objects", "rows", "db_bytes", "wal_bytes", "canvas_bytes", "canvas_patch_bytes", "history_bytes")
+
+    def __init__(self, top=10):
+        self.top = top
+        self.databases = 0
+        self.errors = 0
+        self.storage = {}
+        self.totals = dict.fromkeys(self._TOTALS, 0)
+        self._largest = []
+
+    def add(self, report):
+        self.databases += 1
+        if report.get("error"):
+            self.errors += 1
+            return
+        for key in self._TOTALS:
+            self.totals[key] += report.get(key) or 0
+        self.storage[report["storage"]] = self.storage.get(report["storage"], 0) + 1
+        self._largest.append((report["rows"], report["db_bytes"], report["file"], report["username"]))
+        if len(self._largest) > self.top * 4:
+            self._largest = sorted(self._largest, reverse=True)[: self.top]
+
+    def largest(self):
+        return [
+            {"file": f, "username": u, "rows": rows, "db_bytes": size}
+            for rows, size, f, u in sorted(self._largest, reverse=True)[: self.top]
+        ]
+
+    def as_dict(self):
+        return dict(
+            self.totals,
+            type="summary",
+            databases=self.databases,
+            errors=self.errors,
+            storage=self.storage,
+            largest=self.largest(),
+        )
+
+
+def main(argv=None):
+    backend_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="全アカウントのDBの集計（オブジェクト数・行数・サイズ）")
+    parser.add_argument("paths", nargs="*", help="対象の .db（省略時は data/*.db すべて）")
+    parser.add_argument("--data-dir", default=os.path.join(backend_dir, "data"))
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="プロセス数（1 なら並列にしない）")
+    parser.add_argument("--immutable", action="store_true", help="ロックを取らずに読む（書き込みの無いDBのみ）")
+    parser.add_argument("--mmap-mb", type=int, default=0, help="PRAGMA mmap_size（MB）")
+    parser.add_argument("--top", type=int, default=10, help="行数の多い順に表示する件数")
+    parser.add_argument("--format", choices=("text", "ndjson"), default="text")
+    args = parser.parse_args(argv)
+
+    paths = args.paths or sorted(
+        p for p in glob.glob(os.path.join(args.data_dir, "*.db"))
+        if not os.path.basename(p).startswith(".")
+    )
+    # meta に username が無い古いDB用に user_map.json から引く
+    usernames = {f: u for u, f in UserMap(os.path.join(args.data_dir, "user_map.json")).items()}
+    summary = FleetSummary(top=args.top)
+    started = time.perf_counter()
+    for report in scan_fleet(paths, args.workers, args.immutable, args.mmap_mb):
+        if not report.get("username"):
+            report["username"] = usernames.get(report["file"])
+        summary.add(report)
+        if args.format == "ndjson":
+            print(json.dumps(dict(report, type="database"), ensure_ascii=False), flush=True)
+        elif report.get("error"):
+            print(f"{report['file']}: error: {report['error']}", flush=True)
+        else:
+            print(
+                f"{report['file']} ({report['username'] or '?'}): {report['objects']} objects, "
+                f"{report['rows']} rows, {report['db_bytes'] // 1024} KB, canvas {report['canvas_bytes']} bytes",
+                flush=True,
+            )
+    result = summary.as_dict()
+    result["seconds"] = round(time.perf_counter() - started, 3)
+    if args.format == "ndjson":
+        print(json.dumps(result, ensure_ascii=False))
+        return 0
+    print(
+        f"\n{result['databases']} databases ({result['errors']} errors) in {result['seconds']} s: "
+        f"{result['objects']} objects, {result['rows']} rows, "
+        f"{result['db_bytes'] // 1024} KB (+{result['wal_bytes'] // 1024} KB wal), "
+        f"canvas {result['canvas_bytes'] // 1024} KB, history {result['history_bytes'] // 1024} KB"
+    )
+    for i, item in enumerate(result["largest"], 1):
+        print(f"{i:>3}. {item['file']} ({item['username'] or '?'}): {item['rows']} rows, {item['db_bytes'] // 1024} KB")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,41 @@
+"""
+gunicorn の設定（python serve.py から、または gunicorn -c gunicorn.conf.py wsgi:app で使う）。
+値は環境変数で変えられる:
+  SUMAPURO_BIND=127.0.0.1:5000  SUMAPURO_WORKERS=2  SUMAPURO_THREADS=4  SUMAPURO_TIMEOUT=30
+  SUMAPURO_PRELOAD=1（親プロセスで app を読み込んでから fork する）
+"""
+import os
+import sys
+
+chdir = os.path.dirname(os.path.abspath(__file__))
+bind = os.getenv("SUMAPURO_BIND", "127.0.0.1:5000")
+workers = int(os.getenv("SUMAPURO_WORKERS", "2"))
+threads = int(os.getenv("SUMAPURO_THREADS", "4"))
+worker_class = "gthread"
+timeout = int(os.getenv("SUMAPURO_TIMEOUT", "30"))
+graceful_timeout = timeout
+preload_app = os.getenv("SUMAPURO_PRELOAD", "0") == "1"
+accesslog = "-" if os.getenv("SUMAPURO_ACCESS_LOG", "0") == "1" else None
+
+# app.py に gunicorn 配下であることを伝える（保守のスレッドは読み込み時ではなく post_worker_init で始める）
+os.environ["SUMAPURO_GUNICORN"] = "1"
+
+# 検索キャッシュの無効化を他のワーカーにも伝えるため、複数ワーカーでは世代をDBに置く
+if workers > 1:
+    os.environ.setdefault("SUMAPURO_SEARCH_CACHE_SHARED", "1")
+
+
+def post_fork(server, worker):
+    """preload で親が app を読み込んでいた場合、引き継いだ SQLite 接続を子で使わないよう手放す。"""
+    app_module = sys.modules.get("app")
+    if app_module is None:
+        return
+    app_module._user_engines.dispose_all(close=False)
+    app_module.accounts.reset_after_fork()
+
+
+def post_worker_init(worker):
+    """ワーカーで app を読み込んだ後に保守の巡回を始める（親プロセスでは始めない。巡回するのはロックを取れた1つだけ）。"""
+    app_module = sys.modules.get("app")
+    if app_module is not None and app_module.app.config["SUMAPURO_MAINTENANCE"]:
+        app_module.maintenance.start()
@@ -0,0 +1,62 @@
+"""
+JWT（jti）→ 解決済みのユーザー情報（username, DBキー）のプロセス内キャッシュ。
+同じトークンの2回目以降のリクエストでは identity の解釈と SHA-256 を省き、辞書を引くだけにする。
+エントリはトークンの有効期限か ttl_seconds の早い方で切れ、ログアウトで消す。
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class IdentityCache:
+    """jti → 値（LRU・期限付き）。max_entries が 0 なら何も覚えない。"""
+
+    def __init__(self, max_entries=4096, ttl_seconds=300):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # jti -> (期限の epoch 秒, 値)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, jti):
+        if not jti or self.max_entries <= 0:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(jti)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._entries[jti]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(jti)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, jti, value, expires_at=None):
+        """expires_at はトークンの exp（epoch 秒）。"""
+        if not jti or self.max_entries <= 0:
+            return
+        deadline = time.time() + self.ttl_seconds
+        if expires_at:
+            deadline = min(deadline, expires_at)
+        with self._lock:
+            self._entries[jti] = (deadline, value)
+            self._entries.move_to_end(jti)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, jti):
+        with self._lock:
+            return self._entries.pop(jti, None) is not None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
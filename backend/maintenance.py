@@ -0,0 +1,281 @@
+"""
+アカウント毎DB（data/*.db）の保守。書き込みが止まっている（idle な）DBに対して
+  - WAL のチェックポイント（TRUNCATE。読み取り中の接続があれば諦めて次の巡回へ）
+  - 空きページの回収（auto_vacuum=INCREMENTAL なら incremental_vacuum。未設定の古いDBは予算内なら1回だけ
+    VACUUM して INCREMENTAL に切り替える）
+  - 統計の更新（sqlite_stat1 が無い・SUMAPURO_MAINT_ANALYZE_HOURS より古いときに analysis_limit 付きの ANALYZE、
+    毎回 PRAGMA optimize）
+を行う。1回の巡回で読み書きする量（見積もり）は SUMAPURO_MAINT_IO_BUDGET_MB までで、残りは次の巡回に回す。
+保守用の接続は busy_timeout=0 で開き、ロックが取れなければその DB は飛ばす（利用中のリクエストを待たせない）。
+前回の保守から -wal・本体とも変わっていないファイルは開かない。
+
+  サーバ内: SUMAPURO_MAINTENANCE=1 で SUMAPURO_MAINT_INTERVAL 秒毎に巡回する
+            （複数ワーカーでも data/.maintenance.lock を取れた1つだけが動く）
+  単独:     python maintenance.py                    # data/*.db を1回巡回
+            python maintenance.py --idle 0 --budget-mb 512 data/xxxx.db
+"""
+import argparse
+import glob
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from user_map import file_lock
+
+MAINT_INTERVAL = int(os.getenv("SUMAPURO_MAINT_INTERVAL", "300"))
+# 最後の書き込みからこの秒数が過ぎたDBだけを対象にする
+MAINT_IDLE_SECONDS = int(os.getenv("SUMAPURO_MAINT_IDLE_SECONDS", "60"))
+MAINT_IO_BUDGET_MB = int(os.getenv("SUMAPURO_MAINT_IO_BUDGET_MB", "64"))
+# 空きページがこの割合以上（かつ MIN_FREE_PAGES 以上）なら回収する
+MAINT_FREE_RATIO = float(os.getenv("SUMAPURO_MAINT_FREE_RATIO", "0.1"))
+MAINT_MIN_FREE_PAGES = 64
+MAINT_ANALYZE_HOURS = int(os.getenv("SUMAPURO_MAINT_ANALYZE_HOURS", "24"))
+# incremental_vacuum を1回（1トランザクション）で回収するページ数。間に他の書き込みが入れる
+_VACUUM_STEP_PAGES = 256
+_ANALYSIS_LIMIT = 400
+
+
+def _size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _fingerprint(path):
+    """本体と -wal の (サイズ, 更新時刻)。変わっていなければ前回の保守以降書き込みが無い。"""
+    result = []
+    for p in (path, path + "-wal"):
+        try:
+            st = os.stat(p)
+            result.append((st.st_size, st.st_mtime_ns))
+        except OSError:
+            result.append(None)
+    return tuple(result)
+
+
+def _last_write(path):
+    times = []
+    for p in (path, path + "-wal"):
+        try:
+            times.append(os.path.getmtime(p))
+        except OSError:
+            pass
+    return max(times) if times else 0
+
+
+def _pragma(conn, name):
+    return conn.execute(f"PRAGMA {name}").fetchone()[0]
+
+
+def inspect_database(conn, path):
+    """保守の判断に使う値（空きページの割合など）"""
+    page_size = _pragma(conn, "page_size")
+    page_count = _pragma(conn, "page_count")
+    freelist = _pragma(conn, "freelist_count")
+    return {
+        "page_size": page_size,
+        "page_count": page_count,
+        "free_pages": freelist,
+        "free_ratio": round(freelist / page_count, 4) if page_count else 0.0,
+        "auto_vacuum": _pragma(conn, "auto_vacuum"),
+        "wal_bytes": _size(path + "-wal"),
+    }
+
+
+def _needs_analyze(conn, now):
+    if conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='sqlite_stat1'"
+    ).fetchone() is None:
+        return True
+    try:
+        row = conn.execute("SELECT value FROM meta WHERE key = 'analyzed_at'").fetchone()
+    except sqlite3.OperationalError:
+        return True
+    return row is None or now - float(row[0]) >= MAINT_ANALYZE_HOURS * 3600
+
+
+def maintain_database(path, budget_bytes, now=None):
+    """1ファイル分の保守。(報告 dict, 使った I/O の見積もりバイト数) を返す。"""
+    now = time.time() if now is None else now
+    conn = sqlite3.connect(path, timeout=0, isolation_level=None)
+    actions = []
+    spent = 0
+    try:
+        conn.execute("PRAGMA busy_timeout=0")
+        info = inspect_database(conn, path)
+        page_size = info["page_size"]
+
+        def checkpoint():
+            nonlocal spent
+            wal = _size(path + "-wal")
+            if not wal or spent + wal > budget_bytes:
+                return
+            busy, _, _ = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+            actions.append("checkpoint_busy" if busy else "checkpoint")
+            spent += wal
+
+        checkpoint()
+        free_pages = info["free_pages"]
+        if free_pages >= MAINT_MIN_FREE_PAGES and info["free_ratio"] >= MAINT_FREE_RATIO:
+            if info["auto_vacuum"] == 2:
+                pages = min(free_pages, (budget_bytes - spent) // page_size)
+                reclaimed = 0
+                while reclaimed < pages:
+                    step = min(_VACUUM_STEP_PAGES, pages - reclaimed)
+                    # execute() だと1ページ分しか進まないので、最後まで実行する executescript を使う
+                    conn.executescript(f"PRAGMA incremental_vacuum({step});")
+                    reclaimed += step
+                if reclaimed:
+                    actions.append(f"incremental_vacuum:{reclaimed}")
+                    spent += reclaimed * page_size
+            elif spent + 2 * info["page_count"] * page_size <= budget_bytes:
+                # 古いDB: 全体を書き直すので読み書き2回分を予算から引く
+                conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                conn.execute("VACUUM")
+                actions.append("vacuum")
+                spent += 2 * info["page_count"] * page_size
+            checkpoint()
+        if _needs_analyze(conn, now):
+            conn.execute(f"PRAGMA analysis_limit={_ANALYSIS_LIMIT}")
+            conn.execute("ANALYZE")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('analyzed_at', ?)", (str(now),)
+            )
+            actions.append("analyze")
+        conn.execute("PRAGMA optimize")
+    except sqlite3.OperationalError as e:
+        # 使用中（database is locked など）。ここまでの分だけ報告し、残りは次の巡回で
+        actions.append(f"skipped:{e}")
+    finally:
+        conn.close()
+    report = dict(info, actions=actions, db_bytes=_size(path), at=now)
+    return report, spent
+
+
+class MaintenanceScheduler:
+    """data_dir の *.db を巡回して保守する。start() でバックグラウンドのスレッドを動かす。"""
+
+    def __init__(
+        self,
+        data_dir,
+        interval=MAINT_INTERVAL,
+        idle_seconds=MAINT_IDLE_SECONDS,
+        budget_mb=MAINT_IO_BUDGET_MB,
+    ):
+        self.data_dir = data_dir
+        self.interval = interval
+        self.idle_seconds = idle_seconds
+        self.budget_bytes = budget_mb * 1024 * 1024
+        self._fingerprints = {}  # path -> 保守直後の _fingerprint
+        self._reports = {}  # path -> 直近の報告
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.cycles = 0
+        self.maintained = 0
+        self.skipped_active = 0
+        self.bytes_spent = 0
+
+    def run_cycle(self, paths=None):
+        """1回巡回して、保守したファイル数を返す。書き込み中のDBと前回から変わっていないDBは飛ばす。"""
+        if paths is None:
+            paths = sorted(glob.glob(os.path.join(self.data_dir, "*.db")))
+        now = time.time()
+        candidates = []
+        for path in paths:
+            if os.path.basename(path).startswith("."):
+                continue
+            fingerprint = _fingerprint(path)
+            if self._fingerprints.get(path) == fingerprint:
+                continue
+            if now - _last_write(path) < self.idle_seconds:
+                with self._lock:
+                    self.skipped_active += 1
+                continue
+            candidates.append(path)
+        # 回収できる量が多いもの（-wal が大きいもの）から
+        candidates.sort(key=lambda p: _size(p + "-wal") + _size(p) // 16, reverse=True)
+        budget = self.budget_bytes
+        done = 0
+        for path in candidates:
+            if budget <= 0:
+                break
+            report, spent = maintain_database(path, budget, now)
+            budget -= spent
+            done += 1
+            if not any(a.startswith("skipped") for a in report["actions"]):
+                self._fingerprints[path] = _fingerprint(path)
+            with self._lock:
+                self._reports[path] = report
+                self.maintained += 1
+                self.bytes_spent += spent
+        with self._lock:
+            self.cycles += 1
+        return done
+
+    def _loop(self):
+        lock_path = os.path.join(self.data_dir, ".maintenance.lock")
+        while not self._stop.wait(self.interval):
+            try:
+                os.makedirs(self.data_dir, exist_ok=True)
+                with file_lock(lock_path, blocking=False) as acquired:
+                    if acquired:
+                        self.run_cycle()
+            except Exception as e:
+                print("[maintenance] cycle failed:", e)
+
+    def start(self):
+        """バックグラウンドで巡回を始める（動いていれば何もしない。fork 後の子で呼び直してよい）。"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="maintenance", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def reports(self):
+        """ファイル毎の直近の報告（空きページの割合・-wal の大きさ・実行した処理）"""
+        with self._lock:
+            return {os.path.basename(p): dict(r) for p, r in self._reports.items()}
+
+    def stats(self):
+        with self._lock:
+            return {
+                "running": self._thread is not None and self._thread.is_alive(),
+                "cycles": self.cycles,
+                "maintained": self.maintained,
+                "skipped_active": self.skipped_active,
+                "bytes_spent": self.bytes_spent,
+            }
+
+
+def main(argv=None):
+    backend_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="アカウント毎DBの保守（チェックポイント・空き領域の回収・統計の更新）")
+    parser.add_argument("paths", nargs="*", help="対象の .db（省略時は data/*.db すべて）")
+    parser.add_argument("--data-dir", default=os.path.join(backend_dir, "data"))
+    parser.add_argument("--budget-mb", type=int, default=MAINT_IO_BUDGET_MB, help="1回の巡回の I/O 予算（MB）")
+    parser.add_argument("--idle", type=int, default=MAINT_IDLE_SECONDS, help="この秒数書き込みが無いDBだけを対象にする")
+    args = parser.parse_args(argv)
+
+    scheduler = MaintenanceScheduler(args.data_dir, idle_seconds=args.idle, budget_mb=args.budget_mb)
+    scheduler.run_cycle(args.paths or None)
+    for name, report in sorted(scheduler.reports().items()):
+        print(
+            f"{name}: {report['db_bytes']} bytes, free {report['free_ratio']:.1%}, "
+            f"{', '.join(report['actions']) or 'nothing to do'}"
+        )
+    stats = scheduler.stats()
+    print(f"{stats['maintained']} maintained, {stats['skipped_active']} skipped (active), "
+          f"{stats['bytes_spent'] // 1024} KB of I/O")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
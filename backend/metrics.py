@@ -0,0 +1,282 @@
+"""
+リクエスト毎の計測（SUMAPURO_METRICS=1 のときだけ有効）。
+  - ルート毎のレイテンシのヒストグラムとステータス毎の件数
+  - SQL の文の数と時間（種類別: select / insert / update / delete / schema / other）
+  - 時間の内訳（jwt: トークン検証まで / engine: get_engine_for_user / sql / json: レスポンスの JSON 化）
+  - エンジン置き場・検索キャッシュの統計
+を GET /metrics に Prometheus のテキスト形式で出す。
+全アカウント分の統計なので、SUMAPURO_METRICS_TOKEN があれば Authorization: Bearer <token> を求め、
+無ければ同じマシン（127.0.0.1 / ::1）からの要求にだけ答える。
+
+SUMAPURO_PROFILE_SAMPLE（0〜1）を指定すると、その割合のリクエストを cProfile で測り、
+遅かった上位 SUMAPURO_PROFILE_KEEP 件を SUMAPURO_PROFILE_DIR に .prof で残す
+（python -m pstats などで開く）。
+"""
+import cProfile
+import hmac
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from flask import Response, g, has_request_context, jsonify, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# レイテンシのバケット（秒）
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_LOOPBACK = ("127.0.0.1", "::1")
+
+
+def _request_state():
+    if not has_request_context():
+        return None
+    return g.get("_metrics")
+
+
+@contextmanager
+def phase(name):
+    """計測中のリクエスト内なら、ブロックの所要時間を内訳 name に加える（無効時は何もしない）"""
+    state = _request_state()
+    if state is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        state["phases"][name] += time.perf_counter() - start
+
+
+def _statement_kind(statement):
+    head = statement.lstrip()[:16].upper()
+    if "SQLITE_MASTER" in statement.upper() or head.startswith(("CREATE", "DROP", "ALTER", "PRAGMA")):
+        return "schema"
+    for kind in ("SELECT", "INSERT", "UPDATE", "DELETE"):
+        if head.startswith(kind):
+            return kind.lower()
+    if head.startswith("WITH"):
+        return "select"
+    return "other"
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    """計測値の置き場（スレッドセーフ）"""
+
+    def __init__(self, profile_sample=0.0, profile_dir=None, profile_keep=10):
+        self._lock = threading.Lock()
+        self.requests = defaultdict(int)  # (route, method, status) -> 件数
+        self.histograms = {}  # (route, method) -> [バケット毎の件数..., 合計秒, 件数]
+        self.sql = defaultdict(lambda: [0, 0.0])  # (route, kind) -> [文の数, 秒]
+        self.phases = defaultdict(float)  # (route, phase) -> 秒
+        self.sources = []  # (接頭辞, 統計 dict を返す関数)
+        self.profile_sample = profile_sample
+        self.profile_dir = profile_dir
+        self.profile_keep = profile_keep
+        self._profile_lock = threading.Lock()
+        self._profiles = []  # (秒, パス)、遅い順
+        self.profiles_written = 0
+
+    def add_source(self, prefix, stats):
+        """stats() の数値をそのまま prefix_<キー> として出す"""
+        self.sources.append((prefix, stats))
+
+    def observe_request(self, route, method, status, seconds, state):
+        with self._lock:
+            self.requests[(route, method, status)] += 1
+            hist = self.histograms.get((route, method))
+            if hist is None:
+                hist = self.histograms[(route, method)] = [0] * len(BUCKETS) + [0.0, 0]
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    hist[i] += 1
+            hist[-2] += seconds
+            hist[-1] += 1
+            for kind, (count, total) in state["sql"].items():
+                entry = self.sql[(route, kind)]
+                entry[0] += count
+                entry[1] += total
+            for name, total in state["phases"].items():
+                self.phases[(route, name)] += total
+
+    def observe_sql(self, kind, seconds):
+        state = _request_state()
+        if state is not None:
+            entry = state["sql"][kind]
+            entry[0] += 1
+            entry[1] += seconds
+            state["phases"]["sql"] += seconds
+            return
+        # リクエスト外（CLI・初期化など）
+        with self._lock:
+            entry = self.sql[("background", kind)]
+            entry[0] += 1
+            entry[1] += seconds
+
+    # --- cProfile ---
+
+    def start_profile(self):
+        """このリクエストを測るなら Profile を返す（同時に測るのは1件だけ）"""
+        if self.profile_sample <= 0 or random.random() >= self.profile_sample:
+            return None
+        if not self._profile_lock.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def finish_profile(self, profile, route, seconds):
+        profile.disable()
+        self._profile_lock.release()
+        with self._lock:
+            if len(self._profiles) >= self.profile_keep and seconds <= self._profiles[-1][0]:
+                return
+        os.makedirs(self.profile_dir, exist_ok=True)
+        name = "{}-{}-{}ms.prof".format(
+            time.strftime("%Y%m%d-%H%M%S"),
+            route.strip("/").replace("/", "_").replace("<", "").replace(">", "") or "root",
+            int(seconds * 1000),
+        )
+        path = os.path.join(self.profile_dir, name)
+        profile.dump_stats(path)
+        with self._lock:
+            self._profiles.append((seconds, path))
+            self._profiles.sort(reverse=True)
+            dropped = self._profiles[self.profile_keep :]
+            del self._profiles[self.profile_keep :]
+            self.profiles_written += 1
+        for _, old in dropped:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+
+    # --- 出力 ---
+
+    def render(self):
+        """Prometheus のテキスト形式"""
+        lines = []
+        with self._lock:
+            lines.append("# HELP sumapuro_http_requests_total Requests by route, method and status.")
+            lines.append("# TYPE sumapuro_http_requests_total counter")
+            for (route, method, status), n in sorted(self.requests.items()):
+                lines.append(
+                    f'sumapuro_http_requests_total{{route="{_label(route)}",method="{method}",status="{status}"}} {n}'
+                )
+            lines.append("# HELP sumapuro_http_request_duration_seconds Request latency.")
+            lines.append("# TYPE sumapuro_http_request_duration_seconds histogram")
+            for (route, method), hist in sorted(self.histograms.items()):
+                labels = f'route="{_label(route)}",method="{method}"'
+                for bound, n in zip(BUCKETS, hist):
+                    lines.append(
+                        f'sumapuro_http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {n}'
+                    )
+                lines.append(
+                    f'sumapuro_http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {hist[-1]}'
+                )
+                lines.append(f"sumapuro_http_request_duration_seconds_sum{{{labels}}} {hist[-2]:.6f}")
+                lines.append(f"sumapuro_http_request_duration_seconds_count{{{labels}}} {hist[-1]}")
+            lines.append("# HELP sumapuro_sql_statements_total SQL statements by route and kind.")
+            lines.append("# TYPE sumapuro_sql_statements_total counter")
+            for (route, kind), (n, _) in sorted(self.sql.items()):
+                lines.append(
+                    f'sumapuro_sql_statements_total{{route="{_label(route)}",kind="{kind}"}} {n}'
+                )
+            lines.append("# HELP sumapuro_sql_seconds_total Time spent in SQL by route and kind.")
+            lines.append("# TYPE sumapuro_sql_seconds_total counter")
+            for (route, kind), (_, seconds) in sorted(self.sql.items()):
+                lines.append(
+                    f'sumapuro_sql_seconds_total{{route="{_label(route)}",kind="{kind}"}} {seconds:.6f}'
+                )
+            lines.append("# HELP sumapuro_phase_seconds_total Time spent per request phase.")
+            lines.append("# TYPE sumapuro_phase_seconds_total counter")
+            for (route, name), seconds in sorted(self.phases.items()):
+                lines.append(
+                    f'sumapuro_phase_seconds_total{{route="{_label(route)}",phase="{name}"}} {seconds:.6f}'
+                )
+            lines.append("# TYPE sumapuro_profiles_written_total counter")
+            lines.append(f"sumapuro_profiles_written_total {self.profiles_written}")
+        for prefix, stats in self.sources:
+            for key, value in sorted(stats().items()):
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                lines.append(f"sumapuro_{prefix}_{key} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def init_metrics(app, jwt, metrics, token=""):
+    """app に計測用のフック・SQL イベント・JSON 化の計測・GET /metrics を登録する。
+    token が空なら /metrics は同じマシンからだけ読める"""
+
+    @app.before_request
+    def _start_request():
+        g._metrics = {
+            "start": time.perf_counter(),
+            "route": request.url_rule.rule if request.url_rule else "unmatched",
+            "status": 500,
+            "sql": defaultdict(lambda: [0, 0.0]),
+            "phases": defaultdict(float),
+            "profile": metrics.start_profile(),
+        }
+
+    @app.after_request
+    def _record_status(response):
+        state = _request_state()
+        if state is not None:
+            state["status"] = response.status_code
+        return response
+
+    @app.teardown_request
+    def _finish_request(_exc):
+        state = g.pop("_metrics", None)
+        if state is None:
+            return
+        seconds = time.perf_counter() - state["start"]
+        if state["profile"] is not None:
+            metrics.finish_profile(state["profile"], state["route"], seconds)
+        metrics.observe_request(state["route"], request.method, state["status"], seconds, state)
+
+    # トークンの検証（デコード）が終わった時点までを jwt の内訳にする
+    @jwt.token_verification_loader
+    def _mark_jwt_verified(_header, _payload):
+        state = _request_state()
+        if state is not None and "jwt" not in state["phases"]:
+            state["phases"]["jwt"] = time.perf_counter() - state["start"]
+        return True
+
+    @event.listens_for(Engine, "before_cursor_execute")
+    def _before_cursor(conn, _cursor, _statement, _params, _context, _many):
+        conn.info.setdefault("_metrics_start", []).append(time.perf_counter())
+
+    @event.listens_for(Engine, "after_cursor_execute")
+    def _after_cursor(conn, _cursor, statement, _params, _context, _many):
+        starts = conn.info.get("_metrics_start")
+        if starts:
+            metrics.observe_sql(_statement_kind(statement), time.perf_counter() - starts.pop())
+
+    provider_class = type(app.json)
+
+    class TimedJSONProvider(provider_class):
+        def dumps(self, obj, **kwargs):
+            with phase("json"):
+                return super().dumps(obj, **kwargs)
+
+    app.json = TimedJSONProvider(app)
+
+    @app.route("/metrics", methods=["GET"])
+    def prometheus_metrics():
+        if token:
+            given = request.headers.get("Authorization", "")
+            if not hmac.compare_digest(given.encode(), f"Bearer {token}".encode()):
+                return jsonify({"error": "unauthorized"}), 401
+        elif request.remote_addr not in _LOOPBACK:
+            return jsonify({"error": "forbidden"}), 403
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+    return metrics
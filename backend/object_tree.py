@@ -0,0 +1,164 @@
+"""
+オブジェクトの入れ子関係（部屋 > 押し入れ > 箱 …）の表（アカウント毎DB）。
+中身行の parent_table_name からオブジェクト単位の親子を object_tree に持ち、
+部分木・祖先の取得は再帰 CTE 1回で行う（parent_table_name に索引あり）。
+同期は contents_store.ContentStore が行う（初回に既存の中身から構築する）。
+"""
+from sqlalchemy import text
+
+from rollups import ROLLUP_OBJECTS_TABLE
+
+OBJECT_TREE_TABLE = "object_tree"
+OBJECT_TREE_VERSION = "1"
+# 壊れたデータで親子が循環していても止まるよう、たどる深さに上限を置く
+MAX_DEPTH = 64
+
+
+def _create_tree_table(conn):
+    conn.execute(
+        text(
+            f"CREATE TABLE IF NOT EXISTS {OBJECT_TREE_TABLE} ("
+            "table_name TEXT PRIMARY KEY, "
+            "parent_table_name TEXT) WITHOUT ROWID"
+        )
+    )
+    conn.execute(
+        text(
+            f"CREATE INDEX IF NOT EXISTS idx_{OBJECT_TREE_TABLE}_parent "
+            f"ON {OBJECT_TREE_TABLE} (parent_table_name)"
+        )
+    )
+
+
+def ensure_object_tree(conn, object_names, iter_links):
+    """表が無ければ作成し、既存の中身から構築する。
+    object_names() は全オブジェクト名、iter_links() は (table_name, parent_table_name)。"""
+    conn.execute(
+        text("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    )
+    version = conn.execute(text("SELECT value FROM meta WHERE key = 'object_tree'")).scalar()
+    if version == OBJECT_TREE_VERSION:
+        return True
+    _create_tree_table(conn)
+    conn.execute(text(f"DELETE FROM {OBJECT_TREE_TABLE}"))
+    for table_name in object_names():
+        register_object(conn, table_name)
+    for table_name, parent_table_name in iter_links():
+        set_parent(conn, table_name, parent_table_name)
+    conn.execute(
+        text("INSERT OR REPLACE INTO meta (key, value) VALUES ('object_tree', :v)"),
+        {"v": OBJECT_TREE_VERSION},
+    )
+    return True
+
+
+def drop_object_tree(conn):
+    """表を削除する（次回の ensure_object_tree で作り直す）。"""
+    conn.execute(text(f"DROP TABLE IF EXISTS {OBJECT_TREE_TABLE}"))
+    conn.execute(
+        text("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    )
+    conn.execute(text("DELETE FROM meta WHERE key = 'object_tree'"))
+
+
+def register_object(conn, table_name):
+    conn.execute(
+        text(f"INSERT OR IGNORE INTO {OBJECT_TREE_TABLE} (table_name) VALUES (:t)"),
+        {"t": table_name},
+    )
+
+
+def set_parent(conn, table_name, parent_table_name):
+    """table_name の親を記録する（自分自身を親にはしない）。"""
+    if not parent_table_name or parent_table_name == table_name:
+        return
+    conn.execute(
+        text(
+            f"INSERT INTO {OBJECT_TREE_TABLE} (table_name, parent_table_name) VALUES (:t, :p) "
+            "ON CONFLICT (table_name) DO UPDATE SET parent_table_name = excluded.parent_table_name"
+        ),
+        {"t": table_name, "p": parent_table_name},
+    )
+
+
+def remove_object(conn, table_name):
+    """オブジェクト削除時: 自分の行を消し、子は最上位に戻す。"""
+    conn.execute(
+        text(f"DELETE FROM {OBJECT_TREE_TABLE} WHERE table_name = :t"), {"t": table_name}
+    )
+    conn.execute(
+        text(
+            f"UPDATE {OBJECT_TREE_TABLE} SET parent_table_name = NULL "
+            "WHERE parent_table_name = :t"
+        ),
+        {"t": table_name},
+    )
+
+
+def subtree(conn, root=None):
+    """root 以下（None なら全体）を (table_name, object_name, parent_table_name, depth) で返す。
+    親が登録されていないオブジェクトは最上位として扱う。"""
+    if root is None:
+        start = (
+            f"SELECT o.table_name, o.parent_table_name, 0 FROM {OBJECT_TREE_TABLE} o "
+            f"LEFT JOIN {OBJECT_TREE_TABLE} p ON p.table_name = o.parent_table_name "
+            "WHERE p.table_name IS NULL"
+        )
+        params = {}
+    else:
+        start = (
+            f"SELECT table_name, parent_table_name, 0 FROM {OBJECT_TREE_TABLE} "
+            "WHERE table_name = :root"
+        )
+        params = {"root": root}
+    sql = (
+        f"WITH RECURSIVE tree(table_name, parent_table_name, depth) AS ({start} "
+        f"UNION SELECT c.table_name, c.parent_table_name, tree.depth + 1 "
+        f"FROM {OBJECT_TREE_TABLE} c JOIN tree ON c.parent_table_name = tree.table_name "
+        f"WHERE tree.depth < {MAX_DEPTH}) "
+        f"SELECT tree.table_name, r.object_name, tree.parent_table_name, MIN(tree.depth) "
+        f"FROM tree LEFT JOIN {ROLLUP_OBJECTS_TABLE} r ON r.table_name = tree.table_name "
+        "GROUP BY tree.table_name ORDER BY 4, tree.table_name"
+    )
+    return [tuple(r) for r in conn.execute(text(sql), params)]
+
+
+def children(conn, parent, after=None, limit=100):
+    """parent の直下のオブジェクトを table_name 順に (table_name, object_name, rows, total_count) で返す。
+    after 指定時はそれより後の table_name から（キーセットでの続き取得）。"""
+    params = {"p": parent, "n": limit}
+    where = "o.parent_table_name = :p"
+    if after is not None:
+        where += " AND o.table_name > :a"
+        params["a"] = after
+    sql = (
+        "SELECT o.table_name, r.object_name, COALESCE(r.rows, 0), COALESCE(r.total_count, 0) "
+        f"FROM {OBJECT_TREE_TABLE} o LEFT JOIN {ROLLUP_OBJECTS_TABLE} r ON r.table_name = o.table_name "
+        f"WHERE {where} ORDER BY o.table_name LIMIT :n"
+    )
+    return [tuple(r) for r in conn.execute(text(sql), params)]
+
+
+def ancestors(conn, table_names):
+    """各オブジェクトから最上位までの祖先を1回のクエリで引く。
+    {table_name: [(table_name, object_name), ...（自分から最上位の順）]} を返す。"""
+    table_names = list(dict.fromkeys(table_names))
+    if not table_names:
+        return {}
+    values = ", ".join(f"(:s{i})" for i in range(len(table_names)))
+    params = {f"s{i}": t for i, t in enumerate(table_names)}
+    sql = (
+        f"WITH RECURSIVE start(table_name) AS (VALUES {values}), "
+        "chain(start, table_name, depth) AS ("
+        "SELECT table_name, table_name, 0 FROM start "
+        "UNION SELECT chain.start, o.parent_table_name, chain.depth + 1 "
+        f"FROM chain JOIN {OBJECT_TREE_TABLE} o ON o.table_name = chain.table_name "
+        f"WHERE o.parent_table_name IS NOT NULL AND chain.depth < {MAX_DEPTH}) "
+        "SELECT chain.start, chain.table_name, r.object_name FROM chain "
+        f"LEFT JOIN {ROLLUP_OBJECTS_TABLE} r ON r.table_name = chain.table_name "
+        "ORDER BY chain.start, chain.depth"
+    )
+    result = {t: [] for t in table_names}
+    for start, table_name, object_name in conn.execute(text(sql), params):
+        result[start].append((table_name, object_name))
+    return result
@@ -0,0 +1,59 @@
+"""
+パスワードハッシュの生成・照合。方式とコストは環境変数で変えられ、
+保存済みのハッシュが今の方式と違えばログイン成功時に作り直す（needs_rehash）。
+
+ハッシュ計算は CPU を使うので、件数を絞ったスレッドプールで行う（hashlib の scrypt / pbkdf2 は
+計算中 GIL を手放す）。実行中＋待ちが上限に達していれば HasherBusy を投げ、呼び出し側は 503 を返す。
+これでログインが集中しても、同時に使う CPU はプール分までになり、他の API が止まらない。
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class HasherBusy(Exception):
+    """ハッシュ計算の実行中・待ちが上限に達している"""
+
+
+class PasswordHasher:
+    """method は werkzeug の形式（"scrypt", "scrypt:65536:8:1", "pbkdf2:sha256:600000" など）。"""
+
+    def __init__(self, method="scrypt", salt_length=16, workers=2, queue_size=8):
+        self.method = method
+        self.salt_length = salt_length
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pwhash")
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        # "scrypt" のような省略形は werkzeug が既定値で補うので、起動時に1回作って方式・パラメータ（"$" より前）を得る
+        self._target_prefix = generate_password_hash("", method, 1).split("$", 1)[0]
+        self._lock = threading.Lock()
+        self.rejected = 0
+        self.rehashed = 0
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise HasherBusy()
+        try:
+            return self._pool.submit(fn, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method, self.salt_length)
+
+    def verify(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """保存済みハッシュの方式・パラメータ（"$" より前）が今の設定と違うか（ハッシュ計算はしない）"""
+        return pwhash.split("$", 1)[0] != self._target_prefix
+
+    def stats(self):
+        with self._lock:
+            return {"rejected": self.rejected, "rehashed": self.rehashed}
+
+    def count_rehash(self):
+        with self._lock:
+            self.rehashed += 1
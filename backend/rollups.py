@@ -0,0 +1,151 @@
+"""
+在庫の集計表（アカウント毎DB）。分類毎・オブジェクト毎の行数と count 合計を持ち、
+中身の追加・削除・更新・オブジェクト削除と同じトランザクションで差分だけ更新する。
+集計の読み取りは表を引くだけで、中身テーブルは走査しない。
+同期は contents_store.ContentStore が行う（初回に既存の中身から構築する）。
+"""
+from sqlalchemy import text
+
+ROLLUP_OBJECTS_TABLE = "rollup_objects"
+ROLLUP_CATEGORIES_TABLE = "rollup_categories"
+ROLLUP_VERSION = "1"
+
+
+def _create_rollup_tables(conn):
+    conn.execute(
+        text(
+            f"CREATE TABLE IF NOT EXISTS {ROLLUP_OBJECTS_TABLE} ("
+            "table_name TEXT PRIMARY KEY, "
+            "object_name TEXT, "
+            "rows INTEGER NOT NULL DEFAULT 0, "
+            "total_count INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID"
+        )
+    )
+    conn.execute(
+        text(
+            f"CREATE TABLE IF NOT EXISTS {ROLLUP_CATEGORIES_TABLE} ("
+            "category TEXT PRIMARY KEY, "
+            "rows INTEGER NOT NULL DEFAULT 0, "
+            "total_count INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID"
+        )
+    )
+
+
+def ensure_rollups(conn, object_names, iter_groups):
+    """集計表が無ければ作成し、既存の中身から構築する。
+    object_names() は全オブジェクト名、iter_groups() は (table_name, object_name, category, rows, total_count)。"""
+    conn.execute(
+        text("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    )
+    version = conn.execute(text("SELECT value FROM meta WHERE key = 'rollups'")).scalar()
+    if version == ROLLUP_VERSION:
+        return True
+    _create_rollup_tables(conn)
+    conn.execute(text(f"DELETE FROM {ROLLUP_OBJECTS_TABLE}"))
+    conn.execute(text(f"DELETE FROM {ROLLUP_CATEGORIES_TABLE}"))
+    for table_name in object_names():
+        register_object(conn, table_name)
+    for table_name, object_name, category, rows, total_count in iter_groups():
+        add_to_rollups(conn, table_name, object_name, category, rows, total_count)
+    conn.execute(
+        text("INSERT OR REPLACE INTO meta (key, value) VALUES ('rollups', :v)"),
+        {"v": ROLLUP_VERSION},
+    )
+    return True
+
+
+def drop_rollups(conn):
+    """集計表を削除する（次回の ensure_rollups で作り直す）。"""
+    conn.execute(text(f"DROP TABLE IF EXISTS {ROLLUP_OBJECTS_TABLE}"))
+    conn.execute(text(f"DROP TABLE IF EXISTS {ROLLUP_CATEGORIES_TABLE}"))
+    conn.execute(
+        text("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    )
+    conn.execute(text("DELETE FROM meta WHERE key = 'rollups'"))
+
+
+def register_object(conn, table_name, object_name=None):
+    """中身0行のオブジェクトとして登録する（既にあれば何もしない）。"""
+    conn.execute(
+        text(
+            f"INSERT OR IGNORE INTO {ROLLUP_OBJECTS_TABLE} (table_name, object_name, rows, total_count) "
+            "VALUES (:t, :o, 0, 0)"
+        ),
+        {"t": table_name, "o": object_name},
+    )
+
+
+def add_to_rollups(conn, table_name, object_name, category, rows, total_count):
+    """行数・count 合計に差分を足す（削除は負の値）。行数が0になった分類は消す。"""
+    params = {
+        "t": table_name,
+        "o": object_name,
+        "c": category or "",
+        "n": rows,
+        "s": total_count or 0,
+    }
+    conn.execute(
+        text(
+            f"INSERT INTO {ROLLUP_OBJECTS_TABLE} (table_name, object_name, rows, total_count) "
+            "VALUES (:t, :o, :n, :s) "
+            "ON CONFLICT (table_name) DO UPDATE SET "
+            "rows = rows + excluded.rows, "
+            "total_count = total_count + excluded.total_count, "
+            "object_name = COALESCE(excluded.object_name, object_name)"
+        ),
+        params,
+    )
+    conn.execute(
+        text(
+            f"INSERT INTO {ROLLUP_CATEGORIES_TABLE} (category, rows, total_count) "
+            "VALUES (:c, :n, :s) "
+            "ON CONFLICT (category) DO UPDATE SET "
+            "rows = rows + excluded.rows, total_count = total_count + excluded.total_count"
+        ),
+        params,
+    )
+    if rows < 0:
+        conn.execute(
+            text(f"DELETE FROM {ROLLUP_CATEGORIES_TABLE} WHERE category = :c AND rows <= 0"),
+            params,
+        )
+
+
+def rename_rollup_object(conn, table_name, new_name):
+    conn.execute(
+        text(f"UPDATE {ROLLUP_OBJECTS_TABLE} SET object_name = :o WHERE table_name = :t"),
+        {"o": new_name, "t": table_name},
+    )
+
+
+def drop_rollup_object(conn, table_name, groups):
+    """オブジェクト削除時: groups（そのオブジェクトの分類毎の (category, rows, total_count)）を引いて行を消す。"""
+    for category, rows, total_count in groups:
+        add_to_rollups(conn, table_name, None, category, -rows, -(total_count or 0))
+    conn.execute(
+        text(f"DELETE FROM {ROLLUP_OBJECTS_TABLE} WHERE table_name = :t"),
+        {"t": table_name},
+    )
+
+
+def category_summary(conn):
+    """分類毎の (category, rows, total_count) を行数の多い順に返す。"""
+    return [
+        tuple(r)
+        for r in conn.execute(
+            text(
+                f"SELECT category, rows, total_count FROM {ROLLUP_CATEGORIES_TABLE} "
+                "ORDER BY rows DESC, category"
+            )
+        )
+    ]
+
+
+def object_summary(conn, table_name=None):
+    """オブジェクト毎の (table_name, object_name, rows, total_count)。table_name 指定でその1件のみ。"""
+    sql = f"SELECT table_name, object_name, rows, total_count FROM {ROLLUP_OBJECTS_TABLE}"
+    params = {}
+    if table_name is not None:
+        sql += " WHERE table_name = :t"
+        params["t"] = table_name
+    return [tuple(r) for r in conn.execute(text(sql + " ORDER BY table_name"), params)]
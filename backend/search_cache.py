@@ -0,0 +1,106 @@
+"""
+/api/contents/search の結果キャッシュ（プロセス内 LRU）。
+キーは (ユーザー, 世代, 正規化した検索語)。中身を変える操作のたびにそのユーザーの世代を進めるので、
+古い世代のエントリは二度と当たらず、LRU で押し出される。
+
+既定では世代はプロセス内に持つ（ワーカー1つ向け）。複数ワーカーで動かすときは
+SUMAPURO_SEARCH_CACHE_SHARED=1 にすると、世代をアカウント毎DBの meta.search_generation に置き、
+他のワーカーの変更も検索前の1行読み取りで検知する。
+"""
+import threading
+import uuid
+from collections import OrderedDict
+
+from sqlalchemy import text
+
+GENERATION_KEY = "search_generation"
+
+# FTS5 trigram・LIKE とも ASCII の大文字小文字を区別しないので、キーでも揃える
+_ASCII_LOWER = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ", "abcdefghijklmnopqrstuvwxyz")
+
+
+def normalize_query(value):
+    return (value or "").strip().translate(_ASCII_LOWER)
+
+
+class SearchCache:
+    """検索結果のキャッシュ。max_entries が 0 なら何も覚えない。"""
+
+    def __init__(self, max_entries=256, shared=False):
+        self.max_entries = max_entries
+        self.shared = shared
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def generation(self, user_key, conn=None):
+        """user_key の現在の世代。共有モードでは conn のDBから読む（検索より先に読むこと）。"""
+        if self.shared and conn is not None:
+            try:
+                stored = conn.execute(
+                    text("SELECT value FROM meta WHERE key = :k"), {"k": GENERATION_KEY}
+                ).scalar()
+            except Exception:
+                stored = None
+            return stored or "0"
+        with self._lock:
+            return self._generations.get(user_key, 0)
+
+    def get(self, user_key, generation, name, category):
+        """キャッシュ済みの結果（list）。無ければ None。"""
+        if self.max_entries <= 0:
+            return None
+        key = (user_key, generation, normalize_query(name), normalize_query(category))
+        with self._lock:
+            matches = self._entries.get(key)
+            if matches is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return matches
+
+    def put(self, user_key, generation, name, category, matches):
+        if self.max_entries <= 0:
+            return
+        key = (user_key, generation, normalize_query(name), normalize_query(category))
+        with self._lock:
+            self._entries[key] = list(matches)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, user_key, conn=None):
+        """user_key の世代を進める。中身を変える操作の commit 後に呼ぶ（共有モードでは conn で書いて commit する）。"""
+        with self._lock:
+            self._generations[user_key] = self._generations.get(user_key, 0) + 1
+            self.invalidations += 1
+        if self.shared and conn is not None:
+            # reset 後に値が戻って古いエントリに当たらないよう、連番ではなく乱数にする
+            conn.execute(
+                text("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            )
+            conn.execute(
+                text("INSERT OR REPLACE INTO meta (key, value) VALUES (:k, :v)"),
+                {"k": GENERATION_KEY, "v": uuid.uuid4().hex},
+            )
+            conn.commit()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "shared": self.shared,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
@@ -0,0 +1,284 @@
+"""
+中身検索用のインデックス（SQLite FTS5 trigram）。
+アカウント毎DBに1つだけ持ち、オブジェクト毎の中身を1つずつ LIKE で走査しなくて済むようにする。
+行の追加・削除などの同期は contents_store.ContentStore が行う。
+
+  python search_index.py                 # data/*.db をすべて再構築
+  python search_index.py data/xxxx.db    # 指定ファイルのみ再構築
+"""
+import argparse
+import glob
+import os
+import sys
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+
+# FTS5 本体（name, category, object_name を trigram で索引）と、rowid → 元テーブル行の対応表
+SEARCH_TABLE = "contents_search"
+SEARCH_DOCS_TABLE = "search_docs"
+SEARCH_INDEX_VERSION = "2"
+
+# trigram は 3 文字未満の語を索引で引けないので、それより短い語は LIKE で照合する
+TRIGRAM_MIN_CHARS = 3
+# 再構築で1回の executemany に渡す行数
+_REBUILD_BATCH = 1000
+
+
+def _escape_like(value):
+    return str(value).replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _fts_phrase(column, value):
+    """FTS5 の列指定フレーズ（" は二重化してリテラル扱い）"""
+    return '{%s} : "%s"' % (column, value.replace('"', '""'))
+
+
+def _create_search_tables(conn):
+    """FTS5 表と対応表を作成する。FTS5 (trigram) が無い SQLite では False。"""
+    conn.execute(
+        text("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    )
+    try:
+        conn.execute(
+            text(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} "
+                "USING fts5(name, category, object_name, tokenize='trigram')"
+            )
+        )
+    except OperationalError:
+        return False
+    conn.execute(
+        text(
+            f"CREATE TABLE IF NOT EXISTS {SEARCH_DOCS_TABLE} ("
+            "doc_id INTEGER PRIMARY KEY, "
+            "table_name TEXT NOT NULL, "
+            "row_id INTEGER NOT NULL, "
+            "parent_table_name TEXT)"
+        )
+    )
+    conn.execute(
+        text(
+            f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{SEARCH_DOCS_TABLE}_row "
+            f"ON {SEARCH_DOCS_TABLE} (table_name, row_id)"
+        )
+    )
+    return True
+
+
+def _mark_built(conn):
+    conn.execute(
+        text("INSERT OR REPLACE INTO meta (key, value) VALUES ('search_index', :v)"),
+        {"v": SEARCH_INDEX_VERSION},
+    )
+
+
+def ensure_search_index(conn, iter_rows):
+    """インデックスが無ければ作成し、iter_rows() の既存行から構築する。FTS5 が使えない環境では False。"""
+    conn.execute(
+        text("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    )
+    version = conn.execute(
+        text("SELECT value FROM meta WHERE key = 'search_index'")
+    ).scalar()
+    if version == SEARCH_INDEX_VERSION:
+        return True
+    if not _create_search_tables(conn):
+        return False
+    rebuild_search_index(conn, iter_rows())
+    _mark_built(conn)
+    return True
+
+
+def rebuild_search_index(conn, rows):
+    """インデックスを空にして作り直す。rows は (table_name, id, object_name, name, category, parent_table_name)。"""
+    conn.execute(text(f"DELETE FROM {SEARCH_TABLE}"))
+    conn.execute(text(f"DELETE FROM {SEARCH_DOCS_TABLE}"))
+    total = 0
+    docs, texts = [], []
+    # 空にした直後なので doc_id は 1 から振り、_REBUILD_BATCH 行ずつ executemany で入れる
+    for table_name, row_id, object_name, name, category, parent_table_name in rows:
+        total += 1
+        docs.append({"d": total, "t": table_name, "r": row_id, "p": parent_table_name})
+        texts.append({
+            "d": total,
+            "name": name,
+            "category": category,
+            "object_name": object_name or "",
+        })
+        if len(docs) >= _REBUILD_BATCH:
+            _insert_docs(conn, docs, texts)
+            docs, texts = [], []
+    _insert_docs(conn, docs, texts)
+    return total
+
+
+def _insert_docs(conn, docs, texts):
+    if not docs:
+        return
+    conn.execute(
+        text(
+            f"INSERT INTO {SEARCH_DOCS_TABLE} (doc_id, table_name, row_id, parent_table_name) "
+            "VALUES (:d, :t, :r, :p)"
+        ),
+        docs,
+    )
+    conn.execute(
+        text(
+            f"INSERT INTO {SEARCH_TABLE} (rowid, name, category, object_name) "
+            "VALUES (:d, :name, :category, :object_name)"
+        ),
+        texts,
+    )
+
+
+def index_content_row(conn, table_name, row_id, object_name, name, category, parent_table_name):
+    """中身1行をインデックスに追加する（add_content と同じトランザクションで呼ぶ）。"""
+    doc_id = conn.execute(
+        text(
+            f"INSERT INTO {SEARCH_DOCS_TABLE} (table_name, row_id, parent_table_name) "
+            "VALUES (:t, :r, :p)"
+        ),
+        {"t": table_name, "r": row_id, "p": parent_table_name},
+    ).lastrowid
+    conn.execute(
+        text(
+            f"INSERT INTO {SEARCH_TABLE} (rowid, name, category, object_name) "
+            "VALUES (:d, :name, :category, :object_name)"
+        ),
+        {
+            "d": doc_id,
+            "name": name,
+            "category": category,
+            "object_name": object_name or "",
+        },
+    )
+
+
+def remove_content_rows(conn, table_name, row_ids):
+    """削除した中身行をインデックスからも外す。"""
+    if not row_ids:
+        return
+    placeholders = ", ".join(f":id{i}" for i in range(len(row_ids)))
+    params = {f"id{i}": v for i, v in enumerate(row_ids)}
+    params["t"] = table_name
+    where = f"table_name = :t AND row_id IN ({placeholders})"
+    conn.execute(
+        text(
+            f"DELETE FROM {SEARCH_TABLE} WHERE rowid IN "
+            f"(SELECT doc_id FROM {SEARCH_DOCS_TABLE} WHERE {where})"
+        ),
+        params,
+    )
+    conn.execute(text(f"DELETE FROM {SEARCH_DOCS_TABLE} WHERE {where}"), params)
+
+
+def rename_indexed_object(conn, table_name, new_name):
+    """オブジェクト名変更をインデックスの object_name に反映する。"""
+    conn.execute(
+        text(
+            f"UPDATE {SEARCH_TABLE} SET object_name = :n WHERE rowid IN "
+            f"(SELECT doc_id FROM {SEARCH_DOCS_TABLE} WHERE table_name = :t)"
+        ),
+        {"n": new_name, "t": table_name},
+    )
+
+
+def drop_indexed_table(conn, table_name):
+    """テーブル削除時に、そのテーブルの行をインデックスから一括で外す。"""
+    conn.execute(
+        text(
+            f"DELETE FROM {SEARCH_TABLE} WHERE rowid IN "
+            f"(SELECT doc_id FROM {SEARCH_DOCS_TABLE} WHERE table_name = :t)"
+        ),
+        {"t": table_name},
+    )
+    conn.execute(
+        text(f"DELETE FROM {SEARCH_DOCS_TABLE} WHERE table_name = :t"),
+        {"t": table_name},
+    )
+
+
+def drop_search_index(conn):
+    """インデックスを丸ごと削除する（reset_db 用）。次回 ensure_search_index で作り直される。"""
+    conn.execute(text(f"DROP TABLE IF EXISTS {SEARCH_TABLE}"))
+    conn.execute(text(f"DROP TABLE IF EXISTS {SEARCH_DOCS_TABLE}"))
+    conn.execute(
+        text("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    )
+    conn.execute(text("DELETE FROM meta WHERE key = 'search_index'"))
+
+
+def search_index(conn, search_name, search_category):
+    """名前・分類の部分一致で検索し、(table_name, parent_table_name) の重複なし一覧を返す。"""
+    match_terms = []
+    where = []
+    params = {}
+    for column, value in (("name", search_name), ("category", search_category)):
+        if not value:
+            # 従来の LIKE '%'（未指定の列）と同じく、その列が NULL の行は含めない（空文字は含める）
+            where.append(f"{SEARCH_TABLE}.{column} IS NOT NULL")
+            continue
+        if len(value) >= TRIGRAM_MIN_CHARS:
+            match_terms.append(_fts_phrase(column, value))
+        else:
+            # 2 文字以下（日本語の短い語など）は索引が効かないため、この表の中だけを LIKE で照合
+            where.append(f"{SEARCH_TABLE}.{column} LIKE :{column}_pattern ESCAPE '\\'")
+            params[f"{column}_pattern"] = "%" + _escape_like(value) + "%"
+    if not search_name and not search_category:
+        return []
+    if match_terms:
+        where.insert(0, f"{SEARCH_TABLE} MATCH :match")
+        params["match"] = " AND ".join(match_terms)
+    rows = conn.execute(
+        text(
+            f"SELECT DISTINCT d.table_name, d.parent_table_name "
+            f"FROM {SEARCH_TABLE} JOIN {SEARCH_DOCS_TABLE} AS d ON d.doc_id = {SEARCH_TABLE}.rowid "
+            f"WHERE {' AND '.join(where)} "
+            "ORDER BY d.table_name"
+        ),
+        params,
+    ).fetchall()
+    return [(t, p) for t, p in rows]
+
+
+def rebuild_database_file(path):
+    """既存の data/{hash}.db 1つ分のインデックスを作り直し、索引した行数を返す。"""
+    from contents_store import ContentStore
+
+    engine = create_engine(
+        f"sqlite:///{path}".replace("\\", "/"),
+        connect_args={"check_same_thread": False},
+    )
+    try:
+        with engine.begin() as conn:
+            if not _create_search_tables(conn):
+                raise RuntimeError("SQLite に FTS5 (trigram) がありません")
+            n = rebuild_search_index(conn, ContentStore(conn).iter_rows())
+            _mark_built(conn)
+            return n
+    finally:
+        engine.dispose()
+
+
+def main(argv=None):
+    backend_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="中身検索インデックスの再構築")
+    parser.add_argument("paths", nargs="*", help="対象の .db（省略時は data/*.db すべて）")
+    parser.add_argument("--data-dir", default=os.path.join(backend_dir, "data"))
+    args = parser.parse_args(argv)
+
+    paths = args.paths or sorted(glob.glob(os.path.join(args.data_dir, "*.db")))
+    failed = 0
+    for path in paths:
+        try:
+            n = rebuild_database_file(path)
+            print(f"{path}: {n} rows indexed")
+        except Exception as e:
+            failed += 1
+            print(f"{path}: failed ({e})", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
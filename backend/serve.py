@@ -0,0 +1,79 @@
+"""
+本番用の起動。Linux / macOS では gunicorn（複数プロセス × スレッド）、gunicorn が無い環境や
+Windows では waitress（1プロセス × スレッド）で app を動かす。開発用の python app.py は使わない。
+
+  pip install gunicorn     # Linux / macOS
+  pip install waitress     # Windows（または gunicorn が使えない環境）
+
+  python serve.py                                  # 127.0.0.1:5000、2 ワーカー × 4 スレッド
+  python serve.py --bind 0.0.0.0:8000 --workers 4 --threads 8
+  python serve.py --server waitress --threads 8
+
+アカウント毎DBのエンジンはプロセス毎に持つ（fork 前に開いた SQLite 接続は子で使わない。gunicorn.conf.py の post_fork）。
+複数ワーカーでは検索キャッシュの世代を DB に置く（SUMAPURO_SEARCH_CACHE_SHARED=1 を自動で設定）。
+"""
+import argparse
+import os
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+GUNICORN_CONFIG = os.path.join(BACKEND_DIR, "gunicorn.conf.py")
+
+
+def _available(module):
+    try:
+        __import__(module)
+    except ImportError:
+        return False
+    return True
+
+
+def run_gunicorn():
+    from gunicorn.app.wsgiapp import run
+
+    sys.argv = ["gunicorn", "-c", GUNICORN_CONFIG, "wsgi:app"]
+    return run()
+
+
+def run_waitress(bind, threads):
+    from waitress import serve
+
+    sys.path.insert(0, BACKEND_DIR)
+    from wsgi import app
+
+    host, _, port = bind.rpartition(":")
+    print(f"[serve] waitress on {bind} ({threads} threads)")
+    serve(app, host=host or "127.0.0.1", port=int(port), threads=threads)
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="本番用の起動（gunicorn / waitress）")
+    parser.add_argument("--server", choices=["auto", "gunicorn", "waitress"], default="auto")
+    parser.add_argument("--bind", default=os.getenv("SUMAPURO_BIND", "127.0.0.1:5000"))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("SUMAPURO_WORKERS", "2")))
+    parser.add_argument("--threads", type=int, default=int(os.getenv("SUMAPURO_THREADS", "4")))
+    args = parser.parse_args(argv)
+
+    server = args.server
+    if server == "auto":
+        server = "gunicorn" if os.name != "nt" and _available("gunicorn") else "waitress"
+    if server == "gunicorn":
+        if not _available("gunicorn"):
+            print("gunicorn is not installed (pip install gunicorn)", file=sys.stderr)
+            return 1
+        # gunicorn.conf.py は環境変数から読む
+        os.environ["SUMAPURO_BIND"] = args.bind
+        os.environ["SUMAPURO_WORKERS"] = str(args.workers)
+        os.environ["SUMAPURO_THREADS"] = str(args.threads)
+        return run_gunicorn()
+    if not _available("waitress"):
+        print("waitress is not installed (pip install waitress)", file=sys.stderr)
+        return 1
+    if args.workers > 1:
+        print("[serve] waitress runs a single process; --workers is ignored")
+    return run_waitress(args.bind, args.threads)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
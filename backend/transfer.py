@@ -0,0 +1,342 @@
+"""
+アカウント毎DBの中身（全オブジェクト・全行）とキャンバス状態の書き出し・取り込み（バックアップ・移行用）。
+形式は NDJSON（1行1レコード）。gzip で圧縮したものも同じ内容:
+
+  {"type": "header", "format": "sumapuro-export", "version": 1, "storage_mode": "tables", ...}
+  {"type": "object", "table_name": "box_1"}                      … 全オブジェクト（中身0行のものも）
+  {"type": "row", "table_name": "box_1", "id": 1, "object_name": ..., "name": ..., ...}
+  {"type": "canvas", "rev": 12, "state": {...}}
+  {"type": "end", "objects": 3, "rows": 120}                      … 件数の照合用。無ければ途中で切れたとみなす
+
+書き出しは読み取りトランザクション1つの中でカーソルから1行ずつ読み、一定量ずつ chunk にして返すので、
+行数が多くてもメモリは増えない（キャンバス状態だけは1レコードとしてまとめて持つ）。
+取り込みは1トランザクションで、行は SUMAPURO_IMPORT_BATCH_ROWS 件ずつ executemany で入れ、
+検索インデックス・集計表・入れ子の表は最後にまとめて作る。
+
+  python transfer.py export data/xxxx.db -o backup.ndjson.gz
+  python transfer.py export --user alice > backup.ndjson
+  python transfer.py import data/xxxx.db backup.ndjson.gz --replace
+"""
+import argparse
+import datetime
+import gzip
+import json
+import os
+import re
+import sys
+import zlib
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import DBAPIError
+
+from canvas_store import ensure_canvas_tables, export_state_text, remap_content_ids, replace_state
+from contents_store import CONTENT_FIELDS, STORAGE_SINGLE, ContentStore, is_content_table_name
+from user_map import UserMap
+
+EXPORT_FORMAT = "sumapuro-export"
+EXPORT_VERSION = 1
+# 取り込みで1回の executemany に渡す行数
+IMPORT_BATCH_ROWS = int(os.getenv("SUMAPURO_IMPORT_BATCH_ROWS", "1000"))
+# 書き出しで1回に返す chunk の目安（バイト）
+_CHUNK_BYTES = 64 * 1024
+_TABLE_NAME_RE = re.compile(r"^[A-Za-z0-9_\-]{1,80}$")
+_NO_CANVAS = object()
+
+
+class TransferError(Exception):
+    """取り込むデータの形式が不正（何行目か line を持つ。何も書かずにロールバックする）"""
+
+    def __init__(self, message, line=None):
+        super().__init__(f"line {line}: {message}" if line else message)
+        self.line = line
+
+
+class TargetNotEmpty(Exception):
+    """取り込み先に既にオブジェクトがある（replace 指定時のみ置き換える）"""
+
+
+def _dumps(record):
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+
+
+def export_lines(conn):
+    """書き出しの NDJSON を1行ずつ（改行付きの str で）返す。"""
+    store = ContentStore(conn)
+    ensure_canvas_tables(conn)
+    conn.commit()
+    # 以降の読み取りを1つのスナップショットにする（WAL なので書き込みは止めない）
+    conn.exec_driver_sql("BEGIN")
+    try:
+        names = sorted(store.object_names())
+        yield _dumps({
+            "type": "header",
+            "format": EXPORT_FORMAT,
+            "version": EXPORT_VERSION,
+            "storage_mode": store.mode,
+            "exported_at": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        }) + "\n"
+        for table_name in names:
+            yield _dumps({"type": "object", "table_name": table_name}) + "\n"
+        rows = 0
+        for table_name, row_id, *values in store.iter_contents():
+            record = {"type": "row", "table_name": table_name, "id": row_id}
+            record.update(zip(CONTENT_FIELDS, values))
+            yield _dumps(record) + "\n"
+            rows += 1
+        # 保存済みの JSON 文字列は解析せずに埋め込む
+        state_text, rev = export_state_text(conn)
+        yield f'{{"type":"canvas","rev":{rev},"state":{state_text}}}\n'
+        yield _dumps({"type": "end", "objects": len(names), "rows": rows}) + "\n"
+    finally:
+        conn.rollback()
+
+
+def export_chunks(engine, compress=False):
+    """export_lines を _CHUNK_BYTES 程度の bytes にまとめて返す（compress=True なら gzip）。
+    接続はこのジェネレータの中で開くので、レスポンスの本文としてそのまま渡せる。"""
+    gz = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    with engine.connect() as conn:
+        buffer = []
+        size = 0
+        for line in export_lines(conn):
+            data = line.encode("utf-8")
+            buffer.append(data)
+            size += len(data)
+            if size >= _CHUNK_BYTES:
+                chunk = b"".join(buffer)
+                buffer, size = [], 0
+                chunk = gz.compress(chunk) if gz else chunk
+                if chunk:
+                    yield chunk
+        chunk = b"".join(buffer)
+        yield gz.compress(chunk) + gz.flush() if gz else chunk
+
+
+def open_import_stream(fileobj):
+    """バイト列のストリームを返す。先頭が gzip のマジックなら展開しながら読む。"""
+    head = fileobj.read(2)
+    if head == b"\x1f\x8b":
+        return gzip.GzipFile(fileobj=_Prefixed(head, fileobj), mode="rb")
+    return _Prefixed(head, fileobj)
+
+
+class _Prefixed:
+    """先に読んだ数バイトを戻した読み取り用ストリーム（gzip 判定用）"""
+
+    def __init__(self, head, fileobj):
+        self._head = head
+        self._fileobj = fileobj
+
+    def read(self, size=-1):
+        head, self._head = self._head, b""
+        if size is None or size < 0:
+            return head + self._fileobj.read()
+        if len(head) >= size:
+            self._head = head[size:]
+            return head[:size]
+        return head + self._fileobj.read(size - len(head))
+
+    def __iter__(self):
+        pending = b""
+        while True:
+            data = self.read(_CHUNK_BYTES)
+            if not data:
+                break
+            lines = (pending + data).split(b"\n")
+            pending = lines.pop()
+            yield from lines
+        if pending:
+            yield pending
+
+
+def _table_name(record, line):
+    name = record.get("table_name")
+    if not isinstance(name, str) or not _TABLE_NAME_RE.match(name) or not is_content_table_name(name):
+        raise TransferError(f"invalid table_name {name!r}", line)
+    return name
+
+
+def _content_row(record, line):
+    try:
+        row_id = int(record["id"])
+        count = int(record.get("count") or 0)
+        nest_type = int(record.get("nest_type") or 0)
+    except (KeyError, TypeError, ValueError):
+        raise TransferError("id, count and nest_type must be integers", line)
+    parent_table_name = record.get("parent_table_name") or None
+    if parent_table_name is not None and not _TABLE_NAME_RE.match(str(parent_table_name)):
+        raise TransferError(f"invalid parent_table_name {parent_table_name!r}", line)
+    return {
+        "id": row_id,
+        "object_name": str(record.get("object_name") or ""),
+        "name": str(record.get("name") or ""),
+        "category": str(record.get("category") or ""),
+        "count": count,
+        "nest_type": nest_type if nest_type in (0, 1, 2) else 0,
+        "parent_table_name": parent_table_name,
+    }
+
+
+def import_lines(conn, lines, replace=False, batch_rows=IMPORT_BATCH_ROWS):
+    """NDJSON の行（bytes / str）を取り込んで commit し、{"objects", "rows", "canvas"} を返す。
+    取り込み先にオブジェクトがあれば TargetNotEmpty（replace=True なら全部消してから入れる）。
+    形式の誤り・件数の不一致・行の制約違反（id の重複など）は TransferError で、いずれも何も書かずにロールバックする。"""
+    store = ContentStore(conn)
+    try:
+        if not replace and store.object_names():
+            raise TargetNotEmpty()
+        store.clear()
+        # single 方式へ別の方式（テーブル毎の id）から入れるときは id を振り直し、キャンバス側も書き換える
+        renumber = None
+        next_id = store.max_row_id()
+        id_map = {}
+        objects = set()
+        header = end = None
+        canvas = _NO_CANVAS
+        batch_table, batch = None, []
+        rows = 0
+
+        def flush():
+            if batch:
+                try:
+                    store.load_object(batch_table, batch)
+                except DBAPIError as e:
+                    # id の重複などの制約違反は DB の不具合ではなくデータの誤り
+                    raise TransferError(f"cannot insert rows into {batch_table}: {e.orig}") from e
+                batch.clear()
+
+        for line_no, raw in enumerate(lines, 1):
+            if not raw.strip():
+                continue
+            if end is not None:
+                raise TransferError("data after end record", line_no)
+            try:
+                record = json.loads(raw)
+            except ValueError:
+                raise TransferError("not a JSON line", line_no)
+            kind = record.get("type") if isinstance(record, dict) else None
+            if header is None:
+                if kind != "header" or record.get("format") != EXPORT_FORMAT:
+                    raise TransferError("not a sumapuro export", line_no)
+                if record.get("version") != EXPORT_VERSION:
+                    raise TransferError(f"unsupported version {record.get('version')!r}", line_no)
+                header = record
+                renumber = store.single and header.get("storage_mode") != STORAGE_SINGLE
+                continue
+            if kind == "object":
+                table_name = _table_name(record, line_no)
+                if table_name not in objects:
+                    objects.add(table_name)
+                    store.load_object(table_name, [])
+            elif kind == "row":
+                table_name = _table_name(record, line_no)
+                if table_name not in objects:
+                    raise TransferError(f"row for undeclared object {table_name}", line_no)
+                row = _content_row(record, line_no)
+                if renumber:
+                    next_id += 1
+                    id_map.setdefault(table_name, {})[row["id"]] = next_id
+                    row["id"] = next_id
+                if table_name != batch_table or len(batch) >= batch_rows:
+                    flush()
+                    batch_table = table_name
+                batch.append(row)
+                rows += 1
+            elif kind == "canvas":
+                canvas = record.get("state")
+            elif kind == "end":
+                end = record
+            else:
+                raise TransferError(f"unknown record type {kind!r}", line_no)
+        flush()
+        if header is None or end is None:
+            raise TransferError("missing header or end record (truncated?)")
+        if end.get("objects") != len(objects) or end.get("rows") != rows:
+            raise TransferError(
+                f"count mismatch: end record says {end.get('objects')} objects / {end.get('rows')} rows, "
+                f"got {len(objects)} / {rows}"
+            )
+        if canvas is not _NO_CANVAS:
+            replace_state(conn, canvas)
+            if id_map:
+                remap_content_ids(conn, id_map)
+        store.rebuild_derived()
+    except Exception:
+        conn.rollback()
+        raise
+    conn.commit()
+    return {"objects": len(objects), "rows": rows, "canvas": canvas is not _NO_CANVAS}
+
+
+def _open_engine(path):
+    return create_engine(
+        f"sqlite:///{path}".replace("\\", "/"),
+        connect_args={"check_same_thread": False},
+    )
+
+
+def _resolve_db(args):
+    if args.user:
+        filename = UserMap(os.path.join(args.data_dir, "user_map.json")).get(args.user)
+        if not filename:
+            raise SystemExit(f"user {args.user!r} is not in {args.data_dir}/user_map.json")
+        return os.path.join(args.data_dir, filename)
+    if not args.db:
+        raise SystemExit("specify a .db path or --user")
+    return args.db
+
+
+def main(argv=None):
+    backend_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="アカウント毎DBの書き出し・取り込み（NDJSON）")
+    sub = parser.add_subparsers(dest="command", required=True)
+    export = sub.add_parser("export", help="中身とキャンバス状態を NDJSON で書き出す")
+    export.add_argument("db", nargs="?", help="対象の .db")
+    export.add_argument("-o", "--output", help="出力先（.gz なら gzip。省略時は標準出力）")
+    export.add_argument("--gzip", action="store_true", help="gzip で圧縮する")
+    imp = sub.add_parser("import", help="書き出したファイルを取り込む（gzip も可）")
+    imp.add_argument("db", nargs="?", help="取り込み先の .db")
+    imp.add_argument("input", nargs="?", help="入力ファイル（省略時は標準入力）")
+    imp.add_argument("--replace", action="store_true", help="取り込み先の中身を消してから入れる")
+    for p in (export, imp):
+        p.add_argument("--user", help="DB をユーザー名で指定（data/user_map.json から引く）")
+        p.add_argument("--data-dir", default=os.path.join(backend_dir, "data"))
+    args = parser.parse_args(argv)
+
+    path = _resolve_db(args)
+    if args.command == "export" and not os.path.exists(path):
+        print(f"{path} does not exist", file=sys.stderr)
+        return 1
+    engine = _open_engine(path)
+    try:
+        if args.command == "export":
+            compress = args.gzip or (args.output or "").endswith(".gz")
+            out = open(args.output, "wb") if args.output else sys.stdout.buffer
+            try:
+                for chunk in export_chunks(engine, compress=compress):
+                    out.write(chunk)
+            finally:
+                if args.output:
+                    out.close()
+            return 0
+        src = open(args.input, "rb") if args.input else sys.stdin.buffer
+        try:
+            with engine.connect() as conn:
+                result = import_lines(conn, open_import_stream(src), replace=args.replace)
+        except TargetNotEmpty:
+            print("target database already has objects (use --replace)", file=sys.stderr)
+            return 1
+        except TransferError as e:
+            print(f"import failed: {e}", file=sys.stderr)
+            return 1
+        finally:
+            if args.input:
+                src.close()
+        print(f"{result['objects']} objects, {result['rows']} rows imported")
+        return 0
+    finally:
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+"""
+data/user_map.json（ユーザー名 → DB ファイル名）の管理。
+起動時に1回だけ読み込んでメモリに持ち、対応が新しいときだけファイルに書く。
+書き込みはロックファイルで他プロセスと排他し、読み直して合流させてから一時ファイル経由で置き換える。
+"""
+import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+@contextmanager
+def file_lock(lock_path, blocking=True):
+    """lock_path を使ったプロセス間の排他ロック。blocking=False なら待たず、取れたかどうか（bool）を渡す。"""
+    with open(lock_path, "a+b") as f:
+        try:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+        except OSError:
+            if blocking:
+                raise
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def atomic_write_json(path, data):
+    """一時ファイルに書いてから os.replace で置き換える（途中で落ちても壊れたファイルを残さない）"""
+    directory = os.path.dirname(path) or "."
+    fd, tmp = tempfile.mkstemp(prefix=".tmp-", suffix=".json", dir=directory)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except Exception:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def _read(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+class UserMap:
+    """ユーザー名 → DB ファイル名の対応表"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._map = _read(path)
+
+    def get(self, username):
+        with self._lock:
+            return self._map.get(username)
+
+    def items(self):
+        with self._lock:
+            return list(self._map.items())
+
+    def record(self, username, filename):
+        """対応を記録する。既に同じ対応があればファイルには触れず False。"""
+        with self._lock:
+            if self._map.get(username) == filename:
+                return False
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with file_lock(self.path + ".lock"):
+                # 他プロセスが追記した分を取り込んでから書く
+                current = _read(self.path)
+                if current.get(username) != filename:
+                    current[username] = filename
+                    atomic_write_json(self.path, current)
+                self._map = current
+            return True
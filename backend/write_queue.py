@@ -0,0 +1,162 @@
+"""
+アカウント毎DBへの書き込みをまとめて commit する（グループコミット）。
+同じDBへの書き込み要求が短い間に重なったら、最初に来たスレッド（リーダー）が SUMAPURO_WRITE_QUEUE_DELAY_MS
+だけ待って（SUMAPURO_WRITE_QUEUE_BATCH 件たまれば待たずに）溜まった分を1つのトランザクションで順に実行し、
+1回の commit で確定させる。各要求はそれぞれ SAVEPOINT の中で実行するので、1件が例外で失敗しても
+その分だけ巻き戻り、他の要求はそのまま commit される。後から来たスレッドは自分の分の commit を待って結果を受け取る。
+
+耐久性: 結果を返すのは、その要求を含むトランザクションの commit が終わった後（まとめない場合と同じ保証）。
+commit に失敗したら、そのバッチの要求はすべて同じ例外になる。まとめるのはプロセス内だけで、
+ワーカー間は従来どおり SQLite のロックで直列になる。無効（SUMAPURO_WRITE_QUEUE=0）なら要求毎に1トランザクション。
+"""
+import threading
+
+from contents_store import begin_write
+
+
+class _Op:
+    __slots__ = ("fn", "after_commit", "done", "lead", "result", "error")
+
+    def __init__(self, fn, after_commit):
+        self.fn = fn
+        self.after_commit = after_commit
+        self.done = threading.Event()
+        self.lead = False  # True: 前のリーダーから次のバッチを任された
+        self.result = None
+        self.error = None
+
+    def outcome(self):
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class _Group:
+    """1つのDBの待ち行列"""
+
+    def __init__(self, lock):
+        self.pending = []
+        self.leading = False
+        self.full = threading.Condition(lock)
+
+
+class WriteQueue:
+    """DB（key）毎に書き込みをまとめる。enabled=False なら run は要求毎に1トランザクションで実行する。
+    prepare(conn) はトランザクションを始める前に毎回呼ぶ（自分で commit する初期化を SAVEPOINT の中でさせないため）。"""
+
+    def __init__(self, enabled=False, max_batch=32, max_delay_ms=2, prepare=None):
+        self.enabled = enabled
+        self.prepare = prepare
+        self.max_batch = max(1, max_batch)
+        self.max_delay = max(0, max_delay_ms) / 1000
+        self._lock = threading.Lock()
+        self._groups = {}
+        self.ops = 0
+        self.batches = 0
+        self.largest_batch = 0
+        self.failed = 0
+
+    def run(self, key, engine, fn, after_commit=None):
+        """fn(conn) を書き込みトランザクションの中で実行し、commit 後にその戻り値を返す（例外はそのまま投げる）。
+        fn の中で commit / rollback はしないこと。after_commit は (関数, 引数…) のタプルで、
+        fn が成功したとき commit 後に 関数(*引数, conn) を呼ぶ（バッチ内で同じタプルは1回だけ）。"""
+        op = _Op(fn, after_commit)
+        if not self.enabled:
+            self._execute(engine, [op])
+            return op.outcome()
+        with self._lock:
+            group = self._groups.get(key)
+            if group is None:
+                group = self._groups[key] = _Group(self._lock)
+            group.pending.append(op)
+            lead = not group.leading
+            if lead:
+                group.leading = True
+            elif len(group.pending) >= self.max_batch:
+                group.full.notify()
+        if not lead:
+            op.done.wait()
+            if not op.lead:
+                return op.outcome()
+        self._lead(key, group, engine)
+        return op.outcome()
+
+    def _lead(self, key, group, engine):
+        with self._lock:
+            if len(group.pending) < self.max_batch and self.max_delay:
+                group.full.wait(self.max_delay)
+            batch = group.pending[: self.max_batch]
+            del group.pending[: self.max_batch]
+        try:
+            self._execute(engine, batch)
+        finally:
+            with self._lock:
+                if group.pending:
+                    # 残りは次の要求のスレッドに任せる（このスレッドは自分の結果を持ってすぐ返る）
+                    nxt = group.pending[0]
+                    nxt.lead = True
+                    nxt.done.set()
+                else:
+                    group.leading = False
+                    if self._groups.get(key) is group:
+                        del self._groups[key]
+
+    def _execute(self, engine, batch):
+        """batch を1トランザクションで実行して各 _Op に結果を入れる。1件だけなら SAVEPOINT は使わない。"""
+        try:
+            with engine.connect() as conn:
+                if self.prepare is not None:
+                    self.prepare(conn)
+                begin_write(conn)
+                single = len(batch) == 1
+                for op in batch:
+                    if single:
+                        try:
+                            op.result = op.fn(conn)
+                        except Exception as e:
+                            op.error = e
+                            conn.rollback()
+                        continue
+                    conn.exec_driver_sql("SAVEPOINT write_queue")
+                    try:
+                        op.result = op.fn(conn)
+                    except Exception as e:
+                        op.error = e
+                        conn.exec_driver_sql("ROLLBACK TO write_queue")
+                    conn.exec_driver_sql("RELEASE write_queue")
+                conn.commit()
+                callbacks = []
+                for op in batch:
+                    if op.error is None and op.after_commit and op.after_commit not in callbacks:
+                        callbacks.append(op.after_commit)
+                for fn, *args in callbacks:
+                    try:
+                        fn(*args, conn)
+                    except Exception as e:
+                        # commit 済みなので要求は成功のまま返す
+                        print("[write_queue] after_commit failed:", e)
+        except Exception as e:
+            # BEGIN・commit の失敗はバッチ全体の失敗
+            for op in batch:
+                if op.error is None:
+                    op.error = e
+                    op.result = None
+        finally:
+            with self._lock:
+                self.ops += len(batch)
+                self.batches += 1
+                self.largest_batch = max(self.largest_batch, len(batch))
+                self.failed += sum(1 for op in batch if op.error is not None)
+            for op in batch:
+                op.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "ops": self.ops,
+                "batches": self.batches,
+                "ops_per_batch": round(self.ops / self.batches, 2) if self.batches else 0.0,
+                "largest_batch": self.largest_batch,
+                "failed": self.failed,
+            }
@@ -0,0 +1,6 @@
+"""
+本番用の WSGI エントリポイント（gunicorn / waitress から読み込む）。起動方法は serve.py を参照。
+"""
+from app import app
+
+application = app
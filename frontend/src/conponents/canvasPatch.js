@@ -0,0 +1,63 @@
+/**
+ * キャンバス状態の差分（JSON Patch / RFC 6902）を作る純粋関数．
+ * items は不変更新なので、同じ参照の部分木は比較せずに飛ばす。
+ */
+
+const escapePointer = (key) =>
+  String(key).replace(/~/g, "~0").replace(/\//g, "~1");
+
+const isObject = (v) => v !== null && typeof v === "object";
+
+function diffInto(ops, path, prev, next) {
+  if (prev === next) return;
+  if (
+    !isObject(prev) ||
+    !isObject(next) ||
+    Array.isArray(prev) !== Array.isArray(next)
+  ) {
+    if (prev !== next) ops.push({ op: "replace", path, value: next });
+    return;
+  }
+  if (Array.isArray(next)) {
+    const common = Math.min(prev.length, next.length);
+    for (let i = 0; i < common; i += 1) {
+      diffInto(ops, `${path}/${i}`, prev[i], next[i]);
+    }
+    // 末尾から消すとインデックスがずれない
+    for (let i = prev.length - 1; i >= next.length; i -= 1) {
+      ops.push({ op: "remove", path: `${path}/${i}` });
+    }
+    for (let i = prev.length; i < next.length; i += 1) {
+      ops.push({ op: "add", path: `${path}/-`, value: next[i] });
+    }
+    return;
+  }
+  for (const key of Object.keys(prev)) {
+    if (!(key in next) || next[key] === undefined) {
+      if (prev[key] !== undefined) {
+        ops.push({ op: "remove", path: `${path}/${escapePointer(key)}` });
+      }
+    }
+  }
+  for (const key of Object.keys(next)) {
+    if (next[key] === undefined) continue;
+    const childPath = `${path}/${escapePointer(key)}`;
+    if (!(key in prev) || prev[key] === undefined) {
+      ops.push({ op: "add", path: childPath, value: next[key] });
+    } else {
+      diffInto(ops, childPath, prev[key], next[key]);
+    }
+  }
+}
+
+/**
+ * prev → next の JSON Patch を返す
+ * @param {*} prev 前回保存した状態
+ * @param {*} next 現在の状態
+ * @returns {Array<{ op: string, path: string, value?: * }>}
+ */
+export function makePatch(prev, next) {
+  const ops = [];
+  diffInto(ops, "", prev, next);
+  return ops;
+}
@@ -4,6 +4,7 @@ import {
   deleteContentRowsByIndices,
   DEFAULT_CONTENT_ROW,
 } from "./contentsActions";
+import { makePatch } from "./canvasPatch";
 
 const MIN_SIZE = 20;
 
@@ -21,14 +22,67 @@ const API_BASE = "http://localhost:5000";
 
 const SAVE_DEBOUNCE_MS = 1500;
 
+// 差分の JSON が全体のこの割合を超えるときは全体保存にする
+const PATCH_MAX_RATIO = 0.5;
+
 export const useCanvasEditor = ({ stageWidth, stageHeight }) => {
   const [items, setItems] = useState([]);
   const itemsRef = useRef(items);
   const loadedFromServerRef = useRef(false);
   const saveTimeoutRef = useRef(null);
+  // サーバに保存済みの rev と、その時点の items（差分保存の基準）
+  const revRef = useRef(null);
+  const lastSavedRef = useRef(null);
 
   itemsRef.current = items;
 
+  // 状態全体を保存（初回・差分が衝突したとき・差分が大きいとき）
+  const saveFullState = useCallback((state, keepalive = false) => {
+    return fetch(`${API_BASE}/api/canvas/state`, {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      credentials: "include",
+      body: JSON.stringify({ state }),
+      keepalive,
+    })
+      .then((res) => (res.ok ? res.json() : null))
+      .then((data) => {
+        if (data?.rev != null) {
+          revRef.current = data.rev;
+          lastSavedRef.current = state;
+        }
+      });
+  }, []);
+
+  // 前回保存からの差分だけを送る。409（別タブが先に保存）などは全体保存で復帰
+  const saveCanvasState = useCallback(
+    (state, keepalive = false) => {
+      const base = lastSavedRef.current;
+      const rev = revRef.current;
+      if (rev == null || base == null) return saveFullState(state, keepalive);
+      const ops = makePatch(base, state);
+      if (ops.length === 0) return Promise.resolve();
+      const body = JSON.stringify({ base_rev: rev, ops });
+      if (body.length > JSON.stringify(state).length * PATCH_MAX_RATIO) {
+        return saveFullState(state, keepalive);
+      }
+      return fetch(`${API_BASE}/api/canvas/state/patch`, {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        credentials: "include",
+        body,
+        keepalive,
+      }).then((res) => {
+        if (!res.ok) return saveFullState(state, keepalive);
+        return res.json().then((data) => {
+          revRef.current = data?.rev ?? null;
+          lastSavedRef.current = state;
+        });
+      });
+    },
+    [saveFullState]
+  );
+
   // マウント時に保存済みキャンバス状態を復元（要ログイン・Cookie 送信）
   useEffect(() => {
     let cancelled = false;
@@ -48,6 +102,8 @@ export const useCanvasEditor = ({ stageWidth, stageHeight }) => {
         if (Array.isArray(state) && state.length > 0) {
           setItems(state);
         }
+        revRef.current = data?.rev ?? null;
+        lastSavedRef.current = Array.isArray(state) ? state : null;
         loadedFromServerRef.current = true;
       })
       .catch(() => {
@@ -64,34 +120,23 @@ export const useCanvasEditor = ({ stageWidth, stageHeight }) => {
     if (saveTimeoutRef.current) clearTimeout(saveTimeoutRef.current);
     saveTimeoutRef.current = setTimeout(() => {
       saveTimeoutRef.current = null;
-      fetch(`${API_BASE}/api/canvas/state`, {
-        method: "POST",
-        headers: { "Content-Type": "application/json" },
-        credentials: "include",
-        body: JSON.stringify({ state: items }),
-      }).catch(() => {});
+      saveCanvasState(items).catch(() => {});
     }, SAVE_DEBOUNCE_MS);
     return () => {
       if (saveTimeoutRef.current) clearTimeout(saveTimeoutRef.current);
     };
-  }, [items]);
+  }, [items, saveCanvasState]);
 
   // 離脱時に最新状態を保存（デバウンス待ちを避ける）
   useEffect(() => {
     const saveOnUnload = () => {
       const state = itemsRef.current;
       if (!Array.isArray(state)) return;
-      fetch(`${API_BASE}/api/canvas/state`, {
-        method: "POST",
-        headers: { "Content-Type": "application/json" },
-        credentials: "include",
-        body: JSON.stringify({ state }),
-        keepalive: true,
-      }).catch(() => {});
+      saveCanvasState(state, true).catch(() => {});
     };
     window.addEventListener("beforeunload", saveOnUnload);
     return () => window.removeEventListener("beforeunload", saveOnUnload);
-  }, []);
+  }, [saveCanvasState]);
 
   const [selectedIds, setSelectedIds] = useState([]);
   const [popupItemId, setPopupItemId] = useState(null);
@@ -373,22 +418,56 @@ export const useCanvasEditor = ({ stageWidth, stageHeight }) => {
         : parent;
       if (!item) return;
 
+      const objectName = item.name ?? item.label ?? "オブジェクト";
+      const isNested = !!item.parentId;
+      const nestType = isNested ? 2 : (parent.nestedItems?.length ? 1 : 0);
+      const parentTableName = isNested && parent.tableName ? parent.tableName : null;
+      const row = {
+        object_name: objectName,
+        name: registerDraft.name ?? "",
+        category: registerDraft.category ?? "",
+        nest_type: nestType,
+        parent_table_name: parentTableName,
+      };
+
+      // テーブル未発行なら、発行と1行追加を batch で1リクエストにまとめる
       let tableName = item.tableName;
+      let rowSaved = false;
+      let rowId = null;
       if (!tableName && item.typeId) {
         try {
-          const res = await fetch(`${API_BASE}/api/objects/next-table-name`, {
+          const res = await fetch(`${API_BASE}/api/contents/batch`, {
             method: "POST",
             headers: { "Content-Type": "application/json" },
             credentials: "include",
-            body: JSON.stringify({ type_id: item.typeId }),
+            body: JSON.stringify({
+              allocate: { type_id: item.typeId },
+              inserts: [row],
+            }),
           });
           const data = await res.json();
           tableName = data?.table_name ?? null;
+          rowSaved = !!tableName;
+          rowId = data?.ids?.[0] ?? null;
         } catch (_) {}
       }
 
       const currentContents = item.contents ?? [];
       const nextContents = addContentRow(currentContents, registerDraft);
+      const newRow = nextContents[nextContents.length - 1];
+      // 保存済みの行 id を画面側の行に付ける（削除・更新は id で指定する）
+      const attachRowId = (id) => {
+        const attach = (target) => ({
+          contents: (target.contents ?? []).map((r) =>
+            r === newRow ? { ...r, id } : r
+          ),
+        });
+        if (item.parentId) {
+          updateNestedItem(popupItemId, item.id, attach);
+        } else {
+          updateItem(item.id, attach);
+        }
+      };
       const patch = tableName
         ? { tableName, contents: nextContents }
         : { contents: nextContents };
@@ -399,27 +478,19 @@ export const useCanvasEditor = ({ stageWidth, stageHeight }) => {
       }
       closeRegisterPopup();
 
-      if (tableName) {
-        const objectName = item.name ?? item.label ?? "オブジェクト";
-        const isNested = !!item.parentId;
-        const nestType = isNested ? 2 : (parent.nestedItems?.length ? 1 : 0);
-        const parentTableName = isNested && parent.tableName ? parent.tableName : null;
+      if (tableName && !rowSaved) {
         try {
-          await fetch(`${API_BASE}/api/contents`, {
+          const res = await fetch(`${API_BASE}/api/contents`, {
             method: "POST",
             headers: { "Content-Type": "application/json" },
             credentials: "include",
-            body: JSON.stringify({
-              table_name: tableName,
-              object_name: objectName,
-              name: registerDraft.name ?? "",
-              category: registerDraft.category ?? "",
-              nest_type: nestType,
-              parent_table_name: parentTableName,
-            }),
+            body: JSON.stringify({ table_name: tableName, ...row }),
           });
+          const data = await res.json();
+          rowId = data?.id ?? null;
         } catch (_) {}
       }
+      if (Number.isInteger(rowId)) attachRowId(rowId);
     },
     [popupItemId, viewingNestedId, items, registerDraft, updateItem, updateNestedItem, closeRegisterPopup]
   );
@@ -449,6 +520,9 @@ export const useCanvasEditor = ({ stageWidth, stageHeight }) => {
         return;
       const tableName = currentPopupItem.tableName;
       const currentContents = currentPopupItem.contents ?? [];
+      const selectedRows = selectedRowIndices.map((i) => currentContents[i]);
+      // 全行に id があれば id で削除する（位置指定は id の無い古い行向け）
+      const byId = selectedRows.every((r) => Number.isInteger(r?.id));
       const nextContents = deleteContentRowsByIndices(
         currentContents,
         selectedRowIndices
@@ -467,10 +541,11 @@ export const useCanvasEditor = ({ stageWidth, stageHeight }) => {
             method: "POST",
             headers: { "Content-Type": "application/json" },
             credentials: "include",
-            body: JSON.stringify({
-              table_name: tableName,
-              indices: selectedRowIndices,
-            }),
+            body: JSON.stringify(
+              byId
+                ? { table_name: tableName, ids: selectedRows.map((r) => r.id) }
+                : { table_name: tableName, indices: selectedRowIndices }
+            ),
           });
         } catch (_) {}
       }